@@ -0,0 +1 @@
+"""Benchmarks and load tools for the bot (not part of the deployed package)."""
@@ -0,0 +1,245 @@
+"""Local stand-in for the Telegram Bot API, for offline throughput measurements.
+
+Point the bot at it with TELEGRAM_BASE_URL=http://127.0.0.1:<port>/bot. The
+server answers the Bot API methods the bot uses and plays simulated users:
+each user presses /start and then taps a random rating button on every name
+card it receives until it has rated `taps` names. Updates are delivered
+either through getUpdates (polling) or by POSTing to the webhook registered
+with setWebhook.
+"""
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional
+from collections import deque
+from urllib.parse import parse_qsl, urlsplit
+
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_name_bot"}
+
+
+@dataclass
+class SimUser:
+    user_id: int
+    taps_left: int
+    sent_at: Optional[float] = None
+    waiting: bool = False
+    paired: bool = False
+    latencies: List[float] = field(default_factory=list)
+
+    @property
+    def chat_id(self) -> int:
+        return self.user_id
+
+
+class FakeTelegram:
+    def __init__(self, users: int, taps: int, seed: int = 0):
+        self.users: Dict[int, SimUser] = {uid: SimUser(uid, taps) for uid in range(1000, 1000 + users)}
+        self.webhook_url: Optional[str] = None
+        self.secret_token: Optional[str] = None
+        self.ready = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.delivered = 0
+        self.api_calls: Dict[str, int] = {}
+        self._random = random.Random(seed)
+        self._queue: Deque[Dict[str, Any]] = deque()
+        self._queued = asyncio.Event()
+        self._update_id = 0
+        self._message_id = 0
+        self._idle: List[tuple] = []
+        self._tasks: set = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081) -> None:
+        self._server = await asyncio.start_server(self._handle, host, port)
+
+    async def stop(self) -> None:
+        self._queued.set()  # release a pending getUpdates long poll
+        if self._server is not None:
+            self._server.close()
+        for _, writer in self._idle:
+            writer.close()
+
+    # --- simulated users -------------------------------------------------
+
+    def begin(self) -> None:
+        """Every user presses /start."""
+        for user in self.users.values():
+            self._send_start(user)
+
+    def _user_json(self, user: SimUser) -> Dict[str, Any]:
+        return {"id": user.user_id, "is_bot": False, "first_name": f"User{user.user_id}", "username": f"user{user.user_id}"}
+
+    def _chat_json(self, chat_id: int) -> Dict[str, Any]:
+        return {"id": chat_id, "type": "private"}
+
+    def _send_start(self, user: SimUser) -> None:
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": self._chat_json(user.chat_id),
+            "from": self._user_json(user),
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        }
+        self._deliver(user, {"message": message})
+
+    def _tap(self, user: SimUser, message: Dict[str, Any], keyboard: List[List[Dict[str, Any]]]) -> None:
+        button = self._random.choice(keyboard[0])
+        query = {
+            "id": str(self._update_id + 1),
+            "from": self._user_json(user),
+            "chat_instance": str(user.chat_id),
+            "message": message,
+            "data": button["callback_data"],
+        }
+        user.taps_left -= 1
+        self._deliver(user, {"callback_query": query})
+
+    def _deliver(self, user: SimUser, payload: Dict[str, Any]) -> None:
+        self._update_id += 1
+        update = dict(payload, update_id=self._update_id)
+        user.sent_at = time.perf_counter()
+        self.delivered += 1
+        if self.webhook_url:
+            task = asyncio.ensure_future(self._post_update(update))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            self._queue.append(update)
+            self._queued.set()
+
+    async def _post_update(self, update: Dict[str, Any]) -> None:
+        # Bare keep-alive HTTP/1.1 POST: a full HTTP client would cost more CPU
+        # than the bot itself and skew the comparison on small boxes
+        url = urlsplit(self.webhook_url)
+        body = json.dumps(update).encode("utf-8")
+        head = f"POST {url.path} HTTP/1.1\r\nHost: {url.netloc}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        if self.secret_token:
+            head += f"X-Telegram-Bot-Api-Secret-Token: {self.secret_token}\r\n"
+        reader, writer = self._idle.pop() if self._idle else await asyncio.open_connection(url.hostname, url.port)
+        writer.write(head.encode("latin-1") + b"\r\n" + body)
+        await writer.drain()
+        await reader.readline()
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, value = line.decode("latin-1").split(":", 1)
+            if key.strip().lower() == "content-length":
+                length = int(value)
+        await reader.readexactly(length)
+        self._idle.append((reader, writer))
+
+    def _on_bot_message(self, chat_id: int, text: str, message: Dict[str, Any], markup: Optional[Dict[str, Any]]) -> None:
+        user = self.users.get(chat_id)
+        if user is None:
+            return
+        if user.sent_at is not None:
+            user.latencies.append(time.perf_counter() - user.sent_at)
+            user.sent_at = None
+        # The first user of a pair only gets a name card after a second /start,
+        # once the partner has joined (in whichever order the two messages arrive)
+        if text.startswith("Waiting for another user"):
+            user.waiting = True
+        elif text.startswith("Pair found") and markup is None:
+            user.paired = True
+        elif markup and user.taps_left > 0:
+            self._tap(user, message, markup["inline_keyboard"])
+        elif markup or text.startswith("All names rated"):
+            user.taps_left = 0
+        if user.waiting and user.paired:
+            user.waiting = False
+            self._send_start(user)
+        if all(u.taps_left == 0 and u.sent_at is None for u in self.users.values()):
+            self.finished.set()
+
+    # --- Bot API ---------------------------------------------------------
+
+    async def _call(self, method: str, params: Dict[str, Any]) -> Any:
+        self.api_calls[method] = self.api_calls.get(method, 0) + 1
+        if method == "getMe":
+            return BOT_USER
+        if method == "setWebhook":
+            self.webhook_url = params.get("url")
+            self.secret_token = params.get("secret_token")
+            self.ready.set()
+            return True
+        if method == "deleteWebhook":
+            self.webhook_url = None
+            return True
+        if method == "getUpdates":
+            self.ready.set()
+            return await self._get_updates(float(params.get("timeout") or 0))
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+            if method == "sendMessage":
+                self._message_id += 1
+                message_id = self._message_id
+            else:
+                message_id = int(params["message_id"])
+            message = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": self._chat_json(chat_id),
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+            if markup:
+                message["reply_markup"] = markup
+            self._on_bot_message(chat_id, message["text"], message, markup)
+            return message
+        return True
+
+    async def _get_updates(self, timeout: float) -> List[Dict[str, Any]]:
+        if not self._queue:
+            self._queued.clear()
+            try:
+                await asyncio.wait_for(self._queued.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        updates = []
+        while self._queue and len(updates) < 100:
+            updates.append(self._queue.popleft())
+        return updates
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Minimal HTTP/1.1 with keep-alive; enough for httpx form-encoded POSTs
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode("latin-1").split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                if headers.get("content-type", "").startswith("application/json"):
+                    params = json.loads(body or b"{}")
+                else:
+                    params = dict(parse_qsl(body.decode("utf-8")))
+                method = target.rstrip("/").rsplit("/", 1)[-1]
+                result = await self._call(method, params)
+                payload = json.dumps({"ok": True, "result": result}).encode("utf-8")
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(payload)
+                    + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def latencies(self) -> List[float]:
+        return sorted(lat for u in self.users.values() for lat in u.latencies)
@@ -0,0 +1,207 @@
+"""Load-test the bot handlers in-process with simulated pairs.
+
+Drives start, rate_callback, result, start2 and result2 for every simulated
+user concurrently, with fake Update/Context objects and a stub bot, against a
+real on-disk DB. Reports throughput and per-handler latency percentiles:
+
+    python -m bench.handler_load --pairs 100 --taps 50
+    python -m bench.handler_load --pairs 100 --max-p95-ms 20   # exit 1 if slower
+    python -m bench.handler_load --pairs 100 --shards 4
+"""
+import argparse
+import asyncio
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+from bot_app import bot as handlers
+from bot_app.db import AnyDatabase, create_database
+from bot_app.names_loader import load_catalogs
+from bot_app.outbound import OutboundQueue
+from bot_app.matchmaking import WaitingQueue
+
+from .webhook_bench import percentile
+
+
+class StubBot:
+    """Accepts send/edit calls from OutboundQueue and hands them to the user's inbox."""
+
+    def __init__(self, api_delay: float = 0.0):
+        self.api_delay = api_delay
+        self.inboxes: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._message_id = 0
+
+    async def _deliver(self, method: str, chat_id: int, message_id: int, text: str, reply_markup: Any) -> Any:
+        self.calls[method] += 1
+        if self.api_delay:
+            await asyncio.sleep(self.api_delay)
+        message = SimpleNamespace(message_id=message_id, chat_id=chat_id, text=text, reply_markup=reply_markup)
+        self.inboxes[chat_id].put_nowait(message)
+        return message
+
+    async def send_message(self, chat_id: int, text: str, reply_markup: Any = None, **kwargs: Any) -> Any:
+        self._message_id += 1
+        return await self._deliver("send_message", chat_id, self._message_id, text, reply_markup)
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str, reply_markup: Any = None, **kwargs: Any) -> Any:
+        return await self._deliver("edit_message_text", chat_id, message_id, text, reply_markup)
+
+    async def answer_callback_query(self, callback_query_id: str, **kwargs: Any) -> bool:
+        self.calls["answer_callback_query"] += 1
+        if self.api_delay:
+            await asyncio.sleep(self.api_delay)
+        return True
+
+
+class CallbackQuery:
+    def __init__(self, data: str, message: Any):
+        self.id = data
+        self.data = data
+        self.message = message
+
+
+class SimUser:
+    def __init__(self, user_id: int, load: "HandlerLoad"):
+        self.user_id = user_id
+        self.chat_id = user_id
+        self.load = load
+        self.inbox: asyncio.Queue = load.bot.inboxes[self.chat_id]
+
+    def update(self, query: Optional[CallbackQuery] = None) -> Any:
+        return SimpleNamespace(
+            effective_user=SimpleNamespace(id=self.user_id, username=f"user{self.user_id}"),
+            effective_chat=SimpleNamespace(id=self.chat_id),
+            callback_query=query,
+        )
+
+    async def receive(self, *prefixes: str, card: bool = False) -> Any:
+        """Next message that is a rating card or starts with one of `prefixes`."""
+        while True:
+            message = await asyncio.wait_for(self.inbox.get(), self.load.timeout)
+            if (card and message.reply_markup is not None) or message.text.startswith(prefixes):
+                return message
+
+    async def rate_round(self, first_card: Any, taps: int) -> None:
+        message = first_card
+        while taps > 0 and message.reply_markup is not None:
+            buttons = message.reply_markup.inline_keyboard[0]
+            data = self.load.random.choice(buttons).callback_data
+            await self.load.call("rate_callback", self.update(CallbackQuery(data, message)))
+            message = await self.receive("All names rated", card=True)
+            taps -= 1
+
+    async def run(self, taps: int) -> None:
+        await self.load.call("start", self.update())
+        message = await self.receive("Waiting for another user", card=True)
+        if message.reply_markup is None:
+            # First of the pair: press /start again once the partner has joined
+            await self.receive("Pair found")
+            await self.load.call("start", self.update())
+            message = await self.receive(card=True)
+        await self.rate_round(message, taps)
+        await self.load.call("result_round1", self.update())
+        await self.receive("Round 1 matches", "No common likes")
+
+        await self.load.call("start2", self.update())
+        message = await self.receive("All names rated", card=True)
+        await self.rate_round(message, taps)
+        await self.load.call("result_round2", self.update())
+        await self.receive("Round 2 matches", "No common likes")
+
+
+class HandlerLoad:
+    def __init__(self, db: AnyDatabase, api_delay: float, timeout: float, seed: int):
+        self.db = db
+        self.bot = StubBot(api_delay)
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.context: Any = None
+
+    async def call(self, name: str, update: Any) -> None:
+        started = time.perf_counter()
+        await getattr(handlers, name)(update, self.context)
+        self.latencies[name].append(time.perf_counter() - started)
+
+    async def run(self, users: int, taps: int) -> Tuple[float, Dict[str, float]]:
+        # Budgets lifted: measure the handlers, not the outbound rate limits
+        outbound = OutboundQueue(self.bot, global_rate=1e9, chat_rate=1e9, chat_burst=1e9, stats_interval=0)
+        outbound.start()
+        self.context = SimpleNamespace(
+            bot=self.bot,
+            args=[],
+            bot_data={handlers.DB_KEY: self.db, handlers.WAITING_KEY: WaitingQueue(), handlers.OUTBOUND_KEY: outbound},
+        )
+        sims = [SimUser(user_id, self) for user_id in range(1000, 1000 + users)]
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(sim.run(taps) for sim in sims))
+        finally:
+            elapsed = time.perf_counter() - started
+            await outbound.stop()
+        return elapsed, outbound.stats()
+
+
+def report(load: HandlerLoad, elapsed: float, outbound_stats: Dict[str, float]) -> float:
+    """Print the results; return the overall p95 handler latency in ms."""
+    everything = sorted(lat for lats in load.latencies.values() for lat in lats)
+    print(f"handler calls: {len(everything)} in {elapsed:.2f}s -> {len(everything) / elapsed:.1f} calls/s")
+    print(f"{'handler':<15}{'calls':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, lats in sorted(load.latencies.items()) + [("all", everything)]:
+        lats = sorted(lats)
+        print(f"{name:<15}{len(lats):>8}" + "".join(f"{percentile(lats, q) * 1000:>10.2f}" for q in (0.5, 0.95, 0.99)))
+    print(f"bot api calls: {dict(sorted(load.bot.calls.items()))}")
+    print(f"outbound: {outbound_stats}")
+    print(f"user cache: {load.db.conn.user_cache.stats()}")
+    print(f"result cache: {[conn.result_cache.stats() for conn in load.db.connections]}")
+    print(f"prefetch: {[conn.prefetch.stats() for conn in load.db.connections if conn.prefetch is not None]}")
+    return percentile(everything, 0.95) * 1000
+
+
+async def run(args: argparse.Namespace) -> float:
+    if not handlers.TELEGRAM_BOT_TOKEN:
+        # start() refuses to run without a token; the stub bot needs none
+        handlers.TELEGRAM_BOT_TOKEN = "load-test"
+    with tempfile.TemporaryDirectory() as tmp:
+        db = create_database(args.db or str(Path(tmp) / "load.db"), args.shards, (), args.commit_window_ms, args.commit_rows)
+        conn = db.open()
+        handlers.seed_names(conn)
+        catalogs = load_catalogs(conn)
+        for db_conn in db.connections:
+            db_conn.name_catalogs = catalogs
+        load = HandlerLoad(db, args.api_ms / 1000, args.timeout, args.seed)
+        try:
+            elapsed, outbound_stats = await load.run(args.pairs * 2, args.taps)
+            print(f"pairs={args.pairs} taps/user/round={args.taps} names={sum(map(len, catalogs.values()))} shards={args.shards}")
+            return report(load, elapsed, outbound_stats)
+        finally:
+            db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pairs", type=int, default=50)
+    parser.add_argument("--taps", type=int, default=30, help="Names each user rates per round.")
+    parser.add_argument("--db", help="DB file to use (default: a fresh temporary file).")
+    parser.add_argument("--shards", type=int, default=1, help="Ratings files (see db.ShardedDatabase).")
+    parser.add_argument("--commit-window-ms", type=int, default=0)
+    parser.add_argument("--commit-rows", type=int, default=0)
+    parser.add_argument("--api-ms", type=float, default=0, help="Simulated Bot API latency per call.")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds a user waits for a reply.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-p95-ms", type=float, help="Exit with status 1 if the overall p95 is above this.")
+    args = parser.parse_args()
+    p95 = asyncio.run(run(args))
+    if args.max_p95_ms is not None and p95 > args.max_p95_ms:
+        print(f"FAIL: p95 {p95:.2f} ms > {args.max_p95_ms} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
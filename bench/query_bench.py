@@ -0,0 +1,269 @@
+"""Time the core.py queries on large catalogs and check their query plans.
+
+Seeds an on-disk DB per catalog size (1k names, names.txt, 100k synthetic
+names) with up to millions of ratings, times each core function, and records
+EXPLAIN QUERY PLAN for every statement it runs. A statement that scans a
+whole table or index, or sorts through a temp B-tree, fails the run:
+
+    python -m bench.query_bench
+    python -m bench.query_bench --catalogs 100k --ratings 5000000 --plans
+"""
+import argparse
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, NamedTuple, Sequence, Tuple
+
+from bot_app import core
+from bot_app.config import ANSWER_CODES, ANSWER_LIKE, ANSWER_DISLIKE, ANSWER_NEUTRAL, BASE_DIR, NAMES_FILE, ROUND_ONE, ROUND_TWO
+from bot_app.db import GroupCommitConnection, add_names, configure_connection, get_connection, init_db
+from bot_app.likes import rebuild_like_bitmaps
+from bot_app.names_loader import load_catalogs, load_names
+
+from .webhook_bench import percentile
+
+
+ANSWERS = (ANSWER_LIKE, ANSWER_DISLIKE, ANSWER_NEUTRAL)
+
+# Full scans of a table or index (including a bare "SEARCH t", a rowid walk
+# without any usable index), and sorts that go through a temp B-tree. SCAN of
+# a subquery result or a constant row is fine.
+PLAN_PROBLEMS = re.compile(r"^SCAN (?!CONSTANT ROW|\(subquery)|^SEARCH [^ (]+$|USE TEMP B-TREE")
+
+# Accepted problems, per core function
+ALLOWED_PLAN_PROBLEMS: Dict[str, Tuple[str, ...]] = {}
+
+_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+
+def catalog_names(catalog: str) -> List[str]:
+    if catalog == "1k":
+        return load_names(NAMES_FILE)
+    if catalog == "7.5k":
+        return load_names(BASE_DIR / "names.txt")
+    if catalog == "100k":
+        return [f"Name{i:06d}" for i in range(100000)]
+    raise ValueError(f"Unknown catalog {catalog!r}")
+
+
+def seed(conn: sqlite3.Connection, names: Sequence[str], pairs: int, ratings: int, seed: int = 0) -> int:
+    """Fill an initialized DB with `pairs` pairs whose users rated the first names in order.
+
+    About `ratings` round 1 answers in total, with matching progress rows;
+    every other pair has started round 2 and rated half of its candidates.
+    Returns the number of ratings written.
+    """
+    rnd = random.Random(seed)
+    add_names(conn, names)
+    name_ids = [row[0] for row in conn.execute("SELECT id FROM names ORDER BY id")]
+    per_user = min(len(name_ids), max(1, ratings // (pairs * 2)))
+    written = 0
+    for p in range(pairs):
+        user1, user2 = 2 * p + 1, 2 * p + 2
+        cur = conn.cursor()
+        cur.executemany("INSERT OR IGNORE INTO users(user_id, username, chat_id) VALUES (?, ?, ?)", [(u, f"user{u}", u) for u in (user1, user2)])
+        cur.execute("INSERT INTO pairs(user1_id, user2_id) VALUES (?, ?)", (user1, user2))
+        pair_id = cur.lastrowid
+        for user_id in (user1, user2):
+            # Likes are common enough that round 2 has candidates at every size
+            rows = [
+                (pair_id, ROUND_ONE, user_id, name_id, ANSWER_CODES[ANSWER_LIKE if rnd.random() < 0.6 else rnd.choice(ANSWERS[1:])])
+                for name_id in name_ids[:per_user]
+            ]
+            cur.executemany("INSERT INTO ratings(pair_id, round, user_id, name_id, answer) VALUES (?, ?, ?, ?, ?)", rows)
+            written += len(rows)
+            next_position = name_ids[per_user] if per_user < len(name_ids) else name_ids[-1] + 1
+            cur.execute(
+                "INSERT INTO progress(pair_id, user_id, round, position, answered) VALUES (?, ?, ?, ?, ?)",
+                (pair_id, user_id, ROUND_ONE, next_position, per_user),
+            )
+        conn.commit()
+    # Ratings went in behind core's back: derive the like bitmaps from them
+    rebuild_like_bitmaps(conn.cursor())
+    conn.commit()
+    for pair_id in range(1, pairs + 1, 2):
+        user1 = 2 * pair_id - 1
+        core.start_second_round(conn, pair_id)
+        candidates = [row[0] for row in conn.execute("SELECT name_id FROM round2_candidates WHERE pair_id=? ORDER BY name_id", (pair_id,))]
+        for name_id in candidates[: len(candidates) // 2]:
+            core.record_answer(conn, pair_id, ROUND_TWO, user1, name_id, rnd.choice(ANSWERS))
+    return written
+
+
+class Check(NamedTuple):
+    label: str
+    function: str
+    call: Callable[[sqlite3.Connection, int, int, int], object]
+
+
+CHECKS: List[Check] = [
+    Check("get_user_pair", "get_user_pair", lambda conn, pair_id, user_id, name_id: core.get_user_pair(conn, user_id)),
+    Check(
+        "get_round_step r1", "get_round_step", lambda conn, pair_id, user_id, name_id: core.get_round_step(conn, pair_id, ROUND_ONE, user_id)
+    ),
+    Check(
+        "get_round_step r2", "get_round_step", lambda conn, pair_id, user_id, name_id: core.get_round_step(conn, pair_id, ROUND_TWO, user_id)
+    ),
+    Check(
+        "get_next_name_for_round r1",
+        "get_next_name_for_round",
+        lambda conn, pair_id, user_id, name_id: core.get_next_name_for_round(conn, pair_id, ROUND_ONE, user_id),
+    ),
+    Check(
+        "get_round_progress r1",
+        "get_round_progress",
+        lambda conn, pair_id, user_id, name_id: core.get_round_progress(conn, pair_id, ROUND_ONE, user_id),
+    ),
+    Check(
+        "answer_and_advance r1",
+        "answer_and_advance",
+        lambda conn, pair_id, user_id, name_id: core.answer_and_advance(conn, pair_id, ROUND_ONE, user_id, name_id, ANSWER_LIKE),
+    ),
+    Check(
+        "get_results_for_round r1",
+        "get_results_for_round",
+        lambda conn, pair_id, user_id, name_id: core.get_results_for_round(conn, pair_id, ROUND_ONE),
+    ),
+    Check(
+        "get_results_for_round r2",
+        "get_results_for_round",
+        lambda conn, pair_id, user_id, name_id: core.get_results_for_round(conn, pair_id, ROUND_TWO),
+    ),
+    Check(
+        "start_second_round", "start_second_round", lambda conn, pair_id, user_id, name_id: core.start_second_round(conn, pair_id)
+    ),
+]
+
+
+@contextmanager
+def capture_sql(conn: sqlite3.Connection) -> Iterator[List[str]]:
+    """Collect the statements (with bound values expanded) run on conn."""
+    statements: List[str] = []
+    conn.set_trace_callback(statements.append)
+    try:
+        yield statements
+    finally:
+        conn.set_trace_callback(None)
+
+
+def normalize_sql(sql: str) -> str:
+    """Statement text with literals replaced by ?, for grouping executions."""
+    return _SQL_LITERAL.sub("?", " ".join(sql.split()))
+
+
+def query_plan(conn: sqlite3.Connection, sql: str) -> List[str]:
+    if not sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")):
+        return []
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+
+
+def plan_problems(plan: Sequence[str], allowed: Sequence[str] = ()) -> List[str]:
+    return [detail for detail in plan if PLAN_PROBLEMS.search(detail) and detail not in allowed]
+
+
+def collect_plans(conn: sqlite3.Connection, pair_id: int, user_id: int, name_id: int) -> Dict[str, Dict[str, List[str]]]:
+    """Run every check once; return {label: {normalized statement: plan}}."""
+    plans: Dict[str, Dict[str, List[str]]] = {}
+    for check in CHECKS:
+        with capture_sql(conn) as statements:
+            check.call(conn, pair_id, user_id, name_id)
+        for sql in statements:
+            plan = query_plan(conn, sql)
+            if plan:
+                plans.setdefault(check.label, {})[normalize_sql(sql)] = plan
+    return plans
+
+
+def plan_failures(plans: Dict[str, Dict[str, List[str]]]) -> Dict[str, Dict[str, List[str]]]:
+    """The statements of collect_plans() whose plans have unaccepted problems."""
+    functions = {check.label: check.function for check in CHECKS}
+    failures: Dict[str, Dict[str, List[str]]] = {}
+    for label, statements in plans.items():
+        allowed = ALLOWED_PLAN_PROBLEMS.get(functions[label], ())
+        for sql, plan in statements.items():
+            if plan_problems(plan, allowed):
+                failures.setdefault(label, {})[sql] = plan
+    return failures
+
+
+def time_checks(conn: sqlite3.Connection, pairs: int, per_user: int, repeat: int, rnd: random.Random) -> Dict[str, List[float]]:
+    timings: Dict[str, List[float]] = {}
+    for check in CHECKS:
+        samples = timings[check.label] = []
+        for _ in range(repeat):
+            pair_id = rnd.randint(1, pairs)
+            user_id = 2 * pair_id - rnd.randint(0, 1)
+            # Answers land just past the seeded ones, like a user working through the catalog
+            name_id = per_user + rnd.randint(1, 50)
+            started = time.perf_counter()
+            check.call(conn, pair_id, user_id, name_id)
+            samples.append(time.perf_counter() - started)
+    return timings
+
+
+def run_catalog(catalog: str, args: argparse.Namespace, tmp: Path) -> bool:
+    names = catalog_names(catalog)
+    conn = get_connection(str(tmp / f"query_{catalog}.db"), factory=GroupCommitConnection)
+    configure_connection(conn)
+    init_db(conn)
+    started = time.perf_counter()
+    written = seed(conn, names, args.pairs, args.ratings, args.seed)
+    seeded_in = time.perf_counter() - started
+    if args.catalog_attached:
+        conn.name_catalogs = load_catalogs(conn)
+    per_user = conn.execute("SELECT MAX(position) FROM progress WHERE round=?", (ROUND_ONE,)).fetchone()[0]
+    print(f"\n== catalog {catalog}: {len(names)} names, {args.pairs} pairs, {written} ratings (seeded in {seeded_in:.1f}s)")
+
+    # Pair 2 is still in round 1 (its first start_second_round takes the
+    # snapshot); pair 1 is in round 2
+    plans = collect_plans(conn, 2, 3, per_user)
+    for label, statements in collect_plans(conn, 1, 1, per_user).items():
+        plans.setdefault(label, {}).update(statements)
+    failures = plan_failures(plans)
+    if args.plans:
+        for label, statements in plans.items():
+            print(f"-- {label}")
+            for sql, plan in statements.items():
+                print(f"   {sql[:120]}")
+                for detail in plan:
+                    print(f"      {detail}")
+
+    timings = time_checks(conn, args.pairs, per_user, args.repeat, random.Random(args.seed))
+    print(f"{'function':<30}{'mean us':>10}{'p50 us':>10}{'p95 us':>10}{'p99 us':>10}")
+    for label, samples in timings.items():
+        samples.sort()
+        mean = sum(samples) / len(samples)
+        print(f"{label:<30}{mean * 1e6:>10.1f}" + "".join(f"{percentile(samples, q) * 1e6:>10.1f}" for q in (0.5, 0.95, 0.99)))
+    conn.close()
+
+    for label, statements in failures.items():
+        for sql, plan in statements.items():
+            print(f"PLAN REGRESSION in {label}: {sql[:120]}")
+            for detail in plan:
+                print(f"      {detail}")
+    return not failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--catalogs", nargs="+", choices=("1k", "7.5k", "100k"), default=["1k", "7.5k", "100k"])
+    parser.add_argument("--pairs", type=int, default=200)
+    parser.add_argument("--ratings", type=int, default=1000000, help="Round 1 ratings to seed per catalog.")
+    parser.add_argument("--repeat", type=int, default=500, help="Timed calls per function.")
+    parser.add_argument("--catalog-attached", action="store_true", help="Attach a NameCatalog, as the bot does.")
+    parser.add_argument("--plans", action="store_true", help="Print every statement's query plan.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        ok = all([run_catalog(catalog, args, Path(tmp)) for catalog in args.catalogs])
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Compare the old (v1) and compact (v2) ratings layouts, and time the migration.
+
+For each layout: file size after `--ratings` answers and the rate of per-tap
+inserts (one INSERT OR IGNORE and commit per answer, as core does). Then a v1
+file is converted with db.migrate_ratings, reporting the longest batch, which
+is how long a handler can wait behind the migration:
+
+    python -m bench.ratings_schema_bench
+    python -m bench.ratings_schema_bench --ratings 2000000 --taps 20000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterator, Tuple
+
+from bot_app.config import ANSWER_CODES, DB_MIGRATION_BATCH_ROWS
+from bot_app.db import RATINGS_SQL, SCHEMA_VERSION, configure_connection, get_connection, migrate_ratings
+
+
+# ratings as created before schema version 2
+LEGACY_RATINGS_SQL = (
+    """
+    CREATE TABLE ratings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        pair_id INTEGER NOT NULL,
+        round INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        name_id INTEGER NOT NULL,
+        answer TEXT NOT NULL CHECK (answer IN ('like','dislike','neutral')),
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(pair_id, round, user_id, name_id)
+    )
+    """,
+    "CREATE INDEX idx_ratings_pair_round ON ratings(pair_id, round)",
+    "CREATE INDEX idx_ratings_user_round ON ratings(user_id, round)",
+)
+
+ANSWERS = tuple(ANSWER_CODES)
+
+
+def create_legacy_ratings(conn: sqlite3.Connection) -> None:
+    """Give a fresh file the v1 ratings table, as an old bot would have left it."""
+    for sql in LEGACY_RATINGS_SQL:
+        conn.execute(sql)
+    conn.commit()
+
+
+def create_ratings(conn: sqlite3.Connection, legacy: bool) -> None:
+    if legacy:
+        create_legacy_ratings(conn)
+    else:
+        conn.execute(RATINGS_SQL.format(table="ratings"))
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+
+
+def answers(count: int, pairs: int, seed: int) -> Iterator[Tuple[int, int, int, int, str]]:
+    """(pair_id, round, user_id, name_id, answer): both users of every pair
+    rating names in order, pairs interleaved the way live taps arrive."""
+    rnd = random.Random(seed)
+    for i in range(count):
+        pair_id = i % pairs + 1
+        turn = i // pairs
+        user_id = 2 * pair_id - 1 + turn % 2
+        yield pair_id, 1, user_id, turn // 2 + 1, rnd.choice(ANSWERS)
+
+
+def stored(row: Tuple[int, int, int, int, str], legacy: bool) -> Tuple[int, int, int, int, object]:
+    return row[:4] + ((row[4] if legacy else ANSWER_CODES[row[4]]),)
+
+
+def fill(conn: sqlite3.Connection, legacy: bool, count: int, pairs: int, seed: int) -> None:
+    rows = (stored(row, legacy) for row in answers(count, pairs, seed))
+    conn.executemany("INSERT INTO ratings(pair_id, round, user_id, name_id, answer) VALUES (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+
+
+def file_size(path: Path) -> int:
+    return sum(os.path.getsize(p) for p in (path, Path(f"{path}-wal")) if p.exists())
+
+
+def insert_rate(conn: sqlite3.Connection, legacy: bool, taps: int, pairs: int, seed: int) -> float:
+    """Answers per second, committing each one."""
+    rows = [stored(row, legacy) for row in answers(taps, pairs, seed)]
+    # Fresh pair ids: appended after the seeded ratings, as new pairs would be
+    offset = 10 * pairs
+    started = time.perf_counter()
+    for pair_id, round_num, user_id, name_id, answer in rows:
+        conn.execute(
+            "INSERT OR IGNORE INTO ratings(pair_id, round, user_id, name_id, answer) VALUES (?, ?, ?, ?, ?)",
+            (pair_id + offset, round_num, user_id + 2 * offset, name_id, answer),
+        )
+        conn.commit()
+    return taps / (time.perf_counter() - started)
+
+
+def run_layout(tmp: Path, legacy: bool, args: argparse.Namespace) -> None:
+    path = tmp / ("v1.db" if legacy else "v2.db")
+    conn = get_connection(str(path))
+    configure_connection(conn)
+    create_ratings(conn, legacy)
+    fill(conn, legacy, args.ratings, args.pairs, args.seed)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    size = file_size(path)
+    rate = insert_rate(conn, legacy, args.taps, args.pairs, args.seed + 1)
+    conn.close()
+    label = "v1 (text, rowid, 3 indexes)" if legacy else "v2 (int, WITHOUT ROWID)"
+    print(f"{label:<30}{size / 1e6:>10.1f} MB{size / args.ratings:>10.1f} B/row{rate:>12.0f} inserts/s")
+
+
+def run_migration(tmp: Path, args: argparse.Namespace) -> None:
+    path = tmp / "migrate.db"
+    conn = get_connection(str(path))
+    configure_connection(conn)
+    create_legacy_ratings(conn)
+    fill(conn, True, args.ratings, args.pairs, args.seed)
+    conn.execute(RATINGS_SQL.format(table="ratings_v2"))
+    conn.commit()
+    batches = []
+    started = time.perf_counter()
+    after_id = 0
+    while after_id is not None:
+        batch_started = time.perf_counter()
+        after_id = migrate_ratings(conn, after_id, args.batch_rows)
+        batches.append(time.perf_counter() - batch_started)
+    elapsed = time.perf_counter() - started
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.close()
+    print(
+        f"migration: {args.ratings} rows in {elapsed:.2f}s ({args.ratings / elapsed:.0f} rows/s), "
+        f"{len(batches)} batches of {args.batch_rows}, longest {max(batches) * 1000:.1f} ms, user_version {version}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ratings", type=int, default=500000, help="Answers seeded per layout.")
+    parser.add_argument("--pairs", type=int, default=500)
+    parser.add_argument("--taps", type=int, default=5000, help="Answers inserted one commit at a time.")
+    parser.add_argument("--batch-rows", type=int, default=DB_MIGRATION_BATCH_ROWS)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{args.ratings} ratings over {args.pairs} pairs")
+        for legacy in (True, False):
+            run_layout(Path(tmp), legacy, args)
+        run_migration(Path(tmp), args)
+
+
+if __name__ == "__main__":
+    main()
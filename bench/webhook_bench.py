@@ -0,0 +1,88 @@
+"""Measure bot throughput against the local fake Telegram, polling vs webhook.
+
+Runs the real bot (python -m bot_app.bot) in a subprocess with a fresh DB and
+drives it with simulated users, without network access:
+
+    python -m bench.webhook_bench --mode webhook --pairs 50 --taps 40
+    python -m bench.webhook_bench --mode polling --pairs 50 --taps 40
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from .fake_telegram import FakeTelegram
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args: argparse.Namespace) -> None:
+    fake = FakeTelegram(users=args.pairs * 2, taps=args.taps, seed=args.seed)
+    await fake.start(port=args.api_port)
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            TELEGRAM_BOT_TOKEN="123456:FAKE",
+            TELEGRAM_BASE_URL=f"http://127.0.0.1:{args.api_port}/bot",
+            BOT_MODE=args.mode,
+            BOT_DB_PATH=str(Path(tmp) / "bench.db"),
+            WEBHOOK_PORT=str(args.webhook_port),
+            WEBHOOK_URL=f"http://127.0.0.1:{args.webhook_port}/telegram",
+            MAX_CONCURRENT_UPDATES=str(args.concurrency),
+        )
+        if not args.real_budgets:
+            # Simulated users tap instantly; measure the bot, not the outbound rate limits
+            env.update(OUTBOUND_GLOBAL_RATE="100000", OUTBOUND_CHAT_RATE="100000", OUTBOUND_CHAT_BURST="100000")
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "bot_app.bot", env=env, stderr=asyncio.subprocess.DEVNULL if args.quiet else None
+        )
+        try:
+            await asyncio.wait_for(fake.ready.wait(), 30)
+            if args.mode == "webhook":
+                # The webhook server starts listening right after setWebhook returns
+                await asyncio.sleep(0.5)
+            started = time.perf_counter()
+            fake.begin()
+            await asyncio.wait_for(fake.finished.wait(), args.timeout)
+            elapsed = time.perf_counter() - started
+        finally:
+            proc.send_signal(signal.SIGINT)
+            await proc.wait()
+            await fake.stop()
+
+    latencies = fake.latencies()
+    print(f"mode={args.mode} pairs={args.pairs} taps/user={args.taps} concurrency={args.concurrency}")
+    print(f"updates: {fake.delivered} in {elapsed:.2f}s -> {fake.delivered / elapsed:.1f} updates/s")
+    print(
+        "update->reply latency ms: p50={:.1f} p95={:.1f} p99={:.1f}".format(
+            *(percentile(latencies, q) * 1000 for q in (0.5, 0.95, 0.99))
+        )
+    )
+    print(f"api calls: {dict(sorted(fake.api_calls.items()))}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="webhook")
+    parser.add_argument("--pairs", type=int, default=20)
+    parser.add_argument("--taps", type=int, default=30, help="Names each user rates.")
+    parser.add_argument("--concurrency", type=int, default=64, help="MAX_CONCURRENT_UPDATES for webhook mode.")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--webhook-port", type=int, default=8443)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--real-budgets", action="store_true", help="Keep the bot's outbound rate limits.")
+    parser.add_argument("--quiet", action="store_true", help="Hide the bot's log output.")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Awaitable wrappers over core/db functions.
+
+Each call runs on the Database thread, so a slow query or commit delays only the
+update that issued it instead of the whole event loop. Calls about one pair's
+ratings go through run_for_pair, which a ShardedDatabase routes to that pair's
+shard.
+"""
+import sqlite3
+from typing import List, Optional, Tuple
+
+from . import core
+from .config import DEFAULT_CATALOG_ID
+from .db import AnyDatabase, get_catalog as _get_catalog, get_user_chat_id as _get_user_chat_id, list_catalogs as _list_catalogs
+from .matchmaking import WaitingQueue
+
+
+async def create_or_join_pair(
+    db: AnyDatabase,
+    user_id: int,
+    username: Optional[str],
+    chat_id: Optional[int],
+    queue: Optional[WaitingQueue] = None,
+    catalog_id: int = DEFAULT_CATALOG_ID,
+) -> Tuple[sqlite3.Row, bool]:
+    return await db.run(core.create_or_join_pair, user_id, username, chat_id, queue, catalog_id)
+
+
+async def get_user_pair(db: AnyDatabase, user_id: int) -> Optional[sqlite3.Row]:
+    return await db.run(core.get_user_pair, user_id)
+
+
+async def record_answer(db: AnyDatabase, pair_id: int, round_num: int, user_id: int, name_id: int, answer: str) -> bool:
+    return await db.run_for_pair(pair_id, core.record_answer, pair_id, round_num, user_id, name_id, answer)
+
+
+async def answer_and_advance(db: AnyDatabase, pair_id: int, round_num: int, user_id: int, name_id: int, answer: str) -> core.RoundStep:
+    return await db.run_for_pair(pair_id, core.answer_and_advance, pair_id, round_num, user_id, name_id, answer)
+
+
+async def get_round_step(db: AnyDatabase, pair_id: int, round_num: int, user_id: int) -> core.RoundStep:
+    return await db.run_for_pair(pair_id, core.get_round_step, pair_id, round_num, user_id)
+
+
+async def get_next_name_for_round(db: AnyDatabase, pair_id: int, round_num: int, user_id: int) -> Optional[sqlite3.Row]:
+    return await db.run_for_pair(pair_id, core.get_next_name_for_round, pair_id, round_num, user_id)
+
+
+async def get_round_progress(db: AnyDatabase, pair_id: int, round_num: int, user_id: int) -> Tuple[int, int]:
+    return await db.run_for_pair(pair_id, core.get_round_progress, pair_id, round_num, user_id)
+
+
+async def get_results_for_round(db: AnyDatabase, pair_id: int, round_num: int) -> List[str]:
+    return await db.run_for_pair(pair_id, core.get_results_for_round, pair_id, round_num)
+
+
+async def start_second_round(db: AnyDatabase, pair_id: int) -> None:
+    await db.run_for_pair(pair_id, core.start_second_round, pair_id)
+
+
+async def get_user_chat_id(db: AnyDatabase, user_id: int) -> Optional[int]:
+    return await db.run(_get_user_chat_id, user_id)
+
+
+async def get_catalog(db: AnyDatabase, name: str) -> Optional[sqlite3.Row]:
+    return await db.run(_get_catalog, name)
+
+
+async def list_catalogs(db: AnyDatabase) -> List[sqlite3.Row]:
+    return await db.run(_list_catalogs)
@@ -1,28 +1,135 @@
+import asyncio
+import contextlib
 import logging
 import os
-from typing import Optional
+import time
+from typing import Any, Awaitable, Dict, Hashable, Optional, Tuple
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler
-
-from .config import TELEGRAM_BOT_TOKEN, DB_PATH, ANSWER_LIKE, ANSWER_DISLIKE, ANSWER_NEUTRAL, ROUND_ONE, ROUND_TWO
-from .db import get_connection, init_db, get_user_chat_id
-from .core import (
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor, CommandHandler, ContextTypes, CallbackQueryHandler
+
+from .config import (
+    TELEGRAM_BOT_TOKEN,
+    TELEGRAM_BASE_URL,
+    DB_PATH,
+    NAMES_FILE,
+    BOT_MODE,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET,
+    MAX_CONCURRENT_UPDATES,
+    RATING_CARD_EDIT,
+    ANSWER_LIKE,
+    ANSWER_DISLIKE,
+    ANSWER_NEUTRAL,
+    DEFAULT_CATALOG,
+    DEFAULT_CATALOG_ID,
+    ROUND_ONE,
+    ROUND_TWO,
+)
+from .db import AnyDatabase, create_database, shard_connections, sync_names
+from .matchmaking import WaitingQueue
+from .metrics import MetricsReporter, instrument_handler, metrics
+from .outbound import OutboundQueue
+from .async_core import (
     create_or_join_pair,
     get_user_pair,
-    get_next_name_for_round,
-    record_answer,
+    answer_and_advance,
+    get_round_step,
     get_results_for_round,
     start_second_round,
-    get_round_progress,
+    get_user_chat_id,
+    get_catalog,
+    list_catalogs,
 )
-from .names_loader import load_names
-from .db import add_names
+from .core import RoundStep
+from .names_loader import load_catalogs, load_names
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Keys of shared state in application.bot_data
+DB_KEY = "db"
+WAITING_KEY = "waiting"
+OUTBOUND_KEY = "outbound"
+METRICS_KEY = "metrics"
+MIGRATION_KEY = "migration"
+
+
+def get_db(context: ContextTypes.DEFAULT_TYPE) -> AnyDatabase:
+    return context.bot_data[DB_KEY]
+
+
+def get_outbound(context: ContextTypes.DEFAULT_TYPE) -> OutboundQueue:
+    return context.bot_data[OUTBOUND_KEY]
+
+
+def reply(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
+    # Queued like every other outbound message; the handler doesn't wait for Telegram
+    get_outbound(context).send_message(update.effective_chat.id, text)
+
+
+def seed_names(db: AnyDatabase) -> None:
+    # Add names that are new in NAMES_FILE; removals only go through
+    # filter_names.py --sync-db, so a truncated file can't empty the table
+    added, _ = sync_names(db.conn, load_names(NAMES_FILE), remove=False, shards=shard_connections(db))
+    if added:
+        logger.info("Added %d names from %s", added, NAMES_FILE)
+
+
+def update_order_keys(update: object) -> Tuple[Hashable, ...]:
+    """Keys whose updates must be handled in arrival order, in locking order.
+
+    Every update is ordered per user, so a tap and the command sent right after it
+    can't swap; rating taps are also ordered per pair (pair id from callback_data).
+    """
+    if not isinstance(update, Update) or update.effective_user is None:
+        return ()
+    keys: Tuple[Hashable, ...] = (("user", update.effective_user.id),)
+    q = update.callback_query
+    if q is not None and q.data and q.data.startswith("r|"):
+        keys += (("pair", q.data.split("|", 2)[1]),)
+    return keys
+
+
+class PairOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently while serializing those that share an order key.
+
+    Locks are taken user first, pair last, and only taps take a pair lock, so two
+    updates never wait on each other in a cycle.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._users: Dict[Hashable, int] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        keys = update_order_keys(update)
+        for key in keys:
+            self._users[key] = self._users.get(key, 0) + 1
+        try:
+            async with contextlib.AsyncExitStack() as stack:
+                for key in keys:
+                    # asyncio.Lock wakes waiters first-in first-out, i.e. in arrival order
+                    await stack.enter_async_context(self._locks.setdefault(key, asyncio.Lock()))
+                await coroutine
+        finally:
+            for key in keys:
+                self._users[key] -= 1
+                if not self._users[key]:
+                    del self._users[key]
+                    del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
 
 def build_keyboard(pair_id: int, name_id: int, round_num: int) -> InlineKeyboardMarkup:
     # Compact callback_data format: r|pair|name|round|ans
@@ -39,54 +146,73 @@ def build_keyboard(pair_id: int, name_id: int, round_num: int) -> InlineKeyboard
     return InlineKeyboardMarkup(buttons)
 
 
-async def send_next_name(update: Update, context: ContextTypes.DEFAULT_TYPE, conn, pair_id: int, user_id: int, round_num: int):
-    row = get_next_name_for_round(conn, pair_id, round_num, user_id)
-    answered, total = get_round_progress(conn, pair_id, round_num, user_id)
-    if not row:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=f"All names rated for round {round_num}. Progress: {answered}/{total}. Use /result{'' if round_num == 1 else '2'} to see matches.",
-        )
-        return
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=f"Round {round_num} ({answered}/{total}): {row['name']}",
-        reply_markup=build_keyboard(pair_id, row["id"], round_num),
-    )
+async def send_round_step(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    pair_id: int,
+    round_num: int,
+    step: RoundStep,
+    message_id: Optional[int] = None,
+):
+    # With a message_id the rating card is edited in place (a new message is
+    # sent only if the edit fails), otherwise a new card is sent
+    outbound = get_outbound(context)
+    chat_id = update.effective_chat.id
+    if step.name_id is None:
+        text = f"All names rated for round {round_num}. Progress: {step.answered}/{step.total}. Use /result{'' if round_num == 1 else '2'} to see matches."
+        markup = None
+    else:
+        text = f"Round {round_num} ({step.answered}/{step.total}): {step.name}"
+        markup = build_keyboard(pair_id, step.name_id, round_num)
+    if message_id is not None:
+        outbound.edit_message_text(chat_id, message_id, text, reply_markup=markup)
+    else:
+        outbound.send_message(chat_id, text, reply_markup=markup)
+
+
+async def send_next_name(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AnyDatabase, pair_id: int, user_id: int, round_num: int):
+    step = await get_round_step(db, pair_id, round_num, user_id)
+    await send_round_step(update, context, pair_id, round_num, step)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not TELEGRAM_BOT_TOKEN:
-        await update.message.reply_text("Bot token missing. Set TELEGRAM_BOT_TOKEN env variable.")
+        reply(update, context, "Bot token missing. Set TELEGRAM_BOT_TOKEN env variable.")
         return
-    conn = get_connection(str(DB_PATH))
-    init_db(conn)
-    # Seed names once if empty
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) AS cnt FROM names")
-    if cur.fetchone()["cnt"] == 0:
-        names = load_names(DB_PATH.parent / "names_1000.txt")
-        add_names(conn, names)
+    db = get_db(context)
 
     user_id = update.effective_user.id
     username = update.effective_user.username
     chat_id = update.effective_chat.id
 
-    pair, paired_now = create_or_join_pair(conn, user_id, username, chat_id)
+    # "/start <catalog>" rates another catalog; both users must name the same one
+    catalog_name = context.args[0] if context.args else DEFAULT_CATALOG
+    catalog_id = DEFAULT_CATALOG_ID
+    if catalog_name != DEFAULT_CATALOG:
+        catalog = await get_catalog(db, catalog_name)
+        if catalog is None or catalog["size"] is None:
+            available = ", ".join(f"{row['name']} ({row['size']})" for row in await list_catalogs(db))
+            reply(update, context, f"Unknown catalog {catalog_name!r}. Available: {available}.")
+            return
+        catalog_id = int(catalog["id"])
+
+    pair, paired_now = await create_or_join_pair(db, user_id, username, chat_id, context.bot_data.get(WAITING_KEY), catalog_id)
 
     if pair["user2_id"] is None:
-        await update.message.reply_text("Waiting for another user to press /start to form a pair.")
+        command = "/start" if catalog_name == DEFAULT_CATALOG else f"/start {catalog_name}"
+        reply(update, context, f"Waiting for another user to press {command} to form a pair.")
         return
 
     # Pair is complete now
-    await update.message.reply_text("Pair found! Starting round 1.")
+    outbound = get_outbound(context)
+    reply(update, context, "Pair found! Starting round 1.")
     # Notify the other user, if we know their chat_id
     other_user_id = pair["user1_id"] if pair["user2_id"] == user_id else pair["user2_id"]
-    other_chat_id = get_user_chat_id(conn, other_user_id)
+    other_chat_id = await get_user_chat_id(db, other_user_id)
     if other_chat_id:
-        await context.bot.send_message(chat_id=other_chat_id, text="Pair found! Starting round 1.")
+        outbound.send_message(other_chat_id, "Pair found! Starting round 1.", coalesce_key="pair_found")
 
-    await send_next_name(update, context, conn, pair["id"], user_id, ROUND_ONE)
+    await send_next_name(update, context, db, pair["id"], user_id, ROUND_ONE)
 
 
 def _map_answer_short(ans_short: str) -> str:
@@ -95,7 +221,9 @@ def _map_answer_short(ans_short: str) -> str:
 
 async def rate_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
-    await q.answer()
+    outbound = get_outbound(context)
+    # Stop the button spinner without waiting for Telegram
+    outbound.answer_callback_query(q.id)
     data = q.data  # r|pair|name|round|ans
     try:
         _, pair_id_s, name_id_s, round_s, ans_short = data.split("|")
@@ -104,67 +232,73 @@ async def rate_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         round_num = int(round_s)
         answer = _map_answer_short(ans_short)
     except Exception:
-        await q.edit_message_text("Invalid selection.")
+        if q.message is not None:
+            outbound.edit_message_text(q.message.chat_id, q.message.message_id, "Invalid selection.")
         return
 
-    conn = get_connection(str(DB_PATH))
-    init_db(conn)
+    db = get_db(context)
     user_id = update.effective_user.id
-    recorded = record_answer(conn, pair_id, round_num, user_id, name_id, answer)
-    if not recorded:
-        # Already answered; show the next
-        pass
-    # Send next name
-    await send_next_name(update, context, conn, pair_id, user_id, round_num)
+    # Record and fetch the next name in one DB round trip; a repeated answer
+    # is ignored and simply shows the next name
+    step = await answer_and_advance(db, pair_id, round_num, user_id, name_id, answer)
+    message_id = q.message.message_id if RATING_CARD_EDIT and q.message is not None else None
+    await send_round_step(update, context, pair_id, round_num, step, message_id)
 
 
 async def result_round1(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_connection(str(DB_PATH))
-    init_db(conn)
+    db = get_db(context)
     user_id = update.effective_user.id
-    pair = get_user_pair(conn, user_id)
+    pair = await get_user_pair(db, user_id)
     if not pair or pair["user2_id"] is None:
-        await update.message.reply_text("No active pair. Use /start with another user.")
+        reply(update, context, "No active pair. Use /start with another user.")
         return
-    matches = get_results_for_round(conn, pair["id"], ROUND_ONE)
+    matches = await get_results_for_round(db, pair["id"], ROUND_ONE)
     if not matches:
-        await update.message.reply_text("No common likes yet in round 1.")
+        reply(update, context, "No common likes yet in round 1.")
         return
-    await update.message.reply_text("Round 1 matches:\n" + "\n".join(matches))
+    reply(update, context, "Round 1 matches:\n" + "\n".join(matches))
 
 
 async def start2(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_connection(str(DB_PATH))
-    init_db(conn)
+    db = get_db(context)
     user_id = update.effective_user.id
-    pair = get_user_pair(conn, user_id)
+    pair = await get_user_pair(db, user_id)
     if not pair or pair["user2_id"] is None:
-        await update.message.reply_text("No active pair. Use /start with another user.")
+        reply(update, context, "No active pair. Use /start with another user.")
         return
-    start_second_round(conn, pair["id"])
-    await update.message.reply_text("Starting round 2 (common likes from round 1).")
+    await start_second_round(db, pair["id"])
+    outbound = get_outbound(context)
+    reply(update, context, "Starting round 2 (common likes from round 1).")
 
     other_user_id = pair["user1_id"] if pair["user2_id"] == user_id else pair["user2_id"]
-    other_chat_id = get_user_chat_id(conn, other_user_id)
+    other_chat_id = await get_user_chat_id(db, other_user_id)
     if other_chat_id:
-        await context.bot.send_message(chat_id=other_chat_id, text="Starting round 2.")
+        outbound.send_message(other_chat_id, "Starting round 2.", coalesce_key="round2")
 
-    await send_next_name(update, context, conn, pair["id"], user_id, ROUND_TWO)
+    await send_next_name(update, context, db, pair["id"], user_id, ROUND_TWO)
 
 
 async def result_round2(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_connection(str(DB_PATH))
-    init_db(conn)
+    db = get_db(context)
     user_id = update.effective_user.id
-    pair = get_user_pair(conn, user_id)
+    pair = await get_user_pair(db, user_id)
     if not pair or pair["user2_id"] is None:
-        await update.message.reply_text("No active pair. Use /start with another user.")
+        reply(update, context, "No active pair. Use /start with another user.")
         return
-    matches = get_results_for_round(conn, pair["id"], ROUND_TWO)
+    matches = await get_results_for_round(db, pair["id"], ROUND_TWO)
     if not matches:
-        await update.message.reply_text("No common likes in round 2 yet.")
+        reply(update, context, "No common likes in round 2 yet.")
         return
-    await update.message.reply_text("Round 2 matches:\n" + "\n".join(matches))
+    reply(update, context, "Round 2 matches:\n" + "\n".join(matches))
+
+
+async def migrate_ratings(db: AnyDatabase) -> None:
+    try:
+        started = time.perf_counter()
+        if await db.migrate():
+            logger.info("Ratings table converted to schema v2 in %.1fs", time.perf_counter() - started)
+    except Exception:
+        logger.exception("Ratings migration failed; the old table stays in use")
 
 
 def main():
@@ -173,24 +307,74 @@ def main():
         logger.error("TELEGRAM_BOT_TOKEN environment variable not set.")
         raise RuntimeError("TELEGRAM_BOT_TOKEN environment variable not set.")
 
-    # Ensure DB exists and seed names
-    conn = get_connection(str(DB_PATH))
-    init_db(conn)
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) AS cnt FROM names")
-    if cur.fetchone()["cnt"] == 0:
-        names = load_names(DB_PATH.parent / "names_1000.txt")
-        add_names(conn, names)
-
-    application = ApplicationBuilder().token(token).build()
-
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("result", result_round1))
-    application.add_handler(CommandHandler("start2", start2))
-    application.add_handler(CommandHandler("result2", result_round2))
-    application.add_handler(CallbackQueryHandler(rate_callback))
-
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Open the shared DB once (schema, pragmas) and seed names
+    db = create_database(str(DB_PATH))
+    conn = db.open()
+    seed_names(db)
+    # Catalogs are read-only from here on: serve them from memory
+    catalogs = load_catalogs(conn)
+    for db_conn in db.connections:
+        db_conn.name_catalogs = catalogs
+    for catalog_id, catalog in catalogs.items():
+        logger.info("Name catalog %d: %d names, %d bytes", catalog_id, len(catalog), catalog.nbytes())
+
+    async def start_outbound(app) -> None:
+        outbound = OutboundQueue(app.bot)
+        outbound.start()
+        app.bot_data[OUTBOUND_KEY] = outbound
+        if metrics.enabled:
+            reporter = MetricsReporter()
+            await reporter.start()
+            app.bot_data[METRICS_KEY] = reporter
+        # Converts an old ratings table while updates are being served
+        app.bot_data[MIGRATION_KEY] = asyncio.get_running_loop().create_task(migrate_ratings(db))
+
+    async def shutdown(app) -> None:
+        migration = app.bot_data.get(MIGRATION_KEY)
+        if migration is not None and not migration.done():
+            # Resumed (from the start) on the next run
+            migration.cancel()
+        reporter = app.bot_data.get(METRICS_KEY)
+        if reporter is not None:
+            await reporter.stop()
+            logger.info("Metrics: %s", metrics.log_line())
+        outbound = app.bot_data.get(OUTBOUND_KEY)
+        if outbound is not None:
+            await outbound.stop()
+            logger.info("Outbound queue stats: %s", outbound.stats())
+        logger.info("User cache stats: %s", db.conn.user_cache.stats())
+        logger.info("Result cache stats: %s", [db_conn.result_cache.stats() for db_conn in db.connections])
+        logger.info("Prefetch stats: %s", [db_conn.prefetch.stats() for db_conn in db.connections if db_conn.prefetch is not None])
+        db.close()
+
+    builder = ApplicationBuilder().token(token).post_init(start_outbound).post_shutdown(shutdown)
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    if BOT_MODE == "webhook":
+        builder = builder.concurrent_updates(PairOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        builder = builder.connection_pool_size(MAX_CONCURRENT_UPDATES)
+    application = builder.build()
+    application.bot_data[DB_KEY] = db
+    application.bot_data[WAITING_KEY] = WaitingQueue()
+
+    # instrument_handler returns the handler unchanged unless METRICS_ENABLED
+    application.add_handler(CommandHandler("start", instrument_handler("start", start)))
+    application.add_handler(CommandHandler("result", instrument_handler("result", result_round1)))
+    application.add_handler(CommandHandler("start2", instrument_handler("start2", start2)))
+    application.add_handler(CommandHandler("result2", instrument_handler("result2", result_round2)))
+    application.add_handler(CallbackQueryHandler(instrument_handler("rate", rate_callback)))
+
+    if BOT_MODE == "webhook":
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL or None,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
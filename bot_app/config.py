@@ -6,16 +6,79 @@ from pathlib import Path
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 # Paths
-DB_PATH = BASE_DIR / "child_names.db"
+DB_PATH = Path(os.getenv("BOT_DB_PATH", str(BASE_DIR / "child_names.db")))
 NAMES_FILE = BASE_DIR / "names_1000.txt"
 
+# Name catalogs (db.add_names): pairs rate the default one, seeded from
+# NAMES_FILE, unless /start names another
+DEFAULT_CATALOG = "default"
+DEFAULT_CATALOG_ID = 1
+# Names per transaction when importing into a catalog
+CATALOG_IMPORT_BATCH_ROWS = 10000
+
+# Group commit for SQLite writes: buffer up to this many milliseconds / changed
+# rows before committing. 0 and 0 keep the default commit per answer.
+DB_COMMIT_WINDOW_MS = int(os.getenv("DB_COMMIT_WINDOW_MS", "0"))
+DB_COMMIT_BATCH_ROWS = int(os.getenv("DB_COMMIT_BATCH_ROWS", "0"))
+# Window used when only DB_COMMIT_BATCH_ROWS is set, so buffered answers are
+# never held longer than this
+DB_COMMIT_DEFAULT_WINDOW_MS = 50
+
+# Ratings split over this many SQLite files by pair id (db.ShardedDatabase);
+# 1 keeps everything in DB_PATH. Shard files go next to DB_PATH unless
+# DB_SHARD_DIRS lists directories (comma separated) to spread them over.
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+DB_SHARD_DIRS = [d for d in os.getenv("DB_SHARD_DIRS", "").split(",") if d.strip()]
+# Old-layout ratings rows converted per transaction by db.migrate_ratings
+DB_MIGRATION_BATCH_ROWS = 5000
+
+# Users kept in the in-process LRU cache (db.UserCache)
+USER_CACHE_SIZE = 10000
+# (pair, round) match lists kept in the in-process LRU cache (db.ResultCache)
+RESULT_CACHE_SIZE = 2000
+# Upcoming names queued per (pair, user, round) so taps skip the selection
+# query (db.PrefetchQueue; 0 turns it off), for this many recent pairs
+PREFETCH_NAMES = int(os.getenv("PREFETCH_NAMES", "16"))
+PREFETCH_CACHE_PAIRS = 5000
+
 # Telegram bot token
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
+# Bot API base URL override, e.g. http://127.0.0.1:8081/bot for bench/fake_telegram.py
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "")
+
+# Serving mode: "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Webhook mode: local HTTP server and the public URL registered with Telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Updates processed at once in webhook mode; a pair's updates still run in order
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+
+# Outbound message budgets (messages per second) and stats log period in seconds
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "2"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "10"))
+OUTBOUND_STATS_INTERVAL = float(os.getenv("OUTBOUND_STATS_INTERVAL", "60"))
+# Show the next name by editing the rating card in place (0: send a new message per name)
+RATING_CARD_EDIT = os.getenv("RATING_CARD_EDIT", "1") != "0"
+
+# Instrumentation (bot_app.metrics): off by default. When on, metrics are served
+# as Prometheus text on METRICS_PORT (0: no endpoint) and logged every
+# METRICS_LOG_INTERVAL seconds (0: no log line)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") != "0"
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "60"))
 
 # Answer constants
 ANSWER_LIKE = "like"
 ANSWER_DISLIKE = "dislike"
 ANSWER_NEUTRAL = "neutral"
+# How ratings.answer stores each answer (schema v2)
+ANSWER_CODES = {ANSWER_NEUTRAL: 0, ANSWER_LIKE: 1, ANSWER_DISLIKE: 2}
 
 # Rounds
 ROUND_ONE = 1
@@ -1,14 +1,37 @@
-from typing import List, Optional, Tuple
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+import functools
 import sqlite3
+import string
 
-from .config import ANSWER_LIKE, ANSWER_DISLIKE, ANSWER_NEUTRAL, ROUND_ONE, ROUND_TWO
-from .db import ensure_user, get_pair_for_user, get_pair_by_id
+from .config import ANSWER_CODES, ANSWER_LIKE, DEFAULT_CATALOG_ID, ROUND_ONE, ROUND_TWO
+from .db import PrefetchQueue, ResultCache, ensure_user, get_pair_for_user, get_pair_by_id, stored_answer
+from .likes import add_like, common_likes
+from .matchmaking import WaitingQueue, claim_pending_pair, create_pending_pair
+from .names_loader import NameCatalog
 
 
-def create_or_join_pair(conn: sqlite3.Connection, user_id: int, username: Optional[str], chat_id: Optional[int]) -> Tuple[sqlite3.Row, bool]:
-    """Create a new pending pair or join an existing pending pair.
+class RoundStep(NamedTuple):
+    """What to show a user next: the next unrated name (None when done) and progress."""
+
+    recorded: bool
+    name_id: Optional[int]
+    name: Optional[str]
+    answered: int
+    total: int
+
+
+def create_or_join_pair(
+    conn: sqlite3.Connection,
+    user_id: int,
+    username: Optional[str],
+    chat_id: Optional[int],
+    queue: Optional[WaitingQueue] = None,
+    catalog_id: int = DEFAULT_CATALOG_ID,
+) -> Tuple[sqlite3.Row, bool]:
+    """Create a new pending pair or join an existing pending pair of the same catalog.
 
     Returns (pair_row, paired_now). paired_now=True means the pair just became complete.
+    A user already in a pair gets that pair back, whatever its catalog.
     """
     ensure_user(conn, user_id, username=username, chat_id=chat_id)
 
@@ -18,19 +41,14 @@ def create_or_join_pair(conn: sqlite3.Connection, user_id: int, username: Option
         return existing, False
 
     cur = conn.cursor()
-    # Find a pending pair waiting for a second user
-    cur.execute("SELECT * FROM pairs WHERE user2_id IS NULL ORDER BY id ASC LIMIT 1")
-    pending = cur.fetchone()
-    if pending and pending["user1_id"] != user_id:
-        cur.execute("UPDATE pairs SET user2_id=? WHERE id=?", (user_id, pending["id"]))
+    # Join the oldest pending pair atomically, if any
+    if claim_pending_pair(cur, user_id, queue, catalog_id):
         conn.commit()
-        updated = get_pair_by_id(conn, pending["id"])
-        return updated, True
+        return get_pair_for_user(conn, user_id), True
 
     # Otherwise create a new pending pair with this user as user1
-    cur.execute("INSERT INTO pairs(user1_id, current_round) VALUES (?, ?)", (user_id, ROUND_ONE))
+    new_pair_id = create_pending_pair(cur, user_id, queue, catalog_id)
     conn.commit()
-    new_pair_id = cur.lastrowid
     new_pair = get_pair_by_id(conn, new_pair_id)
     return new_pair, False
 
@@ -46,101 +64,415 @@ def get_pair_users(conn: sqlite3.Connection, pair_id: int) -> Optional[Tuple[int
     return pr["user1_id"], pr["user2_id"]
 
 
-def record_answer(conn: sqlite3.Connection, pair_id: int, round_num: int, user_id: int, name_id: int, answer: str) -> bool:
-    if answer not in (ANSWER_LIKE, ANSWER_DISLIKE, ANSWER_NEUTRAL):
-        raise ValueError("Invalid answer")
-    cur = conn.cursor()
+def _get_progress(cur: sqlite3.Cursor, pair_id: int, round_num: int, user_id: int) -> Tuple[int, Optional[int]]:
+    """Return (position, answered) for a user; answered is None when not tracked yet."""
     cur.execute(
-        "INSERT OR IGNORE INTO ratings(pair_id, round, user_id, name_id, answer) VALUES (?, ?, ?, ?, ?)",
-        (pair_id, round_num, user_id, name_id, answer),
+        "SELECT position, answered FROM progress WHERE pair_id=? AND user_id=? AND round=?",
+        (pair_id, user_id, round_num),
     )
-    conn.commit()
-    return cur.rowcount > 0
+    row = cur.fetchone()
+    if row is None:
+        return 0, None
+    return int(row["position"]), None if row["answered"] is None else int(row["answered"])
 
 
-def get_next_name_for_round(conn: sqlite3.Connection, pair_id: int, round_num: int, user_id: int) -> Optional[sqlite3.Row]:
-    cur = conn.cursor()
+def _save_progress(cur: sqlite3.Cursor, pair_id: int, round_num: int, user_id: int, position: int, answered: int) -> None:
+    cur.execute(
+        """
+        INSERT INTO progress(pair_id, user_id, round, position, answered) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(pair_id, user_id, round) DO UPDATE SET position=excluded.position, answered=excluded.answered
+        """,
+        (pair_id, user_id, round_num, position, answered),
+    )
+
+
+def _count_answers(cur: sqlite3.Cursor, pair_id: int, round_num: int, user_id: int) -> int:
+    # Only for progress rows written before the answered counter existed
+    cur.execute(
+        "SELECT COUNT(*) AS cnt FROM ratings WHERE pair_id=? AND round=? AND user_id=?",
+        (pair_id, round_num, user_id),
+    )
+    return int(cur.fetchone()["cnt"])
+
+
+def _pair_catalog_id(cur: sqlite3.Cursor, pair_id: int) -> int:
+    cur.execute("SELECT catalog_id FROM pairs WHERE id=?", (pair_id,))
+    row = cur.fetchone()
+    return DEFAULT_CATALOG_ID if row is None else int(row["catalog_id"])
+
+
+def _name_catalog(cur: sqlite3.Cursor, catalog_id: int) -> Optional[NameCatalog]:
+    """The connection's in-memory copy of a catalog; None means use SQL."""
+    catalogs = getattr(cur.connection, "name_catalogs", None)
+    return None if catalogs is None else catalogs.get(catalog_id)
+
+
+def _pair_name_catalog(cur: sqlite3.Cursor, pair_id: int) -> Optional[NameCatalog]:
+    # No pairs lookup when nothing is attached
+    if not getattr(cur.connection, "name_catalogs", None):
+        return None
+    return _name_catalog(cur, _pair_catalog_id(cur, pair_id))
+
+
+def _seek_next_names(cur: sqlite3.Cursor, pair_id: int, round_num: int, user_id: int, position: int, limit: int = 1) -> List[sqlite3.Row]:
+    """First `limit` unrated names with id >= position, in id order.
+
+    The cursor keeps this a single index seek; the NOT EXISTS probe only skips
+    names that were answered out of order.
+    """
     if round_num == ROUND_ONE:
+        # Only the pair's catalog: a seek on its catalog_names rows
         cur.execute(
             """
-            SELECT n.id, n.name FROM names n
-            WHERE n.id NOT IN (
-                SELECT name_id FROM ratings WHERE pair_id=? AND round=? AND user_id=?
+            SELECT n.id, n.name
+            FROM catalog_names c
+            JOIN names n ON n.id = c.name_id
+            WHERE c.catalog_id = ? AND c.name_id >= ? AND NOT EXISTS (
+                SELECT 1 FROM ratings r
+                WHERE r.pair_id=? AND r.round=? AND r.user_id=? AND r.name_id=c.name_id
             )
-            ORDER BY n.id ASC
-            LIMIT 1
+            ORDER BY c.name_id ASC
+            LIMIT ?
             """,
-            (pair_id, ROUND_ONE, user_id),
+            (_pair_catalog_id(cur, pair_id), position, pair_id, ROUND_ONE, user_id, limit),
         )
-        return cur.fetchone()
+        return cur.fetchall()
 
-    # Round two: only names liked by both users in round 1
+    # Round two: names frozen into round2_candidates by start_second_round
     cur.execute(
         """
-        SELECT DISTINCT n.id, n.name
-        FROM names n
-        JOIN ratings r1 ON r1.name_id = n.id AND r1.pair_id = ? AND r1.round = 1 AND r1.answer = 'like'
-        JOIN ratings r2 ON r2.name_id = n.id AND r2.pair_id = ? AND r2.round = 1 AND r2.answer = 'like'
-        WHERE n.id NOT IN (
-            SELECT name_id FROM ratings WHERE pair_id = ? AND round = 2 AND user_id = ?
+        SELECT n.id, n.name
+        FROM round2_candidates c
+        JOIN names n ON n.id = c.name_id
+        WHERE c.pair_id = ? AND c.name_id >= ? AND NOT EXISTS (
+            SELECT 1 FROM ratings r
+            WHERE r.pair_id = ? AND r.round = 2 AND r.user_id = ? AND r.name_id = c.name_id
         )
-        ORDER BY n.id ASC
-        LIMIT 1
+        ORDER BY c.name_id ASC
+        LIMIT ?
         """,
-        (pair_id, pair_id, pair_id, user_id),
+        (pair_id, position, pair_id, user_id, limit),
+    )
+    return cur.fetchall()
+
+
+def _next_names(cur: sqlite3.Cursor, pair_id: int, round_num: int, user_id: int, position: int, limit: int = 1) -> List[Tuple[int, str]]:
+    """(id, name) of the next `limit` unrated names, resolving names from the
+    connection's copy of the pair's catalog when one is attached so selection
+    only touches ratings."""
+    catalog = _pair_name_catalog(cur, pair_id)
+    if catalog is None:
+        return [(int(row["id"]), row["name"]) for row in _seek_next_names(cur, pair_id, round_num, user_id, position, limit)]
+
+    names: List[Tuple[int, str]] = []
+    if round_num == ROUND_ONE:
+        for name_id in catalog.ids_from(position):
+            cur.execute(
+                "SELECT 1 FROM ratings WHERE pair_id=? AND round=? AND user_id=? AND name_id=?",
+                (pair_id, ROUND_ONE, user_id, name_id),
+            )
+            if cur.fetchone() is None:
+                names.append((name_id, catalog.name(name_id)))
+                if len(names) == limit:
+                    break
+        return names
+
+    while len(names) < limit:
+        cur.execute(
+            """
+            SELECT c.name_id
+            FROM round2_candidates c
+            WHERE c.pair_id = ? AND c.name_id >= ? AND NOT EXISTS (
+                SELECT 1 FROM ratings r
+                WHERE r.pair_id = ? AND r.round = 2 AND r.user_id = ? AND r.name_id = c.name_id
+            )
+            ORDER BY c.name_id ASC
+            LIMIT ?
+            """,
+            (pair_id, position, pair_id, user_id, limit - len(names)),
+        )
+        name_ids = [int(row["name_id"]) for row in cur.fetchall()]
+        if not name_ids:
+            break
+        # Candidates dropped from the catalog since the snapshot (db.sync_names) are skipped
+        names.extend((name_id, name) for name_id, name in zip(name_ids, map(catalog.name, name_ids)) if name is not None)
+        position = name_ids[-1] + 1
+    return names
+
+
+def _next_name(cur: sqlite3.Cursor, pair_id: int, round_num: int, user_id: int, position: int) -> Optional[Tuple[int, str]]:
+    """(id, name) of the next unrated name: the head of the user's prefetch
+    queue when there is one, else a fresh selection (which then schedules a
+    refill of the queue)."""
+    prefetch: Optional[PrefetchQueue] = getattr(cur.connection, "prefetch", None)
+    if prefetch is not None:
+        queue = prefetch.head(pair_id, user_id, round_num)
+        if queue:
+            if len(queue) <= prefetch.low_water:
+                _request_refill(cur.connection, prefetch, pair_id, round_num, user_id)
+            return queue[0]
+    names = _next_names(cur, pair_id, round_num, user_id, position)
+    if prefetch is not None and names:
+        _request_refill(cur.connection, prefetch, pair_id, round_num, user_id)
+    return names[0] if names else None
+
+
+def _request_refill(conn: sqlite3.Connection, prefetch: "PrefetchQueue", pair_id: int, round_num: int, user_id: int) -> None:
+    prefetch.request_refill(pair_id, user_id, round_num, functools.partial(_refill_prefetch, conn, pair_id, round_num, user_id))
+
+
+def _refill_prefetch(conn: sqlite3.Connection, pair_id: int, round_num: int, user_id: int) -> None:
+    """Top the user's prefetch queue up to its size: names after the last one
+    queued, or from the progress cursor when the queue is empty. Runs on the
+    DB thread between handler calls (see Database.run)."""
+    prefetch: PrefetchQueue = conn.prefetch
+    cur = conn.cursor()
+    queue = prefetch.get(pair_id, user_id, round_num)
+    if queue:
+        start = queue[-1][0] + 1
+    else:
+        start, _ = _get_progress(cur, pair_id, round_num, user_id)
+    wanted = prefetch.size - len(queue or ())
+    names = _next_names(cur, pair_id, round_num, user_id, start, wanted)
+    prefetch.extend(pair_id, user_id, round_num, names, exhausted=len(names) < wanted)
+
+
+def _advance_prefetch(cur: sqlite3.Cursor, pair_id: int, round_num: int, user_id: int, name_id: int, recorded: bool) -> None:
+    """Keep the user's prefetch queue equal to their next unrated names after an answer."""
+    prefetch: Optional[PrefetchQueue] = getattr(cur.connection, "prefetch", None)
+    if prefetch is None:
+        return
+    queue = prefetch.get(pair_id, user_id, round_num)
+    if not queue:
+        return
+    if not recorded:
+        # Already rated: if it is queued the queue is wrong, so start over
+        if any(queued_id == name_id for queued_id, _ in queue):
+            prefetch.invalidate(pair_id)
+        return
+    if queue[0][0] == name_id:
+        queue.popleft()
+    else:
+        # Answered out of order, e.g. from an older card
+        for i, (queued_id, _) in enumerate(queue):
+            if queued_id == name_id:
+                del queue[i]
+                break
+
+
+def _record_answer(cur: sqlite3.Cursor, pair_id: int, round_num: int, user_id: int, name_id: int, answer: str) -> Tuple[bool, Optional[Tuple[int, str]], int]:
+    """Insert an answer and update the user's progress row without committing.
+
+    Returns (recorded, next_name, answered). Everything between the old position
+    and the next unrated name is rated, so the cursor can jump straight to it.
+    """
+    if answer not in ANSWER_CODES:
+        raise ValueError("Invalid answer")
+    cur.execute(
+        "INSERT OR IGNORE INTO ratings(pair_id, user_id, round, name_id, answer) VALUES (?, ?, ?, ?, ?)",
+        (pair_id, user_id, round_num, name_id, stored_answer(cur.connection, answer)),
     )
-    return cur.fetchone()
+    recorded = cur.rowcount > 0
+    if recorded and answer == ANSWER_LIKE:
+        add_like(cur, pair_id, round_num, user_id, name_id)
+        _update_cached_results(cur, pair_id, round_num, user_id, name_id)
+    position, answered = _get_progress(cur, pair_id, round_num, user_id)
+    changed = recorded
+    if answered is None:
+        # Counted once (including this answer), then maintained incrementally
+        answered = _count_answers(cur, pair_id, round_num, user_id)
+        changed = True
+    elif recorded:
+        answered += 1
+    _advance_prefetch(cur, pair_id, round_num, user_id, name_id, recorded)
+    nxt = _next_name(cur, pair_id, round_num, user_id, position)
+    new_position = nxt[0] if nxt is not None else max(position, name_id + 1)
+    if changed or new_position != position:
+        _save_progress(cur, pair_id, round_num, user_id, new_position, answered)
+    return recorded, nxt, answered
+
+
+def record_answer(conn: sqlite3.Connection, pair_id: int, round_num: int, user_id: int, name_id: int, answer: str) -> bool:
+    cur = conn.cursor()
+    recorded, _, _ = _record_answer(cur, pair_id, round_num, user_id, name_id, answer)
+    conn.commit()
+    return recorded
+
+
+def answer_and_advance(conn: sqlite3.Connection, pair_id: int, round_num: int, user_id: int, name_id: int, answer: str) -> RoundStep:
+    """Record an answer, pick the next name and read progress in one transaction."""
+    cur = conn.cursor()
+    recorded, nxt, answered = _record_answer(cur, pair_id, round_num, user_id, name_id, answer)
+    total = _get_round_total(cur, pair_id, round_num)
+    conn.commit()
+    return _round_step(recorded, nxt, answered, total)
+
+
+def get_next_name_for_round(conn: sqlite3.Connection, pair_id: int, round_num: int, user_id: int) -> Optional[sqlite3.Row]:
+    cur = conn.cursor()
+    position, _ = _get_progress(cur, pair_id, round_num, user_id)
+    rows = _seek_next_names(cur, pair_id, round_num, user_id, position)
+    return rows[0] if rows else None
+
+
+def get_round_step(conn: sqlite3.Connection, pair_id: int, round_num: int, user_id: int) -> RoundStep:
+    """Next name plus progress for a user, without recording anything."""
+    cur = conn.cursor()
+    position, answered = _get_progress(cur, pair_id, round_num, user_id)
+    nxt = _next_name(cur, pair_id, round_num, user_id, position)
+    if answered is None:
+        answered = _count_answers(cur, pair_id, round_num, user_id)
+    total = _get_round_total(cur, pair_id, round_num)
+    return _round_step(False, nxt, answered, total)
+
+
+def _round_step(recorded: bool, nxt: Optional[Tuple[int, str]], answered: int, total: int) -> RoundStep:
+    if nxt is None:
+        return RoundStep(recorded, None, None, answered, total)
+    return RoundStep(recorded, nxt[0], nxt[1], answered, total)
+
+
+# SQLite's NOCASE collation: only ASCII letters are folded
+_NOCASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def _names_for_ids(cur: sqlite3.Cursor, name_ids: Sequence[int], catalog_id: int) -> List[str]:
+    # Ids no longer in the catalog (db.sync_names) are skipped, by both the
+    # in-memory copy and the SQL lookup
+    catalog = _name_catalog(cur, catalog_id)
+    if catalog is not None:
+        return [name for name in map(catalog.name, name_ids) if name is not None]
+    names: List[str] = []
+    for start in range(0, len(name_ids), 500):
+        batch = name_ids[start:start + 500]
+        cur.execute(
+            f"""
+            SELECT n.name FROM catalog_names c JOIN names n ON n.id = c.name_id
+            WHERE c.catalog_id = ? AND c.name_id IN ({','.join('?' * len(batch))})
+            """,
+            (catalog_id, *batch),
+        )
+        names.extend(row["name"] for row in cur.fetchall())
+    return names
+
+
+def _catalog_members(cur: sqlite3.Cursor, catalog_id: int, name_ids: Sequence[int]) -> List[int]:
+    """Those of name_ids that are still in the catalog, in order."""
+    catalog = _name_catalog(cur, catalog_id)
+    if catalog is not None:
+        return [name_id for name_id in name_ids if catalog.name(name_id) is not None]
+    members = set()
+    for start in range(0, len(name_ids), 500):
+        batch = name_ids[start:start + 500]
+        cur.execute(
+            f"SELECT name_id FROM catalog_names WHERE catalog_id=? AND name_id IN ({','.join('?' * len(batch))})",
+            (catalog_id, *batch),
+        )
+        members.update(row["name_id"] for row in cur.fetchall())
+    return [name_id for name_id in name_ids if name_id in members]
+
+
+def _result_key(name: str) -> Tuple[str, str]:
+    return name.translate(_NOCASE), name
 
 
 def get_results_for_round(conn: sqlite3.Connection, pair_id: int, round_num: int) -> List[str]:
+    """Names both users of the pair liked in the round, sorted case-insensitively.
+
+    An AND of the two users' like bitmaps, so the cost follows the number of
+    likes rather than the size of the ratings table. Served from the
+    connection's ResultCache when one is attached.
+    """
+    cache: Optional[ResultCache] = getattr(conn, "result_cache", None)
+    if cache is not None:
+        cached = cache.get(pair_id, round_num)
+        if cached is not None:
+            return cached
     cur = conn.cursor()
-    # Restrict to likes from user1 and user2 specifically to avoid duplicates
+    pair = get_pair_by_id(conn, pair_id)
+    if pair is None or pair["user2_id"] is None:
+        return []
+    name_ids = common_likes(cur, pair_id, round_num, pair["user1_id"], pair["user2_id"])
+    names = sorted(_names_for_ids(cur, name_ids, pair["catalog_id"]), key=_result_key)
+    if cache is not None:
+        cache.put(pair_id, round_num, names)
+    return names
+
+
+def _update_cached_results(cur: sqlite3.Cursor, pair_id: int, round_num: int, user_id: int, name_id: int) -> None:
+    """After a new like: add the name to the pair's cached results if the partner liked it too."""
+    cache: Optional[ResultCache] = getattr(cur.connection, "result_cache", None)
+    if cache is None or (pair_id, round_num) not in cache:
+        return
+    pair = get_pair_by_id(cur.connection, pair_id)
+    partner_id = pair["user2_id"] if pair["user1_id"] == user_id else pair["user1_id"]
     cur.execute(
-        """
-        SELECT DISTINCT n.name
-        FROM names n
-        JOIN ratings r1 ON r1.name_id = n.id AND r1.pair_id = ? AND r1.round = ? AND r1.answer = 'like' AND r1.user_id = (SELECT user1_id FROM pairs WHERE id = ?)
-        JOIN ratings r2 ON r2.name_id = n.id AND r2.pair_id = ? AND r2.round = ? AND r2.answer = 'like' AND r2.user_id = (SELECT user2_id FROM pairs WHERE id = ?)
-        ORDER BY n.name COLLATE NOCASE ASC
-        """,
-        (pair_id, round_num, pair_id, pair_id, round_num, pair_id),
+        "SELECT 1 FROM ratings WHERE pair_id=? AND round=? AND user_id=? AND name_id=? AND answer=?",
+        (pair_id, round_num, partner_id, name_id, stored_answer(cur.connection, ANSWER_LIKE)),
     )
-    return [row["name"] for row in cur.fetchall()]
+    if cur.fetchone() is not None:
+        for name in _names_for_ids(cur, [name_id], pair["catalog_id"]):
+            cache.add(pair_id, round_num, name, _result_key)
 
 
 def get_round_progress(conn: sqlite3.Connection, pair_id: int, round_num: int, user_id: int) -> Tuple[int, int]:
     """Return (answered_count, total_count) for the given pair/user/round.
 
-    - Round 1 total is count of all names.
-    - Round 2 total is count of names liked by both users in round 1.
+    - Round 1 total is the size of the pair's catalog.
+    - Round 2 total is the size of the snapshot frozen by start_second_round.
     """
     cur = conn.cursor()
-    cur.execute(
-        "SELECT COUNT(*) AS cnt FROM ratings WHERE pair_id=? AND round=? AND user_id=?",
-        (pair_id, round_num, user_id),
-    )
-    answered = int(cur.fetchone()["cnt"])
+    return _get_round_progress(cur, pair_id, round_num, user_id)
+
+
+def _get_round_progress(cur: sqlite3.Cursor, pair_id: int, round_num: int, user_id: int) -> Tuple[int, int]:
+    _, answered = _get_progress(cur, pair_id, round_num, user_id)
+    if answered is None:
+        answered = _count_answers(cur, pair_id, round_num, user_id)
+    return answered, _get_round_total(cur, pair_id, round_num)
+
 
+def _get_round_total(cur: sqlite3.Cursor, pair_id: int, round_num: int) -> int:
     if round_num == ROUND_ONE:
-        cur.execute("SELECT COUNT(*) AS cnt FROM names")
-        total = int(cur.fetchone()["cnt"])
-        return answered, total
+        # Kept by db.add_names/sync_names
+        cur.execute("SELECT c.size FROM pairs p JOIN catalogs c ON c.id = p.catalog_id WHERE p.id=?", (pair_id,))
+        row = cur.fetchone()
+        return 0 if row is None or row["size"] is None else int(row["size"])
 
-    # Round two total: names liked by both user1 and user2 in round 1
-    cur.execute(
-        """
-        SELECT COUNT(DISTINCT n.id) AS cnt
-        FROM names n
-        JOIN ratings r1 ON r1.name_id = n.id AND r1.pair_id = ? AND r1.round = 1 AND r1.answer = 'like' AND r1.user_id = (SELECT user1_id FROM pairs WHERE id = ?)
-        JOIN ratings r2 ON r2.name_id = n.id AND r2.pair_id = ? AND r2.round = 1 AND r2.answer = 'like' AND r2.user_id = (SELECT user2_id FROM pairs WHERE id = ?)
-        """,
-        (pair_id, pair_id, pair_id, pair_id),
-    )
-    total = int(cur.fetchone()["cnt"])
-    return answered, total
+    # Round two total: size of the snapshot taken by start_second_round
+    cur.execute("SELECT round2_total FROM pair_state WHERE pair_id=?", (pair_id,))
+    row = cur.fetchone()
+    return 0 if row is None or row["round2_total"] is None else int(row["round2_total"])
 
 
 def start_second_round(conn: sqlite3.Connection, pair_id: int) -> None:
+    """Switch the pair to round 2, freezing its candidates on the first call.
+
+    The candidates are the names both users liked in round 1 at that moment;
+    later round 1 answers don't change an already started round 2. The
+    snapshot and its size (pair_state) are committed first, in the file that
+    holds the pair's ratings; a crash before the pairs update only leaves the
+    pair in round 1, and the next call finishes the switch.
+    """
     cur = conn.cursor()
+    cur.execute("SELECT * FROM pairs WHERE id=?", (pair_id,))
+    pair = cur.fetchone()
+    if pair is None:
+        return
+    cur.execute("SELECT 1 FROM pair_state WHERE pair_id=?", (pair_id,))
+    if cur.fetchone() is None:
+        name_ids = [] if pair["user2_id"] is None else common_likes(cur, pair_id, ROUND_ONE, pair["user1_id"], pair["user2_id"])
+        # Likes of names removed from the catalog since (db.sync_names) don't count
+        name_ids = _catalog_members(cur, int(pair["catalog_id"]), name_ids)
+        cur.executemany(
+            "INSERT OR IGNORE INTO round2_candidates(pair_id, name_id) VALUES (?, ?)",
+            [(pair_id, name_id) for name_id in name_ids],
+        )
+        cur.execute("INSERT INTO pair_state(pair_id, round2_total) VALUES (?, ?)", (pair_id, len(name_ids)))
+        conn.commit()
     cur.execute("UPDATE pairs SET current_round=?, started_2=1 WHERE id=?", (ROUND_TWO, pair_id))
-    conn.commit()
\ No newline at end of file
+    conn.commit()
+    prefetch: Optional[PrefetchQueue] = getattr(conn, "prefetch", None)
+    if prefetch is not None:
+        # Round change: queues are rebuilt from the progress cursors on demand
+        prefetch.invalidate(pair_id)
@@ -1,17 +1,548 @@
+import asyncio
+import functools
+import logging
 import sqlite3
-from typing import Iterable, Optional
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypeVar, Union
 
-from .config import ANSWER_LIKE, ANSWER_DISLIKE, ANSWER_NEUTRAL
+from .config import (
+    ANSWER_CODES,
+    ANSWER_LIKE,
+    CATALOG_IMPORT_BATCH_ROWS,
+    DEFAULT_CATALOG,
+    DEFAULT_CATALOG_ID,
+    DB_COMMIT_DEFAULT_WINDOW_MS,
+    DB_COMMIT_WINDOW_MS,
+    DB_COMMIT_BATCH_ROWS,
+    DB_MIGRATION_BATCH_ROWS,
+    DB_SHARDS,
+    DB_SHARD_DIRS,
+    PREFETCH_CACHE_PAIRS,
+    PREFETCH_NAMES,
+    ROUND_ONE,
+    USER_CACHE_SIZE,
+    RESULT_CACHE_SIZE,
+)
+from .likes import rebuild_like_bitmaps
+from .metrics import metrics
+from .names_loader import NameCatalog
 
 
-def get_connection(db_path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
+# Applied once to every long-lived connection (see Database.open)
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# init_db schemas: everything in one file, or the shared part and a per-pair
+# shard of it (see ShardedDatabase)
+SCHEMA_FULL = "full"
+SCHEMA_COMMON = "common"
+SCHEMA_SHARD = "shard"
+
+# PRAGMA user_version of a file whose ratings table has the current layout:
+# 2 = integer answer codes, clustered on (pair_id, user_id, round, name_id).
+# Files with an older ratings table are converted by migrate_ratings.
+SCHEMA_VERSION = 2
+
+RATINGS_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        pair_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        round INTEGER NOT NULL,
+        name_id INTEGER NOT NULL,
+        answer INTEGER NOT NULL CHECK (answer IN (%s)),
+        PRIMARY KEY (pair_id, user_id, round, name_id)
+    ) WITHOUT ROWID;
+""" % ", ".join(str(code) for code in sorted(ANSWER_CODES.values()))
+
+
+class UserCache:
+    """Bounded LRU of users rows: user_id -> (username, chat_id).
+
+    Write-through: ensure_user updates it after writing, so a hit always matches
+    the table and unchanged users need no write at all.
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._users: "OrderedDict[int, Tuple[Optional[str], Optional[int]]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def get(self, user_id: int) -> Optional[Tuple[Optional[str], Optional[int]]]:
+        user = self._users.get(user_id)
+        if user is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._users.move_to_end(user_id)
+        return user
+
+    def put(self, user_id: int, username: Optional[str], chat_id: Optional[int]) -> None:
+        self._users[user_id] = (username, chat_id)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_size:
+            self._users.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._users), "hits": self.hits, "misses": self.misses}
+
+
+class ResultCache:
+    """Bounded LRU of match lists: (pair_id, round) -> names both users liked.
+
+    core.get_results_for_round fills it and core's answer recording keeps
+    cached lists current, so a repeated request for the same results needs no
+    query at all.
+    """
+
+    def __init__(self, max_size: int = RESULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._results: "OrderedDict[Tuple[int, int], List[str]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        return key in self._results
+
+    def get(self, pair_id: int, round_num: int) -> Optional[List[str]]:
+        names = self._results.get((pair_id, round_num))
+        if names is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._results.move_to_end((pair_id, round_num))
+        return list(names)
+
+    def put(self, pair_id: int, round_num: int, names: List[str]) -> None:
+        self._results[(pair_id, round_num)] = list(names)
+        self._results.move_to_end((pair_id, round_num))
+        while len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+
+    def add(self, pair_id: int, round_num: int, name: str, key: Callable[[str], Any]) -> None:
+        """Add a new match to a cached list, keeping it sorted by key."""
+        names = self._results.get((pair_id, round_num))
+        if names is not None:
+            names.append(name)
+            names.sort(key=key)
+
+    def invalidate(self, pair_id: int, round_num: int) -> None:
+        self._results.pop((pair_id, round_num), None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._results), "hits": self.hits, "misses": self.misses}
+
+
+class _NameQueue(deque):
+    # No refill is worth asking for once a fill came back short
+    exhausted = False
+
+
+class PrefetchQueue:
+    """Bounded LRU, by pair, of each user's upcoming names per round: the next
+    `size` unrated (name_id, name) pairs in id order, so most taps are served
+    without a selection query.
+
+    core keeps every queue equal to what a selection would return: answers
+    pop or remove their name, a repeated answer for a queued name drops the
+    pair's queues and so does a round change. Refills are queued as callables
+    by core and run by run_pending(), which Database.run schedules on the DB
+    thread after the call that asked for them, so the tap that empties a
+    queue's lower half doesn't wait for the refill. An empty queue just means
+    a live selection. Use it from the DB thread only.
+    """
+
+    def __init__(self, size: int = PREFETCH_NAMES, max_pairs: int = PREFETCH_CACHE_PAIRS):
+        self.size = size
+        # Refill once a queue is down to this many names
+        self.low_water = size // 2
+        self.max_pairs = max_pairs
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self._pairs: "OrderedDict[int, Dict[Tuple[int, int], _NameQueue]]" = OrderedDict()
+        self._pending: "OrderedDict[Tuple[int, int, int], Callable[[], None]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._pairs)
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._pending)
+
+    def get(self, pair_id: int, user_id: int, round_num: int) -> Optional[Deque[Tuple[int, str]]]:
+        queues = self._pairs.get(pair_id)
+        if queues is None:
+            return None
+        self._pairs.move_to_end(pair_id)
+        return queues.get((user_id, round_num))
+
+    def head(self, pair_id: int, user_id: int, round_num: int) -> Optional[Deque[Tuple[int, str]]]:
+        """get() for serving a name: counts a hit when the queue has one."""
+        queue = self.get(pair_id, user_id, round_num)
+        if queue:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return queue
+
+    def extend(self, pair_id: int, user_id: int, round_num: int, names: Iterable[Tuple[int, str]], exhausted: bool) -> None:
+        queues = self._pairs.setdefault(pair_id, {})
+        self._pairs.move_to_end(pair_id)
+        queue = queues.setdefault((user_id, round_num), _NameQueue())
+        queue.extend(names)
+        queue.exhausted = exhausted
+        while len(self._pairs) > self.max_pairs:
+            evicted, _ = self._pairs.popitem(last=False)
+            self._drop_pending(evicted)
+
+    def request_refill(self, pair_id: int, user_id: int, round_num: int, refill: Callable[[], None]) -> None:
+        queue = self.get(pair_id, user_id, round_num)
+        if queue is not None and queue.exhausted and queue:
+            return
+        self._pending.setdefault((pair_id, user_id, round_num), refill)
+
+    def run_pending(self) -> None:
+        while self._pending:
+            _, refill = self._pending.popitem(last=False)
+            self.refills += 1
+            try:
+                refill()
+            except Exception:
+                # A failed refill only costs the live selection it would have saved
+                logger.exception("Prefetch refill failed")
+
+    def invalidate(self, pair_id: int) -> None:
+        self._pairs.pop(pair_id, None)
+        self._drop_pending(pair_id)
+
+    def _drop_pending(self, pair_id: int) -> None:
+        for key in [key for key in self._pending if key[0] == pair_id]:
+            del self._pending[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {"pairs": len(self._pairs), "hits": self.hits, "misses": self.misses, "refills": self.refills}
+
+
+class GroupCommitConnection(sqlite3.Connection):
+    """Connection that can defer commit() to group several writes into one fsync.
+
+    With commit_window_ms and commit_rows both 0 (the default) commit() is the
+    usual per-call commit. Otherwise the transaction stays open until it holds
+    commit_rows changed rows or commit_window_ms has passed since its first
+    deferred commit; flush() commits unconditionally. Reads through this same
+    connection already see the buffered writes.
+    """
+
+    commit_window_ms: int = 0
+    commit_rows: int = 0
+    # Set by Database.open; plain connections run without a user cache
+    user_cache: Optional[UserCache] = None
+    result_cache: Optional[ResultCache] = None
+    # Set by the bot after seeding: catalog id -> NameCatalog (see names_loader.load_catalogs)
+    name_catalogs: Optional[Dict[int, NameCatalog]] = None
+    prefetch: Optional[PrefetchQueue] = None
+    # Set by init_db while ratings still has the old layout (see migrate_ratings)
+    legacy_ratings: bool = False
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._flushed_changes = 0
+        self._pending_since: Optional[float] = None
+
+    @property
+    def write_behind(self) -> bool:
+        return self.commit_window_ms > 0 or self.commit_rows > 0
+
+    @property
+    def has_pending_writes(self) -> bool:
+        return self.in_transaction and self._pending_since is not None
+
+    def commit(self) -> None:
+        if not self.write_behind or not self.in_transaction:
+            self.flush()
+            return
+        now = time.monotonic()
+        if self._pending_since is None:
+            self._pending_since = now
+        pending_rows = self.total_changes - self._flushed_changes
+        if self.commit_rows and pending_rows >= self.commit_rows:
+            self.flush()
+        elif self.commit_window_ms and (now - self._pending_since) * 1000 >= self.commit_window_ms:
+            self.flush()
+
+    def flush(self) -> None:
+        had_transaction = self.in_transaction
+        super().commit()
+        if metrics.enabled and had_transaction:
+            metrics.inc("db_commits_total")
+            metrics.inc("db_rows_written_total", self.total_changes - self._flushed_changes)
+        self._flushed_changes = self.total_changes
+        self._pending_since = None
+
+
+def get_connection(db_path: str, check_same_thread: bool = True, factory: type = sqlite3.Connection) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, check_same_thread=check_same_thread, factory=factory)
     conn.row_factory = sqlite3.Row
     return conn
 
 
-def init_db(conn: sqlite3.Connection) -> None:
+def configure_connection(conn: sqlite3.Connection) -> None:
     cur = conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cur.execute(pragma)
+
+
+class Database:
+    """Long-lived SQLite connection owned by the bot application.
+
+    Schema setup and pragmas run once in open(); handlers reuse the same connection.
+    After open() the connection belongs to a single DB thread: async code goes
+    through run() so that slow statements and commits never block the event loop.
+
+    commit_window_ms/commit_rows enable group commit (see GroupCommitConnection);
+    run() schedules a flush once the window elapses and close() flushes whatever
+    is still buffered. A row limit alone gets DB_COMMIT_DEFAULT_WINDOW_MS as its
+    window, so a quiet period never leaves answers uncommitted.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        commit_window_ms: int = DB_COMMIT_WINDOW_MS,
+        commit_rows: int = DB_COMMIT_BATCH_ROWS,
+        schema: str = SCHEMA_FULL,
+        attach: Optional[str] = None,
+    ):
+        self.db_path = db_path
+        if commit_rows and not commit_window_ms:
+            commit_window_ms = DB_COMMIT_DEFAULT_WINDOW_MS
+        self.commit_window_ms = commit_window_ms
+        self.commit_rows = commit_rows
+        self.schema = schema
+        # Common file to ATTACH as "common" (shards of a ShardedDatabase)
+        self.attach = attach
+        self._conn: Optional[GroupCommitConnection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def open(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # Opened here, used from the DB thread afterwards
+            conn = get_connection(self.db_path, check_same_thread=False, factory=GroupCommitConnection)
+            if self.attach is not None:
+                # Unqualified names/users/pairs/catalogs resolve to the common file
+                conn.execute("ATTACH DATABASE ? AS common", (self.attach,))
+            configure_connection(conn)
+            # An old ratings table is converted in the background (migrate())
+            init_db(conn, self.schema, migrate=False)
+            conn.commit_window_ms = self.commit_window_ms
+            conn.commit_rows = self.commit_rows
+            conn.user_cache = UserCache()
+            conn.result_cache = ResultCache()
+            if PREFETCH_NAMES:
+                conn.prefetch = PrefetchQueue()
+            if metrics.enabled:
+                conn.set_trace_callback(metrics.count_statement)
+            self._conn = conn
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        return self._conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            raise RuntimeError("Database is not open")
+        return self._conn
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        """Await fn(conn, *args) executed on the DB thread."""
+        conn = self.conn
+        loop = asyncio.get_running_loop()
+        if metrics.enabled:
+            call = functools.partial(metrics.db_call, fn, conn, *args)
+        else:
+            call = functools.partial(fn, conn, *args)
+        result = await loop.run_in_executor(self._executor, call)
+        if conn.prefetch is not None and conn.prefetch.pending:
+            # Behind the calls already queued: refills never delay a reply
+            self._executor.submit(conn.prefetch.run_pending)
+        if self.commit_window_ms and self._flush_handle is None and conn.has_pending_writes:
+            self._flush_handle = loop.call_later(self.commit_window_ms / 1000, self._flush_later)
+        return result
+
+    async def run_for_pair(self, pair_id: int, fn: Callable[..., T], *args: Any) -> T:
+        """run() for a call that touches one pair's ratings; see ShardedDatabase."""
+        return await self.run(fn, *args)
+
+    async def migrate(self, batch_rows: int = DB_MIGRATION_BATCH_ROWS) -> bool:
+        """Convert an old-layout ratings table left by open(), one batch per DB
+        call so that handlers' calls run in between. Returns True if there was
+        anything to convert."""
+        after_id = await self.run(migrate_ratings, 0, batch_rows)
+        if after_id is None:
+            return False
+        while after_id is not None:
+            after_id = await self.run(migrate_ratings, after_id, batch_rows)
+        return True
+
+    @property
+    def connections(self) -> List[sqlite3.Connection]:
+        return [self.conn]
+
+    def _flush_later(self) -> None:
+        self._flush_handle = None
+        if self._executor is not None and self._conn is not None:
+            self._executor.submit(self._conn.flush)
+
+    def close(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._executor is not None:
+            # Let queued DB work finish before the connection goes away
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._conn is not None:
+            # Write-behind mode: persist buffered answers before closing
+            self._conn.flush()
+            self._conn.close()
+            self._conn = None
+
+
+def shard_index(pair_id: int, shards: int) -> int:
+    """Shard holding a pair's ratings. Pair ids are sequential, so a modulo
+    spreads both the pairs and their activity evenly."""
+    return pair_id % shards
+
+
+def shard_paths(db_path: str, shards: int, dirs: Sequence[str] = ()) -> List[str]:
+    """File of each shard: <stem>.shard<i><suffix>, next to db_path or spread
+    round-robin over dirs (e.g. one per disk)."""
+    path = Path(db_path)
+    return [
+        str((Path(dirs[i % len(dirs)]) if dirs else path.parent) / f"{path.stem}.shard{i}{path.suffix}")
+        for i in range(shards)
+    ]
+
+
+class ShardedDatabase:
+    """Ratings and per-pair state split over several SQLite files by pair_id.
+
+    names, users, pairs and catalogs live in a common file served by its own
+    Database; each shard file holds ratings, progress, round2_candidates,
+    pair_state and like_bitmaps for the pairs that map to it (shard_index) and ATTACHes the
+    common file, so core functions run unchanged on a shard connection. Every
+    file has its own connection and DB thread: writes to different shards
+    commit in parallel instead of queueing behind one writer.
+
+    run() goes to the common file, run_for_pair() to the pair's shard. All
+    connections commit per call: a transaction left open by group commit would
+    keep reading an old snapshot of the common file (missing newer pairs) and
+    could not write to it.
+    """
+
+    def __init__(self, db_path: str, shards: int, shard_dirs: Sequence[str] = ()):
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        self.db_path = db_path
+        self.common = Database(db_path, 0, 0, schema=SCHEMA_COMMON)
+        self.shards = [
+            Database(path, 0, 0, schema=SCHEMA_SHARD, attach=db_path)
+            for path in shard_paths(db_path, shards, shard_dirs)
+        ]
+
+    def open(self) -> sqlite3.Connection:
+        # Common first: the shards attach it
+        conn = self.common.open()
+        for shard in self.shards:
+            shard.open()
+        return conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """The common connection (names, users, pairs)."""
+        return self.common.conn
+
+    @property
+    def connections(self) -> List[sqlite3.Connection]:
+        return [self.common.conn] + [shard.conn for shard in self.shards]
+
+    def shard_for(self, pair_id: int) -> Database:
+        return self.shards[shard_index(pair_id, len(self.shards))]
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        return await self.common.run(fn, *args)
+
+    async def run_for_pair(self, pair_id: int, fn: Callable[..., T], *args: Any) -> T:
+        return await self.shard_for(pair_id).run(fn, *args)
+
+    async def migrate(self, batch_rows: int = DB_MIGRATION_BATCH_ROWS) -> bool:
+        migrated = await self.common.migrate(batch_rows)
+        for shard in self.shards:
+            migrated = await shard.migrate(batch_rows) or migrated
+        return migrated
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.close()
+        self.common.close()
+
+
+# Either kind: both offer open/close/conn/connections/run/run_for_pair
+AnyDatabase = Union[Database, ShardedDatabase]
+
+
+def create_database(
+    db_path: str,
+    shards: int = DB_SHARDS,
+    shard_dirs: Sequence[str] = DB_SHARD_DIRS,
+    commit_window_ms: int = DB_COMMIT_WINDOW_MS,
+    commit_rows: int = DB_COMMIT_BATCH_ROWS,
+) -> AnyDatabase:
+    """A single-file Database, or a ShardedDatabase when shards > 1."""
+    if shards > 1:
+        if commit_window_ms or commit_rows:
+            raise ValueError("Group commit is not supported with more than one shard")
+        return ShardedDatabase(db_path, shards, shard_dirs)
+    return Database(db_path, commit_window_ms, commit_rows)
+
+
+def init_db(conn: sqlite3.Connection, schema: str = SCHEMA_FULL, migrate: bool = True) -> None:
+    """Create missing tables. An old-layout ratings table is converted right
+    away with migrate=True; with migrate=False conversion is left to
+    migrate_ratings calls and conn.legacy_ratings is set until it finishes."""
+    if schema not in (SCHEMA_FULL, SCHEMA_COMMON, SCHEMA_SHARD):
+        raise ValueError(f"Unknown schema: {schema!r}")
+    cur = conn.cursor()
+    if schema != SCHEMA_SHARD:
+        _init_common_tables(cur)
+    if schema != SCHEMA_COMMON:
+        _init_pair_tables(cur, migrate)
+    conn.commit()
+
+
+def _init_common_tables(cur: sqlite3.Cursor) -> None:
+    """names, users, pairs and catalogs: shared by every pair."""
     # Names table
     cur.execute(
         """
@@ -46,46 +577,228 @@ def init_db(conn: sqlite3.Connection) -> None:
         );
         """
     )
+    # Catalog the pair rates, chosen at /start
+    _ensure_column(cur, "pairs", "catalog_id", f"INTEGER NOT NULL DEFAULT {DEFAULT_CATALOG_ID}")
 
-    # Ratings (each user answers each name only once per pair and round)
+    # Held the names count that catalogs.size replaced
+    cur.execute("DROP TABLE IF EXISTS meta")
+
+    # Name catalogs: named subsets of names. size (the round 1 total) is NULL
+    # while a new catalog is still being imported, which keeps it off /start
     cur.execute(
         """
-        CREATE TABLE IF NOT EXISTS ratings (
+        CREATE TABLE IF NOT EXISTS catalogs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            size INTEGER
+        );
+        """
+    )
+    # Membership, clustered by catalog: next-name seeks and sizes only touch
+    # the selected catalog's rows
+    has_members = _table_exists(cur, "catalog_names")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS catalog_names (
+            catalog_id INTEGER NOT NULL,
+            name_id INTEGER NOT NULL,
+            PRIMARY KEY (catalog_id, name_id)
+        ) WITHOUT ROWID;
+        """
+    )
+    # For sync_names: is a name still in any catalog?
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_catalog_names_name ON catalog_names(name_id);")
+    cur.execute("INSERT OR IGNORE INTO catalogs(id, name) VALUES (?, ?)", (DEFAULT_CATALOG_ID, DEFAULT_CATALOG))
+    if not has_members:
+        # Names added before catalogs existed: all of them were the catalog
+        cur.execute("INSERT INTO catalog_names(catalog_id, name_id) SELECT ?, id FROM names", (DEFAULT_CATALOG_ID,))
+    _refresh_catalog_size(cur, DEFAULT_CATALOG_ID, only_missing=True)
+
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_pairs_user1 ON pairs(user1_id);")
+    # Also serves matchmaking's "oldest pair with user2_id IS NULL" lookup in id order
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_pairs_user2 ON pairs(user2_id);")
+
+
+def _init_pair_tables(cur: sqlite3.Cursor, migrate: bool) -> None:
+    """Ratings and the state derived from them, all keyed by pair_id."""
+    conn = cur.connection
+    # Ratings (each user answers each name only once per pair and round)
+    cur.execute("PRAGMA user_version")
+    if cur.fetchone()[0] >= SCHEMA_VERSION or not _table_exists(cur, "ratings"):
+        cur.execute(RATINGS_SQL.format(table="ratings"))
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    else:
+        # Old layout (TEXT answers, rowid plus three indexes): filled by
+        # migrate_ratings, then swapped in
+        cur.execute(RATINGS_SQL.format(table="ratings_v2"))
+        if migrate:
+            conn.commit()
+            after_id: Optional[int] = 0
+            while after_id is not None:
+                after_id = migrate_ratings(conn, after_id)
+        else:
+            conn.legacy_ratings = True
+
+    # Round 2 snapshot: names both users liked in round 1, frozen by start_second_round
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS round2_candidates (
             pair_id INTEGER NOT NULL,
-            round INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
             name_id INTEGER NOT NULL,
-            answer TEXT NOT NULL CHECK (answer IN ('like','dislike','neutral')),
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(pair_id, round, user_id, name_id)
+            PRIMARY KEY (pair_id, name_id)
+        ) WITHOUT ROWID;
+        """
+    )
+    # Size of that snapshot, next to it so both commit together (even when
+    # sharded); no row until round 2 is started
+    has_state = _table_exists(cur, "pair_state")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pair_state (
+            pair_id INTEGER PRIMARY KEY,
+            round2_total INTEGER NOT NULL
         );
         """
     )
+    cur.execute("PRAGMA table_info(pairs)")
+    if not has_state and "round2_total" in {row[1] for row in cur.fetchall()}:
+        # Totals kept in pairs before pair_state existed; a shard also copies
+        # other shards' pairs, which it never reads
+        cur.execute("INSERT INTO pair_state(pair_id, round2_total) SELECT id, round2_total FROM pairs WHERE round2_total IS NOT NULL")
 
-    # Helpful indexes
+    # Per-(pair, user, round) cursor: every name with id < position is already rated
     cur.execute(
         """
-        CREATE INDEX IF NOT EXISTS idx_ratings_pair_round ON ratings(pair_id, round);
+        CREATE TABLE IF NOT EXISTS progress (
+            pair_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            round INTEGER NOT NULL,
+            position INTEGER NOT NULL DEFAULT 0,
+            answered INTEGER,
+            PRIMARY KEY (pair_id, user_id, round)
+        ) WITHOUT ROWID;
         """
     )
+
+    # Answers given so far, kept up to date by core.record_answer; NULL for rows
+    # written before the counter existed
+    _ensure_column(cur, "progress", "answered", "INTEGER")
+
+    # Like bitmaps (see likes.py), kept up to date by core.record_answer
+    has_bitmaps = _table_exists(cur, "like_bitmaps")
     cur.execute(
         """
-        CREATE INDEX IF NOT EXISTS idx_ratings_user_round ON ratings(user_id, round);
+        CREATE TABLE IF NOT EXISTS like_bitmaps (
+            pair_id INTEGER NOT NULL,
+            round INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            chunk INTEGER NOT NULL,
+            bits BLOB NOT NULL,
+            PRIMARY KEY (pair_id, round, user_id, chunk)
+        ) WITHOUT ROWID;
         """
     )
+    if not has_bitmaps:
+        # Ratings written before the bitmaps existed
+        rebuild_like_bitmaps(cur, stored_answer(conn, ANSWER_LIKE))
+
+
+def _table_exists(cur: sqlite3.Cursor, table: str) -> bool:
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    return cur.fetchone() is not None
+
+
+def stored_answer(conn: sqlite3.Connection, answer: str) -> Any:
+    """ratings.answer value for an answer: its code, or the answer itself while
+    the connection's ratings table still has the old layout."""
+    if getattr(conn, "legacy_ratings", False):
+        return answer
+    return ANSWER_CODES[answer]
+
+
+# Copies old-layout ratings rows into ratings_v2, converting the answers
+_MIGRATE_RATINGS_SQL = (
+    "INSERT OR IGNORE INTO ratings_v2(pair_id, user_id, round, name_id, answer) "
+    "SELECT pair_id, user_id, round, name_id, CASE answer "
+    + " ".join(f"WHEN '{answer}' THEN {code}" for answer, code in ANSWER_CODES.items())
+    + " END FROM ratings WHERE id > ?"
+)
+
+
+def migrate_ratings(conn: sqlite3.Connection, after_id: int = 0, batch_rows: int = DB_MIGRATION_BATCH_ROWS) -> Optional[int]:
+    """Copy the next batch_rows old-layout ratings (id > after_id) into
+    ratings_v2 and commit; returns the last id copied, or None when nothing is
+    left to migrate.
+
+    Answers keep going to the old table meanwhile and, having larger ids, are
+    picked up by later batches. The batch that reaches the end also drops the
+    old table (and its indexes), renames ratings_v2 to ratings and sets
+    user_version, all in one transaction. Rerunning from after_id=0 is safe.
+    """
+    cur = conn.cursor()
+    if not _table_exists(cur, "ratings_v2"):
+        return None
+    cur.execute("SELECT id FROM ratings WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?", (after_id, batch_rows - 1))
+    row = cur.fetchone()
+    if not conn.in_transaction:
+        cur.execute("BEGIN")
+    if row is not None:
+        cur.execute(_MIGRATE_RATINGS_SQL + " AND id <= ?", (after_id, row[0]))
+        conn.commit()
+        return int(row[0])
+    cur.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='ratings' AND sql IS NOT NULL LIMIT 1")
+    index = cur.fetchone()
+    if index is not None:
+        # Unused by the queries (the UNIQUE index covers them); dropped one per
+        # call so that no single step frees the whole old table
+        cur.execute(f"DROP INDEX {index[0]}")
+        conn.commit()
+        return after_id
+    cur.execute(_MIGRATE_RATINGS_SQL, (after_id,))
+    cur.execute("DROP TABLE ratings")
+    cur.execute("ALTER TABLE ratings_v2 RENAME TO ratings")
+    cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    if getattr(conn, "legacy_ratings", False):
+        conn.legacy_ratings = False
     conn.commit()
+    return None
+
+
+def _ensure_column(cur: sqlite3.Cursor, table: str, column: str, decl: str) -> None:
+    # Add a column to a table created by an older schema
+    cur.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cur.fetchall()}:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _cached_user(conn: sqlite3.Connection, user_id: int) -> Optional[Tuple[Optional[str], Optional[int]]]:
+    # (username, chat_id) from the connection's cache, falling back to the table
+    cache: Optional[UserCache] = getattr(conn, "user_cache", None)
+    user = None if cache is None else cache.get(user_id)
+    if user is None:
+        row = get_user(conn, user_id)
+        if row is not None:
+            user = (row["username"], row["chat_id"])
+            if cache is not None:
+                cache.put(user_id, *user)
+    return user
 
 
 def ensure_user(conn: sqlite3.Connection, user_id: int, username: Optional[str] = None, chat_id: Optional[int] = None) -> None:
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO users(user_id, username, chat_id) VALUES (?, ?, ?)", (user_id, username, chat_id))
-    # Update fields if provided
-    if username is not None:
-        cur.execute("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
-    if chat_id is not None:
-        cur.execute("UPDATE users SET chat_id=? WHERE user_id=?", (chat_id, user_id))
+    current = _cached_user(conn, user_id)
+    if current is not None:
+        # Only provided fields are updated, and only when they changed
+        new = (current[0] if username is None else username, current[1] if chat_id is None else chat_id)
+        if new == current:
+            return
+        conn.execute("UPDATE users SET username=?, chat_id=? WHERE user_id=?", (new[0], new[1], user_id))
+    else:
+        new = (username, chat_id)
+        conn.execute("INSERT OR IGNORE INTO users(user_id, username, chat_id) VALUES (?, ?, ?)", (user_id, username, chat_id))
     conn.commit()
+    cache: Optional[UserCache] = getattr(conn, "user_cache", None)
+    if cache is not None:
+        cache.put(user_id, *new)
 
 
 def get_user(conn: sqlite3.Connection, user_id: int) -> Optional[sqlite3.Row]:
@@ -95,12 +808,248 @@ def get_user(conn: sqlite3.Connection, user_id: int) -> Optional[sqlite3.Row]:
     return row
 
 
-def add_names(conn: sqlite3.Connection, names: Iterable[str]) -> int:
+def _stripped(names: Iterable[str]) -> Iterator[str]:
+    for name in names:
+        if name and name.strip():
+            yield name.strip()
+
+
+def _add_to_catalog(cur: sqlite3.Cursor, catalog_id: int, names: Sequence[str]) -> Tuple[int, Optional[int]]:
+    """Add names to a catalog; shared names keep their one id. Returns how
+    many joined it and the lowest id among them (None when none did)."""
+    cur.executemany("INSERT OR IGNORE INTO names(name) VALUES (?)", [(name,) for name in names])
+    lowest: Optional[int] = None
+    for start in range(0, len(names), 500):
+        batch = names[start:start + 500]
+        cur.execute(
+            f"""
+            SELECT MIN(n.id) FROM names n
+            WHERE n.name IN ({','.join('?' * len(batch))})
+              AND NOT EXISTS (SELECT 1 FROM catalog_names c WHERE c.catalog_id = ? AND c.name_id = n.id)
+            """,
+            (*batch, catalog_id),
+        )
+        first = cur.fetchone()[0]
+        if first is not None and (lowest is None or first < lowest):
+            lowest = int(first)
+    cur.executemany(
+        "INSERT OR IGNORE INTO catalog_names(catalog_id, name_id) SELECT ?, id FROM names WHERE name=?",
+        [(catalog_id, name) for name in names],
+    )
+    return max(cur.rowcount, 0), lowest
+
+
+def shard_connections(db: "AnyDatabase") -> List[sqlite3.Connection]:
+    """Shard connections of a ShardedDatabase (none for a single file): pass
+    them to add_names/sync_names so catalog changes reach per-pair state."""
+    return [shard.conn for shard in db.shards] if isinstance(db, ShardedDatabase) else []
+
+
+def _update_pair_state(
+    conn: sqlite3.Connection,
+    shards: Sequence[sqlite3.Connection],
+    catalog_id: int,
+    first_added: Optional[int],
+    removed: Sequence[int],
+) -> None:
+    """Bring the pair tables in line with a catalog change (see
+    _rewind_catalog_progress and _forget_catalog_names).
+
+    With the pair tables in conn's own file this joins the caller's
+    transaction. Otherwise each shard is updated in its own transaction,
+    which the caller runs after committing the catalog change.
+    """
+    if first_added is None and not removed:
+        return
+    for target in list(shards) if shards else [conn]:
+        cur = target.cursor()
+        if not _table_exists(cur, "progress"):
+            # Pair tables elsewhere, but no pair rates the catalog (_check_reachable)
+            continue
+        if first_added is not None:
+            _rewind_catalog_progress(cur, catalog_id, first_added)
+        if removed:
+            _forget_catalog_names(cur, catalog_id, removed)
+        prefetch: Optional[PrefetchQueue] = getattr(target, "prefetch", None)
+        if prefetch is not None and len(prefetch):
+            # Queued names no longer match the catalog: rebuilt on demand
+            cur.execute("SELECT id FROM pairs WHERE catalog_id=?", (catalog_id,))
+            for row in cur.fetchall():
+                prefetch.invalidate(row[0])
+        if shards:
+            target.commit()
+
+
+def _check_reachable(conn: sqlite3.Connection, shards: Sequence[sqlite3.Connection], catalog_id: int) -> None:
+    # Before any write: a common file alone can't update its pairs' progress
+    cur = conn.cursor()
+    if shards or _table_exists(cur, "progress"):
+        return
+    cur.execute("SELECT 1 FROM pairs WHERE catalog_id=? LIMIT 1", (catalog_id,))
+    if cur.fetchone() is not None:
+        raise ValueError("The catalog's pairs are in shard files: pass shards=shard_connections(db)")
+
+
+def add_names(
+    conn: sqlite3.Connection,
+    names: Iterable[str],
+    catalog: str = DEFAULT_CATALOG,
+    batch_rows: int = CATALOG_IMPORT_BATCH_ROWS,
+    shards: Sequence[sqlite3.Connection] = (),
+) -> int:
+    """Add names to a catalog, creating it if needed. Returns how many joined it.
+
+    `names` is consumed lazily, batch_rows per transaction, so a large import
+    never holds the write lock for long and readers (WAL) are never blocked.
+    A new catalog gets its size, and so becomes selectable, only once the
+    import is complete. Pairs already rating the catalog get their round 1
+    cursors moved back to the new names (`shards`: see shard_connections).
+    """
+    cur = conn.cursor()
+    row = get_catalog(conn, catalog)
+    if row is None:
+        cur.execute("INSERT INTO catalogs(name) VALUES (?)", (catalog,))
+        catalog_id = int(cur.lastrowid)
+        conn.commit()
+    else:
+        catalog_id = int(row["id"])
+        _check_reachable(conn, shards, catalog_id)
+    names = _stripped(names)
+    added = 0
+    for batch in iter(lambda: list(islice(names, batch_rows)), []):
+        joined, first_added = _add_to_catalog(cur, catalog_id, batch)
+        added += joined
+        if not shards:
+            _update_pair_state(conn, shards, catalog_id, first_added, ())
+        conn.commit()
+        if shards:
+            _update_pair_state(conn, shards, catalog_id, first_added, ())
+    _refresh_catalog_size(cur, catalog_id)
+    conn.commit()
+    return added
+
+
+def sync_names(
+    conn: sqlite3.Connection,
+    names: Iterable[str],
+    remove: bool = True,
+    catalog: str = DEFAULT_CATALOG,
+    shards: Sequence[sqlite3.Connection] = (),
+) -> Tuple[int, int]:
+    """Make a catalog match `names` in one transaction: add the new ones and,
+    with remove, drop those no longer listed. Returns (added, removed).
+
+    Names dropped from their last catalog are deleted from names. Kept names
+    keep their ids and ratings are left alone; AUTOINCREMENT never gives a
+    deleted id to a new name. The catalog's pairs follow the change: cursors
+    move back to added names, and removed names leave the progress counters
+    and round 2 snapshots. Sharded, pass the shards (see shard_connections),
+    or a catalog with pairs raises ValueError before anything is written;
+    each shard is updated in its own transaction after the catalog's. A running bot
+    serves the change from memory after a restart (its NameCatalogs are
+    built at startup).
+    """
+    wanted = dict.fromkeys(_stripped(names))
     cur = conn.cursor()
-    to_insert = [(n.strip(),) for n in names if n and n.strip()]
-    cur.executemany("INSERT OR IGNORE INTO names(name) VALUES (?)", to_insert)
+    row = get_catalog(conn, catalog)
+    if row is None:
+        cur.execute("INSERT INTO catalogs(name) VALUES (?)", (catalog,))
+        catalog_id = int(cur.lastrowid)
+    else:
+        catalog_id = int(row["id"])
+        _check_reachable(conn, shards, catalog_id)
+    cur.execute(
+        "SELECT n.id, n.name FROM catalog_names c JOIN names n ON n.id = c.name_id WHERE c.catalog_id=?",
+        (catalog_id,),
+    )
+    existing = {row[1]: row[0] for row in cur.fetchall()}
+    added, first_added = _add_to_catalog(cur, catalog_id, [name for name in wanted if name not in existing])
+    removed = [name_id for name, name_id in existing.items() if name not in wanted] if remove else []
+    cur.executemany("DELETE FROM catalog_names WHERE catalog_id=? AND name_id=?", [(catalog_id, name_id) for name_id in removed])
+    if not shards:
+        _update_pair_state(conn, shards, catalog_id, first_added, removed)
+    cur.executemany(
+        "DELETE FROM names WHERE id=? AND NOT EXISTS (SELECT 1 FROM catalog_names WHERE name_id=?)",
+        [(name_id, name_id) for name_id in removed],
+    )
+    _refresh_catalog_size(cur, catalog_id)
     conn.commit()
-    return cur.rowcount
+    if shards:
+        _update_pair_state(conn, shards, catalog_id, first_added, removed)
+    return added, len(removed)
+
+
+def _rewind_catalog_progress(cur: sqlite3.Cursor, catalog_id: int, first_added: int) -> None:
+    """Move round 1 cursors of the catalog's pairs back to first_added: a name
+    that already existed joins with its old id, which may lie behind them."""
+    cur.execute(
+        """
+        UPDATE progress SET position = ?
+        WHERE round = ? AND position > ? AND pair_id IN (SELECT id FROM pairs WHERE catalog_id = ?)
+        """,
+        (first_added, ROUND_ONE, first_added, catalog_id),
+    )
+
+
+def _forget_catalog_names(cur: sqlite3.Cursor, catalog_id: int, name_ids: Sequence[int]) -> None:
+    """Stop counting names removed from a catalog for the pairs rating it:
+    their answers leave progress.answered, and they leave round 2 snapshots
+    and pair_state totals."""
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS removed_names (name_id INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM temp.removed_names")
+    cur.executemany("INSERT OR IGNORE INTO temp.removed_names(name_id) VALUES (?)", [(name_id,) for name_id in name_ids])
+    cur.execute(
+        """
+        UPDATE progress SET answered = answered - (
+            SELECT COUNT(*) FROM ratings r
+            WHERE r.pair_id = progress.pair_id AND r.round = progress.round AND r.user_id = progress.user_id
+              AND r.name_id IN (SELECT name_id FROM temp.removed_names)
+        )
+        WHERE answered IS NOT NULL AND pair_id IN (SELECT id FROM pairs WHERE catalog_id = ?)
+        """,
+        (catalog_id,),
+    )
+    cur.execute(
+        """
+        UPDATE pair_state SET round2_total = round2_total - (
+            SELECT COUNT(*) FROM round2_candidates c
+            WHERE c.pair_id = pair_state.pair_id AND c.name_id IN (SELECT name_id FROM temp.removed_names)
+        )
+        WHERE pair_id IN (SELECT id FROM pairs WHERE catalog_id = ?)
+        """,
+        (catalog_id,),
+    )
+    cur.execute(
+        """
+        DELETE FROM round2_candidates
+        WHERE pair_id IN (SELECT id FROM pairs WHERE catalog_id = ?)
+          AND name_id IN (SELECT name_id FROM temp.removed_names)
+        """,
+        (catalog_id,),
+    )
+    cur.execute("DELETE FROM temp.removed_names")
+
+
+def _refresh_catalog_size(cur: sqlite3.Cursor, catalog_id: int, only_missing: bool = False) -> None:
+    cur.execute(
+        "UPDATE catalogs SET size = (SELECT COUNT(*) FROM catalog_names WHERE catalog_id = catalogs.id) "
+        + ("WHERE id=? AND size IS NULL" if only_missing else "WHERE id=?"),
+        (catalog_id,),
+    )
+
+
+def get_catalog(conn: sqlite3.Connection, name: str) -> Optional[sqlite3.Row]:
+    """The catalogs row (id, name, size) called `name`; size is NULL while it is first imported."""
+    cur = conn.cursor()
+    cur.execute("SELECT id, name, size FROM catalogs WHERE name=?", (name,))
+    return cur.fetchone()
+
+
+def list_catalogs(conn: sqlite3.Connection) -> List[sqlite3.Row]:
+    """Catalogs a pair can choose (fully imported), default first."""
+    cur = conn.cursor()
+    cur.execute("SELECT id, name, size FROM catalogs WHERE size IS NOT NULL ORDER BY id")
+    return cur.fetchall()
 
 
 def get_pair_by_id(conn: sqlite3.Connection, pair_id: int) -> Optional[sqlite3.Row]:
@@ -111,8 +1060,17 @@ def get_pair_by_id(conn: sqlite3.Connection, pair_id: int) -> Optional[sqlite3.R
 
 def get_pair_for_user(conn: sqlite3.Connection, user_id: int) -> Optional[sqlite3.Row]:
     cur = conn.cursor()
+    # Latest pair on either side; each branch is a seek on its own index
     cur.execute(
-        "SELECT * FROM pairs WHERE user1_id=? OR user2_id=? ORDER BY id DESC LIMIT 1",
+        """
+        SELECT * FROM pairs WHERE id = (
+            SELECT MAX(id) FROM (
+                SELECT MAX(id) AS id FROM pairs WHERE user1_id=?
+                UNION ALL
+                SELECT MAX(id) AS id FROM pairs WHERE user2_id=?
+            )
+        )
+        """,
         (user_id, user_id),
     )
     return cur.fetchone()
@@ -128,5 +1086,5 @@ def get_other_user_id(conn: sqlite3.Connection, pair_id: int, user_id: int) -> O
 
 
 def get_user_chat_id(conn: sqlite3.Connection, user_id: int) -> Optional[int]:
-    u = get_user(conn, user_id)
-    return None if u is None else u["chat_id"]
\ No newline at end of file
+    u = _cached_user(conn, user_id)
+    return None if u is None else u[1]
\ No newline at end of file
@@ -0,0 +1,49 @@
+"""Import a names file into a catalog that pairs can pick with /start <catalog>.
+
+Runs next to a live bot: names are read lazily and committed in batches of
+--batch-rows, so the bot's writes wait at most one batch and its reads not at
+all. A new catalog is offered only once the import has finished; the bot
+serves it from SQL until its next restart loads it into memory.
+
+    python -m bot_app.import_names girls names_girls.txt
+    python -m bot_app.import_names big names.txt --batch-rows 50000
+    python -m bot_app.import_names default names_1000.txt --sync   # also drop unlisted names
+"""
+import argparse
+import time
+from pathlib import Path
+
+from .config import CATALOG_IMPORT_BATCH_ROWS, DB_PATH
+from .db import add_names, create_database, shard_connections, sync_names
+from .names_loader import iter_names
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("catalog", help="Catalog name (created if missing).")
+    parser.add_argument("names_file", help="UTF-8 file, one name per line.")
+    parser.add_argument("--db", default=str(DB_PATH), help="Bot DB (the common file when sharded; shards per DB_SHARDS).")
+    parser.add_argument("--batch-rows", type=int, default=CATALOG_IMPORT_BATCH_ROWS, help="Names per transaction.")
+    parser.add_argument(
+        "--sync", action="store_true", help="Make the catalog match the file exactly, in one transaction (see db.sync_names)."
+    )
+    args = parser.parse_args()
+
+    # Shards too: pairs already rating the catalog have their progress adjusted
+    db = create_database(args.db, commit_window_ms=0, commit_rows=0)
+    try:
+        conn = db.open()
+        shards = shard_connections(db)
+        started = time.perf_counter()
+        names = iter_names(Path(args.names_file))
+        if args.sync:
+            added, removed = sync_names(conn, names, catalog=args.catalog, shards=shards)
+        else:
+            added, removed = add_names(conn, names, args.catalog, args.batch_rows, shards), 0
+        print(f"{args.catalog}: +{added} -{removed} names in {time.perf_counter() - started:.2f}s")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Per-(pair, round, user) like bitmaps over name ids.
+
+Bit n of a user's bitmap is set when they liked name id n. Bitmaps are stored
+in fixed-size chunks (like_bitmaps.chunk = name_id // CHUNK_BITS) so recording
+a like rewrites one small blob regardless of catalog size, and the names two
+users both liked are a per-chunk AND instead of a self-join over ratings.
+Ratings are never changed once written, so bits are only ever set.
+"""
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .config import ANSWER_CODES, ANSWER_LIKE
+
+
+CHUNK_BITS = 4096
+CHUNK_BYTES = CHUNK_BITS // 8
+
+
+def add_like(cur: sqlite3.Cursor, pair_id: int, round_num: int, user_id: int, name_id: int) -> None:
+    """Set name_id's bit in the user's bitmap (no commit)."""
+    chunk, bit = divmod(name_id, CHUNK_BITS)
+    cur.execute(
+        "SELECT bits FROM like_bitmaps WHERE pair_id=? AND round=? AND user_id=? AND chunk=?",
+        (pair_id, round_num, user_id, chunk),
+    )
+    row = cur.fetchone()
+    bits = bytearray(CHUNK_BYTES) if row is None else bytearray(row[0])
+    bits[bit >> 3] |= 1 << (bit & 7)
+    cur.execute(
+        "INSERT OR REPLACE INTO like_bitmaps(pair_id, round, user_id, chunk, bits) VALUES (?, ?, ?, ?, ?)",
+        (pair_id, round_num, user_id, chunk, bytes(bits)),
+    )
+
+
+def _load_chunks(cur: sqlite3.Cursor, pair_id: int, round_num: int, user_id: int) -> Dict[int, int]:
+    cur.execute(
+        "SELECT chunk, bits FROM like_bitmaps WHERE pair_id=? AND round=? AND user_id=?",
+        (pair_id, round_num, user_id),
+    )
+    return {int(row[0]): int.from_bytes(row[1], "little") for row in cur.fetchall()}
+
+
+# Bit positions set in each byte value
+_BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+
+
+def _set_bits(value: int, offset: int) -> List[int]:
+    data = value.to_bytes(CHUNK_BYTES, "little")
+    return [offset + (i << 3) + bit for i, byte in enumerate(data) if byte for bit in _BYTE_BITS[byte]]
+
+
+def common_likes(cur: sqlite3.Cursor, pair_id: int, round_num: int, user1_id: int, user2_id: int) -> List[int]:
+    """Name ids both users liked in the round, ascending."""
+    first = _load_chunks(cur, pair_id, round_num, user1_id)
+    if not first:
+        return []
+    second = _load_chunks(cur, pair_id, round_num, user2_id)
+    ids: List[int] = []
+    for chunk in sorted(first.keys() & second.keys()):
+        ids.extend(_set_bits(first[chunk] & second[chunk], chunk * CHUNK_BITS))
+    return ids
+
+
+def _bitmap_rows(likes: Iterable[Tuple[int, int, int, int]]) -> Iterator[Tuple[int, int, int, int, bytes]]:
+    """(pair_id, round, user_id, name_id) grouped by the first three -> like_bitmaps rows."""
+    key: Optional[Tuple[int, int, int]] = None
+    chunks: Dict[int, bytearray] = {}
+    for pair_id, round_num, user_id, name_id in likes:
+        if (pair_id, round_num, user_id) != key:
+            if key is not None:
+                yield from (key + (chunk, bytes(bits)) for chunk, bits in chunks.items())
+            key, chunks = (pair_id, round_num, user_id), {}
+        chunk, bit = divmod(name_id, CHUNK_BITS)
+        bits = chunks.get(chunk)
+        if bits is None:
+            bits = chunks[chunk] = bytearray(CHUNK_BYTES)
+        bits[bit >> 3] |= 1 << (bit & 7)
+    if key is not None:
+        yield from (key + (chunk, bytes(bits)) for chunk, bits in chunks.items())
+
+
+def rebuild_like_bitmaps(cur: sqlite3.Cursor, like: object = ANSWER_CODES[ANSWER_LIKE]) -> None:
+    """Recompute every bitmap from ratings (no commit), e.g. for a DB that
+    predates them; `like` is how ratings.answer stores a like."""
+    cur.execute("DELETE FROM like_bitmaps")
+    likes = cur.connection.execute(
+        "SELECT pair_id, round, user_id, name_id FROM ratings WHERE answer=? ORDER BY pair_id, user_id, round",
+        (like,),
+    )
+    cur.executemany(
+        "INSERT INTO like_bitmaps(pair_id, round, user_id, chunk, bits) VALUES (?, ?, ?, ?, ?)",
+        _bitmap_rows(likes),
+    )
@@ -0,0 +1,84 @@
+"""Pair matchmaking: indexed pending-pair lookups and an atomic claim.
+
+Claiming is a single UPDATE guarded by `user2_id IS NULL`, so two /start
+calls (from this or another process) can never both join the same pair.
+Users are only paired with someone who chose the same catalog.
+"""
+import sqlite3
+from collections import defaultdict, deque
+from typing import DefaultDict, Deque, Optional
+
+from .config import DEFAULT_CATALOG_ID, ROUND_ONE
+
+
+class WaitingQueue:
+    """Optional in-memory FIFOs of pending pair ids, one per catalog.
+
+    Serves /start bursts without querying for pending pairs. The DB stays the
+    source of truth: stale ids simply fail to claim, and an empty queue falls
+    back to the indexed lookup. Use it from the DB thread only.
+    """
+
+    def __init__(self):
+        self._pair_ids: DefaultDict[int, Deque[int]] = defaultdict(deque)
+        self._loaded = False
+
+    def __len__(self) -> int:
+        return sum(len(pair_ids) for pair_ids in self._pair_ids.values())
+
+    def load(self, cur: sqlite3.Cursor) -> None:
+        if self._loaded:
+            return
+        cur.execute("SELECT id, catalog_id FROM pairs WHERE user2_id IS NULL ORDER BY id ASC")
+        for row in cur.fetchall():
+            self._pair_ids[int(row["catalog_id"])].append(int(row["id"]))
+        self._loaded = True
+
+    def push(self, pair_id: int, catalog_id: int = DEFAULT_CATALOG_ID) -> None:
+        self._pair_ids[catalog_id].append(pair_id)
+
+    def pop(self, catalog_id: int = DEFAULT_CATALOG_ID) -> Optional[int]:
+        pair_ids = self._pair_ids.get(catalog_id)
+        return pair_ids.popleft() if pair_ids else None
+
+
+def _claim(cur: sqlite3.Cursor, pair_id: int, user_id: int) -> bool:
+    cur.execute(
+        "UPDATE pairs SET user2_id=? WHERE id=? AND user2_id IS NULL AND user1_id != ?",
+        (user_id, pair_id, user_id),
+    )
+    return cur.rowcount > 0
+
+
+def claim_pending_pair(
+    cur: sqlite3.Cursor, user_id: int, queue: Optional[WaitingQueue] = None, catalog_id: int = DEFAULT_CATALOG_ID
+) -> bool:
+    """Join the oldest pending pair of the catalog as user2. Returns False when none is waiting."""
+    if queue is not None:
+        queue.load(cur)
+        while True:
+            pair_id = queue.pop(catalog_id)
+            if pair_id is None:
+                break
+            if _claim(cur, pair_id, user_id):
+                return True
+    cur.execute(
+        """
+        UPDATE pairs SET user2_id=?
+        WHERE id = (
+            SELECT id FROM pairs WHERE user2_id IS NULL AND user1_id != ? AND catalog_id = ? ORDER BY id ASC LIMIT 1
+        ) AND user2_id IS NULL
+        """,
+        (user_id, user_id, catalog_id),
+    )
+    return cur.rowcount > 0
+
+
+def create_pending_pair(
+    cur: sqlite3.Cursor, user_id: int, queue: Optional[WaitingQueue] = None, catalog_id: int = DEFAULT_CATALOG_ID
+) -> int:
+    cur.execute("INSERT INTO pairs(user1_id, current_round, catalog_id) VALUES (?, ?, ?)", (user_id, ROUND_ONE, catalog_id))
+    pair_id = int(cur.lastrowid)
+    if queue is not None:
+        queue.push(pair_id, catalog_id)
+    return pair_id
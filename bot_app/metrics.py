@@ -0,0 +1,240 @@
+"""In-process metrics: handler and DB call timings, commit/row counters and
+Telegram send latency.
+
+Disabled unless METRICS_ENABLED is set; instrumented code checks
+`metrics.enabled` (or isn't wrapped at all), so a disabled registry costs one
+attribute lookup per hot-path call. When enabled, the registry is exposed as
+Prometheus text on METRICS_PORT and/or summarized in a periodic log line.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from .config import METRICS_ENABLED, METRICS_LISTEN, METRICS_PORT, METRICS_LOG_INTERVAL
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+Labels = Tuple[Tuple[str, str], ...]
+
+# Statements run outside Metrics.db_call (schema setup, flushes)
+_OTHER_STATEMENTS: Tuple[str, Labels] = ("db_statements_total", (("function", "other"),))
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Summary:
+    """Count, sum and a window of recent samples (for quantiles) of one timing."""
+
+    __slots__ = ("count", "total", "samples")
+
+    def __init__(self, window: int = 1024):
+        self.count = 0
+        self.total = 0.0
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+
+class Metrics:
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._summaries: Dict[Tuple[str, Labels], Summary] = {}
+        # Updated from the event loop and every DB thread: read-modify-write
+        # under this lock so concurrent increments of one key aren't lost
+        self._lock = threading.Lock()
+        # Counter key of the core function running on each DB thread (one per
+        # shard), for attributing statements to it
+        self._local = threading.local()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._summaries.clear()
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = Summary()
+            summary.observe(seconds)
+
+    def counter(self, name: str, **labels: str) -> float:
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def summary(self, name: str, **labels: str) -> Optional[Summary]:
+        return self._summaries.get((name, tuple(sorted(labels.items()))))
+
+    # --- hooks -------------------------------------------------------------
+
+    def count_statement(self, sql: str) -> None:
+        """sqlite3 trace callback: count statements per calling core function."""
+        key = getattr(self._local, "statement_key", _OTHER_STATEMENTS)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def db_call(self, fn: Callable[..., T], *args: Any) -> T:
+        """Run fn(*args) on the DB thread, timing it under fn's name."""
+        local = self._local
+        other = getattr(local, "statement_key", _OTHER_STATEMENTS)
+        local.statement_key = ("db_statements_total", (("function", fn.__name__),))
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.observe("db_call_seconds", time.perf_counter() - started, function=fn.__name__)
+            local.statement_key = other
+
+    # --- output ------------------------------------------------------------
+
+    def _snapshot(self) -> Tuple[List[Tuple[Tuple[str, Labels], float]], List[Tuple[Tuple[str, Labels], int, float, List[float]]]]:
+        """Sorted copies of the counters and of each summary's (count, sum, samples)."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            summaries = sorted(
+                ((key, s.count, s.total, list(s.samples)) for key, s in self._summaries.items()), key=lambda item: item[0]
+            )
+        return counters, summaries
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        lines: List[str] = []
+        typed = set()
+        counters, summaries = self._snapshot()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labels(labels)} {value:g}")
+        for (name, labels), count, total, samples in summaries:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} summary")
+            for q in self.QUANTILES:
+                lines.append(f"{name}{_labels(labels + (('quantile', str(q)),))} {percentile(samples, q):.6f}")
+            lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def log_line(self) -> str:
+        """One-line summary: counters, then count/p50/p95 in ms per timing."""
+        counters, summaries = self._snapshot()
+        parts = [f"{name}{_labels(labels)}={value:g}" for (name, labels), value in counters]
+        for (name, labels), count, _, samples in summaries:
+            parts.append(
+                f"{name}{_labels(labels)}=n{count}/p50 {percentile(samples, 0.5) * 1000:.1f}ms/p95 {percentile(samples, 0.95) * 1000:.1f}ms"
+            )
+        return " ".join(parts)
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+# Process-wide registry
+metrics = Metrics(METRICS_ENABLED)
+
+
+def instrument_handler(name: str, handler: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """Time a telegram handler as handler_seconds{handler=name}; a no-op when disabled."""
+    if not metrics.enabled:
+        return handler
+
+    @functools.wraps(handler)
+    async def timed(*args: Any, **kwargs: Any) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            metrics.inc("handler_errors_total", handler=name)
+            raise
+        finally:
+            metrics.observe("handler_seconds", time.perf_counter() - started, handler=name)
+
+    return timed
+
+
+class MetricsReporter:
+    """Serves GET /metrics on `port` (0: no endpoint) and logs a summary every
+    `log_interval` seconds (0: no log line)."""
+
+    def __init__(
+        self,
+        registry: Metrics = metrics,
+        listen: str = METRICS_LISTEN,
+        port: int = METRICS_PORT,
+        log_interval: float = METRICS_LOG_INTERVAL,
+    ):
+        self.registry = registry
+        self.listen = listen
+        self.port = port
+        self.log_interval = log_interval
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self.port:
+            self._server = await asyncio.start_server(self._handle, self.listen, self.port)
+            logger.info("Metrics at http://%s:%d/metrics", self.listen, self.port)
+        if self.log_interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._log_periodically())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _log_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.log_interval)
+            logger.info("Metrics: %s", self.registry.log_line())
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.registry.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode(
+                    "latin-1"
+                )
+                + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
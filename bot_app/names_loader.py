@@ -1,12 +1,96 @@
+import sqlite3
+from array import array
+from bisect import bisect_left
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
+from .config import DEFAULT_CATALOG_ID
 
-def load_names(names_file: Path) -> List[str]:
-    names: List[str] = []
+
+def iter_names(names_file: Path) -> Iterator[str]:
+    """Stripped, non-empty lines of a names file, read lazily (for db.add_names)."""
     with names_file.open("r", encoding="utf-8") as f:
         for line in f:
             name = line.strip()
             if name:
-                names.append(name)
-    return names
\ No newline at end of file
+                yield name
+
+
+def load_names(names_file: Path) -> List[str]:
+    return list(iter_names(names_file))
+
+
+class NameCatalog:
+    """Immutable id -> name map of one catalog, built once at startup.
+
+    Ids live in a sorted array and all names in one UTF-8 blob sliced by an
+    offset table, so a 100k-name catalog costs a few bytes per name instead of
+    a str object and a dict slot each. Rebuild it if the catalog changes.
+    """
+
+    __slots__ = ("_ids", "_offsets", "_blob")
+
+    def __init__(self, ids: array, offsets: array, blob: bytes):
+        self._ids = ids
+        self._offsets = offsets
+        self._blob = blob
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[int, str]]) -> "NameCatalog":
+        """Build from (id, name) pairs sorted by id."""
+        ids = array("q")
+        offsets = array("I", [0])
+        chunks = []
+        size = 0
+        for name_id, name in rows:
+            data = name.encode("utf-8")
+            ids.append(name_id)
+            chunks.append(data)
+            size += len(data)
+            offsets.append(size)
+        return cls(ids, offsets, b"".join(chunks))
+
+    @classmethod
+    def from_db(cls, conn: sqlite3.Connection, catalog_id: int = DEFAULT_CATALOG_ID) -> "NameCatalog":
+        return cls.from_rows(
+            conn.execute(
+                "SELECT n.id, n.name FROM catalog_names c JOIN names n ON n.id = c.name_id WHERE c.catalog_id=? ORDER BY c.name_id",
+                (catalog_id,),
+            )
+        )
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, name_id: int) -> bool:
+        return self._index(name_id) is not None
+
+    def _index(self, name_id: int) -> Optional[int]:
+        i = bisect_left(self._ids, name_id)
+        if i < len(self._ids) and self._ids[i] == name_id:
+            return i
+        return None
+
+    def name(self, name_id: int) -> Optional[str]:
+        i = self._index(name_id)
+        if i is None:
+            return None
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].decode("utf-8")
+
+    def ids_from(self, position: int) -> Iterator[int]:
+        """Ids >= position in ascending order."""
+        for i in range(bisect_left(self._ids, position), len(self._ids)):
+            yield self._ids[i]
+
+    def nbytes(self) -> int:
+        """Memory held by the arrays and the blob."""
+        return self._ids.itemsize * len(self._ids) + self._offsets.itemsize * len(self._offsets) + len(self._blob)
+
+
+def load_catalogs(conn: sqlite3.Connection) -> Dict[int, NameCatalog]:
+    """A NameCatalog per selectable catalog, for GroupCommitConnection.name_catalogs.
+
+    Catalogs imported later are served from SQL until the next restart.
+    """
+    rows = conn.execute("SELECT id FROM catalogs WHERE size IS NOT NULL ORDER BY id").fetchall()
+    return {int(row[0]): NameCatalog.from_db(conn, int(row[0])) for row in rows}
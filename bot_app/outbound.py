@@ -0,0 +1,275 @@
+"""Outbound Telegram message scheduler.
+
+Handlers enqueue messages and return immediately; a dispatcher task sends them
+within a global and a per-chat token-bucket budget, keeping each chat's
+messages in order. Identical pending notifications are coalesced, a pending
+edit of a message is replaced by a newer edit of the same message, and
+RetryAfter (flood control) responses are retried after the requested delay.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional, Set
+
+from telegram.error import BadRequest, RetryAfter
+
+from .config import OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_STATS_INTERVAL
+from .metrics import metrics, percentile
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available (0 when one is available now)."""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class _Outgoing:
+    __slots__ = ("method", "kwargs", "coalesce_key", "enqueued_at", "future")
+
+    def __init__(self, method: str, kwargs: Dict[str, Any], coalesce_key: Optional[str], future: asyncio.Future):
+        self.method = method
+        self.kwargs = kwargs
+        self.coalesce_key = coalesce_key
+        self.enqueued_at = time.monotonic()
+        self.future = future
+
+
+class OutboundQueue:
+    """Per-chat FIFO queues drained round-robin by a single dispatcher task."""
+
+    def __init__(
+        self,
+        bot: Any,
+        global_rate: float = OUTBOUND_GLOBAL_RATE,
+        chat_rate: float = OUTBOUND_CHAT_RATE,
+        chat_burst: float = OUTBOUND_CHAT_BURST,
+        stats_interval: float = OUTBOUND_STATS_INTERVAL,
+    ):
+        self._bot = bot
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._pending: "OrderedDict[int, Deque[_Outgoing]]" = OrderedDict()
+        self._in_flight: Set[int] = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._deliveries: Set[asyncio.Task] = set()
+        self._stats_interval = stats_interval
+        self._stats_logged = time.monotonic()
+        # Counters and recent latencies (seconds) for stats()
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.failed = 0
+        self.edit_fallbacks = 0
+        self._queue_latency: Deque[float] = deque(maxlen=1000)
+        self._send_latency: Deque[float] = deque(maxlen=1000)
+
+    @property
+    def depth(self) -> int:
+        return sum(len(q) for q in self._pending.values())
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """Give queued messages up to `timeout` seconds to go out, then stop."""
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._deliveries) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._deliveries):
+            task.cancel()
+        if self.depth:
+            logger.warning("Outbound queue stopped with %d unsent messages", self.depth)
+
+    def send_message(self, chat_id: int, text: str, coalesce_key: Optional[str] = None, **kwargs: Any) -> asyncio.Future:
+        """Queue bot.send_message; the future resolves to the sent Message.
+
+        While a message with the same coalesce_key is still waiting for this
+        chat, the new one is dropped and the pending message's future returned.
+        """
+        return self._enqueue(chat_id, "send_message", dict(kwargs, chat_id=chat_id, text=text), coalesce_key)
+
+    def edit_message_text(self, chat_id: int, message_id: int, text: str, **kwargs: Any) -> asyncio.Future:
+        """Queue bot.edit_message_text, sending a new message if the edit fails.
+
+        A newer edit of a message whose previous edit hasn't gone out yet
+        replaces it, so only the latest content is sent.
+        """
+        queue = self._pending.get(chat_id)
+        if queue:
+            for item in queue:
+                if item.method == "edit_message_text" and item.kwargs.get("message_id") == message_id:
+                    item.kwargs = dict(kwargs, chat_id=chat_id, message_id=message_id, text=text)
+                    self.coalesced += 1
+                    return item.future
+        return self._enqueue(chat_id, "edit_message_text", dict(kwargs, chat_id=chat_id, message_id=message_id, text=text), None)
+
+    def answer_callback_query(self, callback_query_id: str, **kwargs: Any) -> asyncio.Future:
+        """Send bot.answer_callback_query now, in the background.
+
+        An answer only stops the button's spinner and isn't a chat message, so
+        it skips the chat queues and budgets rather than waiting behind edits.
+        """
+        loop = asyncio.get_running_loop()
+        item = _Outgoing("answer_callback_query", dict(kwargs, callback_query_id=callback_query_id), None, loop.create_future())
+        task = loop.create_task(self._deliver(None, item))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+        return item.future
+
+    def _enqueue(self, chat_id: int, method: str, kwargs: Dict[str, Any], coalesce_key: Optional[str]) -> asyncio.Future:
+        queue = self._pending.get(chat_id)
+        if coalesce_key is not None and queue:
+            for item in queue:
+                if item.coalesce_key == coalesce_key:
+                    self.coalesced += 1
+                    return item.future
+        future = asyncio.get_running_loop().create_future()
+        if queue is None:
+            queue = self._pending[chat_id] = deque()
+        queue.append(_Outgoing(method, kwargs, coalesce_key, future))
+        self._wakeup.set()
+        return future
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            delay = self._dispatch()
+            if self._stats_interval > 0:
+                if time.monotonic() - self._stats_logged >= self._stats_interval:
+                    self._stats_logged = time.monotonic()
+                    logger.info("Outbound queue: %s", self.stats())
+                delay = self._stats_interval if delay is None else min(delay, self._stats_interval)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self) -> Optional[float]:
+        """Start every send the budgets allow; return seconds until the next one may be possible."""
+        next_delay: Optional[float] = None
+        for chat_id in list(self._pending):
+            if chat_id in self._in_flight:
+                continue
+            delay = max(self._global.delay(), self._chat_bucket(chat_id).delay())
+            if delay > 0:
+                next_delay = delay if next_delay is None else min(next_delay, delay)
+                continue
+            queue = self._pending[chat_id]
+            item = queue.popleft()
+            if queue:
+                # Round-robin: a busy chat goes to the back of the line
+                self._pending.move_to_end(chat_id)
+            else:
+                del self._pending[chat_id]
+            self._global.take()
+            self._chat_bucket(chat_id).take()
+            self._in_flight.add(chat_id)
+            task = asyncio.get_running_loop().create_task(self._deliver(chat_id, item))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+        if len(self._chat_buckets) > 10000:
+            # Idle chats are back at full budget: forget them
+            for chat_id in [c for c, b in self._chat_buckets.items() if b.full and c not in self._pending]:
+                del self._chat_buckets[chat_id]
+        return next_delay
+
+    async def _deliver(self, chat_id: Optional[int], item: _Outgoing) -> None:
+        try:
+            while True:
+                started = time.monotonic()
+                try:
+                    result = await getattr(self._bot, item.method)(**item.kwargs)
+                except RetryAfter as e:
+                    self.retries += 1
+                    retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                    await asyncio.sleep(retry_after)
+                    continue
+                except BadRequest as e:
+                    if item.method != "edit_message_text":
+                        raise
+                    if "not modified" in e.message.lower():
+                        result = True
+                        break
+                    # Message too old, deleted, or not ours: send the content anew
+                    self.edit_fallbacks += 1
+                    item.method = "send_message"
+                    item.kwargs.pop("message_id", None)
+                    continue
+                break
+            now = time.monotonic()
+            self.sent += 1
+            self._send_latency.append(now - started)
+            self._queue_latency.append(now - item.enqueued_at)
+            if metrics.enabled:
+                metrics.observe("telegram_send_seconds", now - started, method=item.method)
+                metrics.observe("outbound_queue_seconds", now - item.enqueued_at)
+            if not item.future.done():
+                item.future.set_result(result)
+        except asyncio.CancelledError:
+            item.future.cancel()
+            raise
+        except Exception as e:
+            self.failed += 1
+            if metrics.enabled:
+                metrics.inc("telegram_send_failures_total", method=item.method)
+            logger.warning("Outbound %s to chat %s failed: %s", item.method, chat_id, e)
+            if not item.future.done():
+                item.future.set_exception(e)
+            # Nobody may await the future; don't log "exception never retrieved"
+            item.future.exception()
+        finally:
+            self._in_flight.discard(chat_id)
+            self._wakeup.set()
+
+    def stats(self) -> Dict[str, float]:
+        queue_lat = list(self._queue_latency)
+        send_lat = list(self._send_latency)
+        return {
+            "depth": self.depth,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+            "failed": self.failed,
+            "edit_fallbacks": self.edit_fallbacks,
+            "queue_ms_p50": round(percentile(queue_lat, 0.5) * 1000, 1),
+            "queue_ms_p95": round(percentile(queue_lat, 0.95) * 1000, 1),
+            "send_ms_p50": round(percentile(send_lat, 0.5) * 1000, 1),
+            "send_ms_p95": round(percentile(send_lat, 0.95) * 1000, 1),
+        }
@@ -1,6 +1,14 @@
 import argparse
+import gzip
+import heapq
+import io
+import os
 import re
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Set, TextIO, Tuple
 
 
 CORE = {
@@ -55,6 +63,7 @@ CYRILLIC_FULL = re.compile(r"^[А-ЯЁІЎ][а-яёіў]+$", re.UNICODE)
 
 
 def score_name(name: str) -> int:
+    """Reference scoring, one rule at a time; ScoreEngine gives the same scores."""
     score = 0
 
     if name in CORE:
@@ -87,10 +96,226 @@ def score_name(name: str) -> int:
     return score
 
 
+# Key of a trie node's weight: the total for suffixes ending at that node
+_WEIGHT = ""
+_REGEX_META = set(".^$*+?{}[]\\|()")
+
+
+def _literal(pattern: str) -> Optional[str]:
+    """The text a regex matches if it is a plain (possibly escaped) literal."""
+    out = []
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\":
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                out.append(pattern[i + 1])
+                i += 2
+                continue
+            return None
+        if ch in _REGEX_META:
+            return None
+        out.append(ch)
+        i += 1
+    return "".join(out) or None
+
+
+def _suffix_trie(suffixes: Iterable[str], weight: int) -> Dict[str, dict]:
+    """Trie over reversed suffixes; walking a reversed word from the root
+    visits the node of every suffix it ends with."""
+    root: Dict[str, dict] = {}
+    for suffix in suffixes:
+        node = root
+        for ch in reversed(suffix):
+            node = node.setdefault(ch, {})
+        node[_WEIGHT] = node.get(_WEIGHT, 0) + weight
+    return root
+
+
+def _suffix_weight(trie: Dict[str, dict], word: str) -> int:
+    total = 0
+    node = trie
+    for ch in reversed(word):
+        node = node.get(ch)
+        if node is None:
+            break
+        total += node.get(_WEIGHT, 0)
+    return total
+
+
+class ScoreEngine:
+    """score_name with the rule tables compiled once.
+
+    CORE and BELARUS_FORMS merge into one name -> bonus lookup and
+    GOOD_SUFFIXES into a reversed-suffix trie. BAD_PATTERNS are split by
+    shape: "literal$" patterns go into a second trie (case-sensitive, like
+    re.search), other literals become substring tests and only the rest stay
+    regexes, each compiled once. Every pattern that matches still costs 40, as
+    in score_name.
+
+    relaxed=True is the fallback scoring main() uses when too few names are
+    left: names that aren't plain Cyrillic are dropped (None) and the
+    BAD_PATTERNS penalties are skipped.
+    """
+
+    def __init__(
+        self,
+        core: Iterable[str] = CORE,
+        belarus_forms: Iterable[str] = BELARUS_FORMS,
+        good_suffixes: Iterable[str] = GOOD_SUFFIXES,
+        bad_patterns: Iterable[str] = BAD_PATTERNS,
+    ):
+        self.bonus: Dict[str, int] = {}
+        for name in core:
+            self.bonus[name] = 100
+        for name in belarus_forms:
+            self.bonus[name] = self.bonus.get(name, 0) + 40
+        self.good_suffixes = _suffix_trie(good_suffixes, 4)
+        bad_suffixes: List[str] = []
+        self.bad_substrings: List[str] = []
+        self.bad_regexes: List[re.Pattern] = []
+        for pattern in bad_patterns:
+            stem = _literal(pattern[:-1]) if pattern.endswith("$") and not pattern.endswith("\\$") else None
+            literal = _literal(pattern)
+            if stem is not None:
+                bad_suffixes.append(stem)
+            elif literal is not None:
+                self.bad_substrings.append(literal)
+            else:
+                self.bad_regexes.append(re.compile(pattern))
+        self.bad_suffixes = _suffix_trie(bad_suffixes, -40)
+
+    def score(self, name: str, relaxed: bool = False) -> Optional[int]:
+        score = self.bonus.get(name, 0)
+        if CYRILLIC_FULL.match(name):
+            score += 15
+        elif relaxed:
+            return None
+        else:
+            score -= 60
+
+        score += _suffix_weight(self.good_suffixes, name.lower())
+
+        n = len(name)
+        if 4 <= n <= 10:
+            score += 6
+        elif n > 12:
+            score -= 5
+        elif n < 3:
+            score -= 10
+
+        if not relaxed:
+            # "x$" also matches before a final newline, as in re.search
+            score += _suffix_weight(self.bad_suffixes, name[:-1] if name.endswith("\n") else name)
+            for literal in self.bad_substrings:
+                if literal in name:
+                    score -= 40
+            for regex in self.bad_regexes:
+                if regex.search(name):
+                    score -= 40
+        return score
+
+    def score_chunk(self, names: Sequence[str], relaxed: bool = False) -> List[Optional[int]]:
+        score = self.score
+        return [score(name, relaxed) for name in names]
+
+
+# Built at import, so every pool worker compiles the rules once
+ENGINE = ScoreEngine()
+
+
+def _score_chunk(names: Sequence[str], relaxed: bool) -> List[Optional[int]]:
+    return ENGINE.score_chunk(names, relaxed)
+
+
+def score_names(names: Sequence[str], relaxed: bool = False, workers: Optional[int] = None, chunk_size: int = 50000) -> List[Optional[int]]:
+    """ENGINE scores of names, in order. Inputs larger than one chunk are
+    spread over a process pool of `workers` (default: CPU count)."""
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(names) <= chunk_size:
+        return ENGINE.score_chunk(names, relaxed)
+    chunks = [names[i:i + chunk_size] for i in range(0, len(names), chunk_size)]
+    scores: List[Optional[int]] = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+        for chunk_scores in pool.map(_score_chunk, chunks, [relaxed] * len(chunks)):
+            scores.extend(chunk_scores)
+    return scores
+
+
+def iter_score_chunks(
+    names: Iterable[str], relaxed: bool = False, workers: Optional[int] = None, chunk_size: int = 50000
+) -> Iterator[Tuple[List[str], List[Optional[int]]]]:
+    """(chunk, scores) for consecutive chunks of a name stream. With a pool,
+    at most two chunks per worker are in flight, so memory stays bounded by
+    the chunk size however long the stream is."""
+    workers = workers or os.cpu_count() or 1
+    names = iter(names)
+    chunks = iter(lambda: list(islice(names, chunk_size)), [])
+    if workers <= 1:
+        for chunk in chunks:
+            yield chunk, ENGINE.score_chunk(chunk, relaxed)
+        return
+    pending: Deque[Tuple[List[str], Future]] = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk in chunks:
+            pending.append((chunk, pool.submit(_score_chunk, chunk, relaxed)))
+            if len(pending) >= 2 * workers:
+                done, future = pending.popleft()
+                yield done, future.result()
+        while pending:
+            done, future = pending.popleft()
+            yield done, future.result()
+
+
+def top_names(
+    names: Iterable[str], count: int, relaxed: bool = False, workers: Optional[int] = None, chunk_size: int = 50000
+) -> List[Tuple[str, int]]:
+    """The `count` best (name, score) pairs of a name stream, sorted like
+    main()'s full sort: by (score, name), highest first, duplicates once.
+
+    Keeps a min-heap of the best `count` so far. Duplicates only need checking
+    against the heap: the heap minimum never decreases, so a name that was
+    rejected or evicted earlier is rejected again when it repeats.
+    """
+    heap: List[Tuple[int, str]] = []
+    in_heap: Set[str] = set()
+    if count <= 0:
+        return []
+    for chunk, scores in iter_score_chunks(names, relaxed, workers, chunk_size):
+        for name, score in zip(chunk, scores):
+            if score is None or name in in_heap:
+                continue
+            if len(heap) < count:
+                heapq.heappush(heap, (score, name))
+                in_heap.add(name)
+            elif (score, name) > heap[0]:
+                _, evicted = heapq.heapreplace(heap, (score, name))
+                in_heap.discard(evicted)
+                in_heap.add(name)
+    return [(name, score) for score, name in sorted(heap, reverse=True)]
+
+
+def open_names(path: Path) -> TextIO:
+    """Open a names file for reading, gunzipping *.gz and gzip-magic files."""
+    raw = path.open("rb")
+    if raw.peek(2)[:2] == b"\x1f\x8b":
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=raw), encoding="utf-8")
+    return io.TextIOWrapper(raw, encoding="utf-8")
+
+
+def iter_names(path: Path) -> Iterator[str]:
+    """Stripped, non-empty lines of a names file, read lazily (duplicates kept)."""
+    with open_names(path) as f:
+        for line in f:
+            name = line.strip()
+            if name:
+                yield name
+
+
 def read_unique_names(path: Path) -> list[str]:
     seen = set()
     out = []
-    with path.open("r", encoding="utf-8") as f:
+    with open_names(path) as f:
         for line in f:
             name = line.strip()
             if not name:
@@ -108,55 +333,66 @@ def write_names(path: Path, names: list[str]) -> None:
             f.write(n + "\n")
 
 
+def sync_db(path: Path, names: List[str]) -> Tuple[int, int]:
+    """Apply the selection to a bot DB's names table (see db.sync_names)."""
+    # Imported here: the bot package isn't needed to just curate a file
+    from bot_app.db import create_database, shard_connections, sync_names
+
+    # Shard files too (DB_SHARDS): removed names leave the pairs' progress there
+    db = create_database(str(path), commit_window_ms=0, commit_rows=0)
+    try:
+        return sync_names(db.open(), names, shards=shard_connections(db))
+    finally:
+        db.close()
+
+
 def main():
     parser = argparse.ArgumentParser(description="Filter Belarus-friendly male names to 1000 entries.")
-    parser.add_argument("--input", default=str(Path("names.txt").resolve()), help="Input names file (UTF-8, one per line).")
+    parser.add_argument("--input", default=str(Path("names.txt").resolve()), help="Input names file (UTF-8, one per line, optionally gzipped).")
     parser.add_argument("--output", default=str(Path("names_1000.txt").resolve()), help="Output file for curated 1000 names.")
     parser.add_argument("--count", type=int, default=1000, help="Target count (default 1000).")
+    parser.add_argument("--workers", type=int, default=None, help="Scoring processes (default: CPU count).")
+    parser.add_argument("--chunk-size", type=int, default=50000, help="Names per scoring task.")
+    parser.add_argument(
+        "--stream", action="store_true", help="Read the input lazily and keep only the top --count names: memory follows --count, not the input size."
+    )
+    parser.add_argument(
+        "--sync-db", help="Bot DB to update with the selection: adds new names, deletes dropped ones, keeps ids and ratings."
+    )
     args = parser.parse_args()
 
     in_path = Path(args.input)
     out_path = Path(args.output)
+    options = dict(workers=args.workers, chunk_size=args.chunk_size)
 
-    names = read_unique_names(in_path)
-    scored = [(name, score_name(name)) for name in names]
-    scored.sort(key=lambda x: (x[1], x[0]), reverse=True)
+    if args.stream:
+        scored = top_names(iter_names(in_path), args.count, **options)
+        if len(scored) < args.count:
+            # Fewer unique names than the target: second pass, relaxed
+            scored = top_names(iter_names(in_path), args.count, relaxed=True, **options)
+        input_count = "streamed"
+    else:
+        names = read_unique_names(in_path)
+        input_count = str(len(names))
+        scored = list(zip(names, score_names(names, **options)))
+        scored.sort(key=lambda x: (x[1], x[0]), reverse=True)
 
-    # If fewer than target, relax penalties (remove some patterns except non-Cyrillic)
-    if len(scored) < args.count:
-        relaxed = []
-        for name in names:
-            # Only keep names that match Cyrillic baseline
-            if not CYRILLIC_FULL.match(name):
-                continue
-            # Re-score with a reduced penalty set (keep non-Cyrillic guard only)
-            relaxed_score = 0
-            if name in CORE:
-                relaxed_score += 100
-            if name in BELARUS_FORMS:
-                relaxed_score += 40
-            relaxed_score += 15  # Cyrillic bonus
-            lower = name.lower()
-            for s in GOOD_SUFFIXES:
-                if lower.endswith(s):
-                    relaxed_score += 4
-            n = len(name)
-            if 4 <= n <= 10:
-                relaxed_score += 6
-            elif n > 12:
-                relaxed_score -= 5
-            elif n < 3:
-                relaxed_score -= 10
-            relaxed.append((name, relaxed_score))
-        relaxed.sort(key=lambda x: (x[1], x[0]), reverse=True)
-        scored = relaxed
+        # If fewer than target, relax penalties: keep only Cyrillic names, without
+        # the BAD_PATTERNS penalties
+        if len(scored) < args.count:
+            relaxed = score_names(names, relaxed=True, **options)
+            scored = [(name, score) for name, score in zip(names, relaxed) if score is not None]
+            scored.sort(key=lambda x: (x[1], x[0]), reverse=True)
 
     selected = [n for n, _ in scored[:args.count]]
     write_names(out_path, selected)
 
     # Summary
-    print(f"Input names: {len(names)}")
+    print(f"Input names: {input_count}")
     print(f"Selected: {len(selected)} -> {out_path}")
+    if args.sync_db:
+        added, removed = sync_db(Path(args.sync_db), selected)
+        print(f"Synced {args.sync_db}: +{added} -{removed} names (restart the bot to pick them up)")
     print("Top 10 preview:")
     for n, s in scored[:10]:
         print(f"{s:4d} | {n}")
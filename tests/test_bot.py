@@ -0,0 +1,75 @@
+import asyncio
+import unittest
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+from bot_app.bot import PairOrderedUpdateProcessor, update_order_keys
+
+
+def tap_update(update_id: int, user_id: int, pair_id: int) -> Update:
+    user = User(id=user_id, first_name="u", is_bot=False)
+    query = CallbackQuery(id=str(update_id), from_user=user, chat_instance="c", data=f"r|{pair_id}|1|1|L")
+    return Update(update_id=update_id, callback_query=query)
+
+
+def command_update(update_id: int, user_id: int) -> Update:
+    user = User(id=user_id, first_name="u", is_bot=False)
+    message = Message(message_id=update_id, date=None, chat=Chat(id=user_id, type="private"), from_user=user, text="/start")
+    return Update(update_id=update_id, message=message)
+
+
+class TestUpdateOrdering(unittest.TestCase):
+    def test_order_keys(self):
+        self.assertEqual(update_order_keys(tap_update(1, 10, 7)), (("user", 10), ("pair", "7")))
+        self.assertEqual(update_order_keys(tap_update(2, 11, 7)), (("user", 11), ("pair", "7")))
+        self.assertEqual(update_order_keys(command_update(3, 10)), (("user", 10),))
+        self.assertEqual(update_order_keys("not an update"), ())
+
+    def test_same_pair_runs_in_order_other_pairs_concurrently(self):
+        processor = PairOrderedUpdateProcessor(max_concurrent_updates=8)
+        events = []
+
+        async def handle(name: str, delay: float):
+            events.append(("start", name))
+            await asyncio.sleep(delay)
+            events.append(("end", name))
+
+        async def scenario():
+            await asyncio.gather(
+                processor.process_update(tap_update(1, 10, 1), handle("p1-a", 0.03)),
+                processor.process_update(tap_update(2, 11, 1), handle("p1-b", 0.0)),
+                processor.process_update(tap_update(3, 20, 2), handle("p2-a", 0.0)),
+            )
+
+        asyncio.run(scenario())
+        # p1-b waits for p1-a even though it is faster; p2 is not blocked by p1
+        self.assertLess(events.index(("end", "p1-a")), events.index(("start", "p1-b")))
+        self.assertLess(events.index(("end", "p2-a")), events.index(("end", "p1-a")))
+        self.assertEqual(processor._locks, {})
+
+    def test_tap_then_command_from_same_user_stay_in_order(self):
+        processor = PairOrderedUpdateProcessor(max_concurrent_updates=8)
+        events = []
+
+        async def handle(name: str, delay: float):
+            events.append(("start", name))
+            await asyncio.sleep(delay)
+            events.append(("end", name))
+
+        async def scenario():
+            await asyncio.gather(
+                processor.process_update(tap_update(1, 10, 1), handle("tap", 0.03)),
+                processor.process_update(command_update(2, 10), handle("start2", 0.0)),
+                processor.process_update(command_update(3, 20), handle("other-user", 0.0)),
+            )
+
+        asyncio.run(scenario())
+        # The command waits for the tap before it; another user's command doesn't
+        self.assertLess(events.index(("end", "tap")), events.index(("start", "start2")))
+        self.assertLess(events.index(("end", "other-user")), events.index(("end", "tap")))
+        self.assertEqual(processor._locks, {})
+        self.assertEqual(processor._users, {})
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -3,7 +3,7 @@ import sqlite3
 from pathlib import Path
 
 from bot_app import config
-from bot_app.db import init_db, add_names
+from bot_app.db import GroupCommitConnection, PrefetchQueue, add_names, get_catalog, init_db, list_catalogs, sync_names
 from bot_app.core import (
     create_or_join_pair,
     get_user_pair,
@@ -12,8 +12,11 @@ from bot_app.core import (
     get_results_for_round,
     start_second_round,
     get_round_progress,
+    answer_and_advance,
+    get_round_step,
 )
-from bot_app.names_loader import load_names
+from bot_app.matchmaking import WaitingQueue
+from bot_app.names_loader import load_catalogs, load_names
 
 
 class TestCoreLogic(unittest.TestCase):
@@ -159,6 +162,253 @@ class TestCoreLogic(unittest.TestCase):
         self.assertEqual(a2b, 1)
         self.assertEqual(t2b, 2)
 
+    def test_next_name_cursor_handles_out_of_order_answers(self):
+        create_or_join_pair(self.conn, 601, "u601", 1601)
+        create_or_join_pair(self.conn, 602, "u602", 1602)
+        pair = get_user_pair(self.conn, 601)
+        ids = [r["id"] for r in self.conn.execute("SELECT id FROM names ORDER BY id LIMIT 3")]
+
+        # Answering the third name first must not skip the first two
+        record_answer(self.conn, pair["id"], 1, 601, ids[2], "like")
+        self.assertEqual(get_next_name_for_round(self.conn, pair["id"], 1, 601)["id"], ids[0])
+        record_answer(self.conn, pair["id"], 1, 601, ids[0], "like")
+        self.assertEqual(get_next_name_for_round(self.conn, pair["id"], 1, 601)["id"], ids[1])
+        record_answer(self.conn, pair["id"], 1, 601, ids[1], "like")
+        nxt = get_next_name_for_round(self.conn, pair["id"], 1, 601)
+        self.assertGreater(nxt["id"], ids[2])
+
+        # The other user's cursor is independent
+        self.assertEqual(get_next_name_for_round(self.conn, pair["id"], 1, 602)["id"], ids[0])
+
+    def test_round2_candidates_are_a_snapshot(self):
+        create_or_join_pair(self.conn, 701, "u701", 1701)
+        create_or_join_pair(self.conn, 702, "u702", 1702)
+        pair = get_user_pair(self.conn, 701)
+        ids = [r["id"] for r in self.conn.execute("SELECT id FROM names ORDER BY id LIMIT 3")]
+
+        record_answer(self.conn, pair["id"], 1, 701, ids[0], "like")
+        record_answer(self.conn, pair["id"], 1, 702, ids[0], "like")
+        # Liked by one user only: never a candidate
+        record_answer(self.conn, pair["id"], 1, 701, ids[1], "like")
+        start_second_round(self.conn, pair["id"])
+        self.assertEqual(get_round_progress(self.conn, pair["id"], 2, 701), (0, 1))
+
+        # Common likes after the start don't join the running round 2, even on a repeated /start2
+        record_answer(self.conn, pair["id"], 1, 702, ids[1], "like")
+        start_second_round(self.conn, pair["id"])
+        self.assertEqual(get_round_progress(self.conn, pair["id"], 2, 702), (0, 1))
+        self.assertEqual(get_next_name_for_round(self.conn, pair["id"], 2, 702)["id"], ids[0])
+        record_answer(self.conn, pair["id"], 2, 702, ids[0], "like")
+        self.assertIsNone(get_next_name_for_round(self.conn, pair["id"], 2, 702))
+
+    def test_second_round_switch_completes_after_an_interrupted_start(self):
+        create_or_join_pair(self.conn, 711, "u711", 1711)
+        create_or_join_pair(self.conn, 712, "u712", 1712)
+        pair = get_user_pair(self.conn, 711)
+        name_id = self.conn.execute("SELECT id FROM names ORDER BY id").fetchone()["id"]
+        record_answer(self.conn, pair["id"], 1, 711, name_id, "like")
+        record_answer(self.conn, pair["id"], 1, 712, name_id, "like")
+        # Snapshot and its size committed, then a crash before the pairs update
+        self.conn.execute("INSERT INTO round2_candidates(pair_id, name_id) VALUES (?, ?)", (pair["id"], name_id))
+        self.conn.execute("INSERT INTO pair_state(pair_id, round2_total) VALUES (?, 1)", (pair["id"],))
+        self.conn.commit()
+        self.assertEqual(get_user_pair(self.conn, 711)["current_round"], 1)
+
+        start_second_round(self.conn, pair["id"])
+        self.assertEqual(get_user_pair(self.conn, 711)["current_round"], 2)
+        self.assertEqual(get_round_progress(self.conn, pair["id"], 2, 711), (0, 1))
+
+    def test_answer_and_advance_matches_separate_calls(self):
+        create_or_join_pair(self.conn, 801, "u801", 1801)
+        create_or_join_pair(self.conn, 802, "u802", 1802)
+        pair = get_user_pair(self.conn, 801)
+
+        first = get_round_step(self.conn, pair["id"], 1, 801)
+        self.assertEqual((first.answered, first.total), (0, 30))
+        step = answer_and_advance(self.conn, pair["id"], 1, 801, first.name_id, "like")
+        self.assertTrue(step.recorded)
+        self.assertEqual((step.answered, step.total), (1, 30))
+        nxt = get_next_name_for_round(self.conn, pair["id"], 1, 801)
+        self.assertEqual((step.name_id, step.name), (nxt["id"], nxt["name"]))
+
+        dup = answer_and_advance(self.conn, pair["id"], 1, 801, first.name_id, "dislike")
+        self.assertFalse(dup.recorded)
+        self.assertEqual(dup.name_id, step.name_id)
+        self.assertFalse(self.conn.in_transaction)
+
+        with self.assertRaises(ValueError):
+            answer_and_advance(self.conn, pair["id"], 1, 801, step.name_id, "maybe")
+
+    def test_progress_counters_backfill_untracked_rows(self):
+        create_or_join_pair(self.conn, 901, "u901", 1901)
+        create_or_join_pair(self.conn, 902, "u902", 1902)
+        pair = get_user_pair(self.conn, 901)
+        for _ in range(3):
+            n = get_next_name_for_round(self.conn, pair["id"], 1, 901)
+            record_answer(self.conn, pair["id"], 1, 901, n["id"], "like")
+        self.assertEqual(get_round_progress(self.conn, pair["id"], 1, 901), (3, 30))
+
+        # Rows from before the counter existed are counted once, then maintained
+        self.conn.execute("UPDATE progress SET answered=NULL")
+        self.assertEqual(get_round_progress(self.conn, pair["id"], 1, 901), (3, 30))
+        n = get_next_name_for_round(self.conn, pair["id"], 1, 901)
+        step = answer_and_advance(self.conn, pair["id"], 1, 901, n["id"], "like")
+        self.assertEqual((step.answered, step.total), (4, 30))
+        row = self.conn.execute("SELECT answered FROM progress WHERE user_id=901").fetchone()
+        self.assertEqual(row["answered"], 4)
+
+    def test_matchmaking_claims_each_pending_pair_once(self):
+        queue = WaitingQueue()
+        p1, _ = create_or_join_pair(self.conn, 11, "a", 1, queue)
+        p2, _ = create_or_join_pair(self.conn, 12, "b", 2)  # without the queue: DB claim
+        self.assertEqual(p1["id"], p2["id"])
+        self.assertEqual(p2["user2_id"], 12)
+
+        # The queue still holds p1, claimed outside of it: that stale entry is skipped
+        p3, _ = create_or_join_pair(self.conn, 13, "c", 3, queue)
+        p4, paired = create_or_join_pair(self.conn, 14, "d", 4, queue)
+        self.assertTrue(paired)
+        self.assertEqual(p4["id"], p3["id"])
+        self.assertEqual((p4["user1_id"], p4["user2_id"]), (13, 14))
+        self.assertEqual(len(queue), 0)
+
+        # Existing members get their own pair back
+        self.assertEqual(create_or_join_pair(self.conn, 11, "a", 1, queue)[0]["id"], p1["id"])
+        self.assertEqual(get_user_pair(self.conn, 14)["id"], p3["id"])
+
+    def test_pairs_rate_the_catalog_they_chose(self):
+        # Overlaps the default catalog in "Ада": one names row, shared
+        add_names(self.conn, ["Ада", "Вера", "Зоя"], catalog="girls", batch_rows=2)
+        girls = get_catalog(self.conn, "girls")
+        self.assertEqual(girls["size"], 3)
+        self.assertEqual([row["name"] for row in list_catalogs(self.conn)], ["default", "girls"])
+        girl_ids = [r[0] for r in self.conn.execute("SELECT name_id FROM catalog_names WHERE catalog_id=? ORDER BY name_id", (girls["id"],))]
+
+        queue = WaitingQueue()
+        default_pair, _ = create_or_join_pair(self.conn, 21, "a", 1, queue)
+        girls_pair, _ = create_or_join_pair(self.conn, 22, "b", 2, queue, girls["id"])
+        self.assertNotEqual(default_pair["id"], girls_pair["id"])
+        pair, paired = create_or_join_pair(self.conn, 23, "c", 3, queue, girls["id"])
+        self.assertTrue(paired)
+        self.assertEqual(pair["id"], girls_pair["id"])
+        self.assertEqual(pair["catalog_id"], girls["id"])
+
+        self.assertEqual(self.rate_all(pair["id"], 22, 23), girl_ids)
+        # Same again with the catalogs served from memory
+        self.conn = self.bot_connection()
+        self.conn.name_catalogs = load_catalogs(self.conn)
+        create_or_join_pair(self.conn, 24, "d", 4, queue, girls["id"])
+        pair, _ = create_or_join_pair(self.conn, 25, "e", 5, queue, girls["id"])
+        self.assertEqual(self.rate_all(pair["id"], 24, 25), girl_ids)
+
+    def test_prefetch_queue_matches_live_selection(self):
+        self.conn = self.bot_connection()
+        self.conn.prefetch = prefetch = PrefetchQueue(size=4)
+        create_or_join_pair(self.conn, 31, "a", 1)
+        pair, _ = create_or_join_pair(self.conn, 32, "b", 2)
+        pair_id = pair["id"]
+
+        def check(step):
+            live = get_next_name_for_round(self.conn, pair_id, 1, 31)
+            self.assertEqual(step.name_id, None if live is None else live["id"])
+            return step
+
+        step = check(get_round_step(self.conn, pair_id, 1, 31))
+        prefetch.run_pending()
+        self.assertEqual(len(prefetch.get(pair_id, 31, 1)), 4)
+        for tap in range(8):
+            step = check(answer_and_advance(self.conn, pair_id, 1, 31, step.name_id, "like"))
+            if tap % 3 == 0:
+                prefetch.run_pending()
+        self.assertGreater(prefetch.hits, 5)
+
+        # Out of order (a queued name further on) and behind core's back (as
+        # another process would): the queue never serves a rated name
+        queue = prefetch.get(pair_id, 31, 1)
+        record_answer(self.conn, pair_id, 1, 31, queue[2][0], "dislike")
+        check(get_round_step(self.conn, pair_id, 1, 31))
+        rated_elsewhere = prefetch.get(pair_id, 31, 1)[0][0]
+        self.conn.execute("INSERT INTO ratings(pair_id, user_id, round, name_id, answer) VALUES (?, 31, 1, ?, 0)", (pair_id, rated_elsewhere))
+        step = answer_and_advance(self.conn, pair_id, 1, 31, rated_elsewhere, "like")
+        self.assertFalse(step.recorded)
+        self.assertIsNone(prefetch.get(pair_id, 31, 1))
+        check(step)
+
+        start_second_round(self.conn, pair_id)
+        self.assertEqual(len(prefetch), 0)
+        self.assertFalse(prefetch.pending)
+
+    def bot_connection(self):
+        """A copy of the test DB on the bot's connection class, which can carry name_catalogs and prefetch."""
+        conn = sqlite3.connect(":memory:", factory=GroupCommitConnection)
+        conn.row_factory = sqlite3.Row
+        self.conn.backup(conn)
+        self.conn.close()
+        return conn
+
+    def rate_all(self, pair_id, user_id, partner_id):
+        """Like every name user_id is shown in round 1; partner likes all but the first."""
+        seen = []
+        step = get_round_step(self.conn, pair_id, 1, user_id)
+        while step.name_id is not None:
+            seen.append(step.name_id)
+            step = answer_and_advance(self.conn, pair_id, 1, user_id, step.name_id, "like")
+        self.assertEqual((step.answered, step.total), (3, 3))
+        for name_id in seen[1:]:
+            record_answer(self.conn, pair_id, 1, partner_id, name_id, "like")
+        self.assertEqual(get_results_for_round(self.conn, pair_id, 1), ["Вера", "Зоя"])
+        return seen
+
+    def test_existing_name_added_to_a_rated_catalog_is_shown(self):
+        add_names(self.conn, ["Вера", "Зоя", "Яна"], catalog="x")
+        pair, _ = create_or_join_pair(self.conn, 41, "a", 1, catalog_id=get_catalog(self.conn, "x")["id"])
+        pair, _ = create_or_join_pair(self.conn, 42, "b", 2, catalog_id=pair["catalog_id"])
+        step = get_round_step(self.conn, pair["id"], 1, 41)
+        while step.name_id is not None:
+            step = answer_and_advance(self.conn, pair["id"], 1, 41, step.name_id, "like")
+        self.assertEqual((step.answered, step.total), (3, 3))
+
+        # The default catalog's first name already exists: it joins with its old, lower id
+        first = self.conn.execute("SELECT id, name FROM names ORDER BY id").fetchone()
+        self.assertEqual(add_names(self.conn, [first["name"], "Жора"], catalog="x"), 2)
+        step = get_round_step(self.conn, pair["id"], 1, 41)
+        self.assertEqual((step.name_id, step.answered, step.total), (first["id"], 3, 5))
+        step = answer_and_advance(self.conn, pair["id"], 1, 41, step.name_id, "like")
+        self.assertEqual((step.name, step.answered), ("Жора", 4))
+        step = answer_and_advance(self.conn, pair["id"], 1, 41, step.name_id, "like")
+        self.assertEqual((step.name_id, step.answered, step.total), (None, 5, 5))
+
+    def test_results_skip_removed_names_with_and_without_loaded_catalogs(self):
+        shared = [r["name"] for r in self.conn.execute("SELECT name FROM names ORDER BY id LIMIT 2")]
+        add_names(self.conn, shared + ["Яна"], catalog="x")
+        catalog_id = get_catalog(self.conn, "x")["id"]
+        create_or_join_pair(self.conn, 51, "a", 1, catalog_id=catalog_id)
+        pair, _ = create_or_join_pair(self.conn, 52, "b", 2, catalog_id=catalog_id)
+        for name_id, in self.conn.execute("SELECT name_id FROM catalog_names WHERE catalog_id=?", (catalog_id,)).fetchall():
+            record_answer(self.conn, pair["id"], 1, 51, name_id, "like")
+            record_answer(self.conn, pair["id"], 1, 52, name_id, "like")
+        # Leaves "x" but stays in names: it is still in the default catalog
+        sync_names(self.conn, shared[1:] + ["Яна"], catalog="x")
+
+        from_sql = get_results_for_round(self.conn, pair["id"], 1)
+        self.conn = self.bot_connection()
+        self.conn.name_catalogs = load_catalogs(self.conn)
+        self.assertEqual(get_results_for_round(self.conn, pair["id"], 1), from_sql)
+        self.assertEqual(sorted(from_sql), sorted([shared[1], "Яна"]))
+
+    def test_new_catalog_is_offered_once_imported(self):
+        def names():
+            for i in range(5):
+                if i == 3:
+                    # Earlier batches are committed, but the catalog isn't listed yet
+                    self.assertIsNone(get_catalog(self.conn, "big")["size"])
+                    self.assertNotIn("big", [row["name"] for row in list_catalogs(self.conn)])
+                yield f"Name{i}"
+
+        self.assertEqual(add_names(self.conn, names(), catalog="big", batch_rows=2), 5)
+        self.assertEqual(get_catalog(self.conn, "big")["size"], 5)
+        self.assertEqual(get_catalog(self.conn, "default")["size"], 30)
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
\ No newline at end of file
@@ -0,0 +1,438 @@
+import asyncio
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from bench.ratings_schema_bench import create_legacy_ratings
+from bot_app.config import DEFAULT_CATALOG_ID
+from bot_app import async_core, core
+from bot_app.db import (
+    SCHEMA_VERSION,
+    Database,
+    ShardedDatabase,
+    UserCache,
+    add_names,
+    create_database,
+    ensure_user,
+    get_connection,
+    get_user_chat_id,
+    init_db,
+    shard_connections,
+    shard_index,
+    sync_names,
+)
+
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database(str(Path(self.tmp.name) / "test.db"))
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_open_runs_schema_and_pragmas_once(self):
+        conn = self.db.open()
+        self.assertIs(self.db.open(), conn)
+        self.assertIs(self.db.conn, conn)
+        mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+        tables = {r["name"] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        self.assertTrue({"names", "users", "pairs", "ratings"} <= tables)
+
+    def test_run_executes_on_db_thread(self):
+        self.db.open()
+
+        def probe(conn, value):
+            conn.execute("INSERT INTO names(name) VALUES (?)", (value,))
+            conn.commit()
+            return threading.current_thread().name
+
+        thread_name = asyncio.run(self.db.run(probe, "Иван"))
+        self.assertNotEqual(thread_name, threading.current_thread().name)
+        self.assertTrue(thread_name.startswith("db"))
+        self.assertEqual(self.db.conn.execute("SELECT name FROM names").fetchone()["name"], "Иван")
+
+    def test_prefetch_refills_run_after_the_call(self):
+        conn = self.db.open()
+        add_names(conn, [f"Name{i}" for i in range(40)])
+
+        async def scenario():
+            await async_core.create_or_join_pair(self.db, 1, None, 1)
+            pair, _ = await async_core.create_or_join_pair(self.db, 2, None, 2)
+            step = await async_core.get_round_step(self.db, pair["id"], 1, 1)
+            # Queued behind the call: not there yet when its result arrives
+            self.assertIsNone(conn.prefetch.get(pair["id"], 1, 1))
+            shown = []
+            while step.name_id is not None:
+                shown.append(step.name_id)
+                step = await async_core.answer_and_advance(self.db, pair["id"], 1, 1, step.name_id, "neutral")
+            return shown
+
+        shown = asyncio.run(scenario())
+        self.assertEqual(shown, [r["id"] for r in conn.execute("SELECT id FROM names ORDER BY id")])
+        stats = conn.prefetch.stats()
+        self.assertEqual(stats["hits"] + stats["misses"], 41)
+        # One live selection per refill at most, plus the empty end of the round
+        self.assertLessEqual(stats["misses"], stats["refills"] + 1)
+        self.assertGreater(stats["hits"], 30)
+
+    def test_group_commit_buffers_until_row_limit(self):
+        db = Database(self.db.db_path, commit_window_ms=0, commit_rows=3)
+        conn = db.open()
+        other = get_connection(db.db_path)
+        try:
+            for name in ("Иван", "Пётр"):
+                conn.execute("INSERT INTO names(name) VALUES (?)", (name,))
+                conn.commit()
+            # Buffered: visible on the writing connection only
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM names").fetchone()[0], 2)
+            self.assertEqual(other.execute("SELECT COUNT(*) FROM names").fetchone()[0], 0)
+            conn.execute("INSERT INTO names(name) VALUES (?)", ("Ян",))
+            conn.commit()
+            self.assertEqual(other.execute("SELECT COUNT(*) FROM names").fetchone()[0], 3)
+
+            conn.execute("INSERT INTO names(name) VALUES (?)", ("Лев",))
+            conn.commit()
+            db.close()
+            self.assertEqual(other.execute("SELECT COUNT(*) FROM names").fetchone()[0], 4)
+        finally:
+            other.close()
+            db.close()
+
+    def test_group_commit_flushes_after_window(self):
+        db = Database(self.db.db_path, commit_window_ms=20, commit_rows=0)
+        db.open()
+        other = get_connection(db.db_path)
+
+        def insert(conn, name):
+            conn.execute("INSERT INTO names(name) VALUES (?)", (name,))
+            conn.commit()
+
+        async def scenario():
+            await db.run(insert, "Иван")
+            before = other.execute("SELECT COUNT(*) FROM names").fetchone()[0]
+            await asyncio.sleep(0.1)
+            return before
+
+        try:
+            before = asyncio.run(scenario())
+            self.assertEqual(before, 0)
+            self.assertEqual(other.execute("SELECT COUNT(*) FROM names").fetchone()[0], 1)
+        finally:
+            other.close()
+            db.close()
+
+    def test_row_limit_alone_still_flushes_after_a_window(self):
+        db = Database(self.db.db_path, commit_window_ms=0, commit_rows=100)
+        self.assertGreater(db.commit_window_ms, 0)
+        db.open()
+        other = get_connection(db.db_path)
+
+        def insert(conn, name):
+            conn.execute("INSERT INTO names(name) VALUES (?)", (name,))
+            conn.commit()
+
+        async def scenario():
+            await db.run(insert, "Иван")
+            await asyncio.sleep(db.commit_window_ms / 1000 + 0.1)
+
+        try:
+            asyncio.run(scenario())
+            self.assertEqual(other.execute("SELECT COUNT(*) FROM names").fetchone()[0], 1)
+        finally:
+            other.close()
+            db.close()
+
+    def test_user_cache_skips_unchanged_writes(self):
+        conn = self.db.open()
+        ensure_user(conn, 1, "alice", 100)
+        changes = conn.total_changes
+        ensure_user(conn, 1, "alice", 100)
+        ensure_user(conn, 1, None, None)
+        self.assertEqual(conn.total_changes, changes)
+
+        ensure_user(conn, 1, None, 101)
+        self.assertEqual(conn.total_changes, changes + 1)
+        row = conn.execute("SELECT username, chat_id FROM users WHERE user_id=1").fetchone()
+        self.assertEqual((row["username"], row["chat_id"]), ("alice", 101))
+
+        hits = conn.user_cache.hits
+        self.assertEqual(get_user_chat_id(conn, 1), 101)
+        self.assertEqual(conn.user_cache.hits, hits + 1)
+        self.assertIsNone(get_user_chat_id(conn, 2))
+
+    def test_user_cache_evicts_least_recently_used(self):
+        cache = UserCache(max_size=2)
+        cache.put(1, "a", 10)
+        cache.put(2, "b", 20)
+        cache.get(1)
+        cache.put(3, "c", 30)
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), ("a", 10))
+        self.assertEqual(cache.stats(), {"size": 2, "hits": 2, "misses": 1})
+
+    def test_conn_requires_open(self):
+        with self.assertRaises(RuntimeError):
+            self.db.conn
+        self.db.open()
+        self.db.close()
+        with self.assertRaises(RuntimeError):
+            self.db.conn
+
+
+class TestSyncNames(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database(str(Path(self.tmp.name) / "test.db"))
+        self.conn = self.db.open()
+        add_names(self.conn, ["Ada", "Bo", "Cy"])
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def names(self):
+        return {r["name"]: r["id"] for r in self.conn.execute("SELECT id, name FROM names")}
+
+    def test_applies_only_the_difference(self):
+        before = self.names()
+        core.create_or_join_pair(self.conn, 1, None, 1)
+        core.create_or_join_pair(self.conn, 2, None, 2)
+        pair = core.get_user_pair(self.conn, 1)
+        core.record_answer(self.conn, pair["id"], 1, 1, before["Bo"], "like")
+
+        self.assertEqual(sync_names(self.conn, [" Cy", "Bo", "Dee", "Dee", ""]), (1, 1))
+        after = self.names()
+        self.assertEqual(set(after), {"Bo", "Cy", "Dee"})
+        self.assertEqual((after["Bo"], after["Cy"]), (before["Bo"], before["Cy"]))
+        # Deleted ids are never reused
+        self.assertGreater(after["Dee"], max(before.values()))
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM ratings").fetchone()[0], 1)
+        self.assertEqual(self.conn.execute("SELECT size FROM catalogs WHERE id=?", (DEFAULT_CATALOG_ID,)).fetchone()[0], 3)
+
+        self.assertEqual(sync_names(self.conn, ["Eve"], remove=False), (1, 0))
+        self.assertEqual(sync_names(self.conn, ["Bo", "Cy", "Dee", "Eve"]), (0, 0))
+
+    def test_removed_names_leave_progress_and_round_two(self):
+        ids = self.names()
+        core.create_or_join_pair(self.conn, 1, None, 1)
+        core.create_or_join_pair(self.conn, 2, None, 2)
+        pair_id = core.get_user_pair(self.conn, 1)["id"]
+        for user_id in (1, 2):
+            core.record_answer(self.conn, pair_id, 1, user_id, ids["Ada"], "like")
+            core.record_answer(self.conn, pair_id, 1, user_id, ids["Bo"], "like")
+        core.start_second_round(self.conn, pair_id)
+        core.record_answer(self.conn, pair_id, 2, 1, ids["Ada"], "like")
+        self.assertEqual(core.get_round_progress(self.conn, pair_id, 1, 1), (2, 3))
+        self.assertEqual(core.get_round_progress(self.conn, pair_id, 2, 1), (1, 2))
+
+        self.assertEqual(sync_names(self.conn, ["Bo", "Cy"]), (0, 1))
+        self.assertEqual(core.get_round_progress(self.conn, pair_id, 1, 1), (1, 2))
+        self.assertEqual(core.get_round_progress(self.conn, pair_id, 2, 1), (0, 1))
+        self.assertEqual(core.get_round_step(self.conn, pair_id, 2, 1).name, "Bo")
+
+    def test_start_two_ignores_likes_of_removed_names(self):
+        ids = self.names()
+        core.create_or_join_pair(self.conn, 1, None, 1)
+        core.create_or_join_pair(self.conn, 2, None, 2)
+        pair_id = core.get_user_pair(self.conn, 1)["id"]
+        for user_id in (1, 2):
+            core.record_answer(self.conn, pair_id, 1, user_id, ids["Ada"], "like")
+        sync_names(self.conn, ["Bo", "Cy"])
+        core.start_second_round(self.conn, pair_id)
+        self.assertEqual(core.get_round_progress(self.conn, pair_id, 2, 1), (0, 0))
+
+
+class TestCatalogUpgrade(unittest.TestCase):
+    def test_names_from_before_catalogs_form_the_default_one(self):
+        conn = get_connection(":memory:")
+        conn.execute("CREATE TABLE names (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE)")
+        conn.execute("CREATE TABLE pairs (id INTEGER PRIMARY KEY AUTOINCREMENT, user1_id INTEGER NOT NULL, user2_id INTEGER)")
+        conn.executemany("INSERT INTO names(name) VALUES (?)", [("Ada",), ("Bo",)])
+        conn.execute("INSERT INTO pairs(user1_id, user2_id) VALUES (1, 2)")
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value INTEGER)")
+        conn.commit()
+        init_db(conn)
+        init_db(conn)  # and only once
+        self.assertIsNone(conn.execute("SELECT 1 FROM sqlite_master WHERE name='meta'").fetchone())
+        members = conn.execute("SELECT catalog_id, name_id FROM catalog_names ORDER BY name_id").fetchall()
+        self.assertEqual([tuple(row) for row in members], [(DEFAULT_CATALOG_ID, 1), (DEFAULT_CATALOG_ID, 2)])
+        self.assertEqual(conn.execute("SELECT size FROM catalogs").fetchall()[0][0], 2)
+        self.assertEqual(conn.execute("SELECT catalog_id FROM pairs").fetchone()[0], DEFAULT_CATALOG_ID)
+        conn.close()
+
+    def test_round2_totals_move_out_of_pairs(self):
+        conn = get_connection(":memory:")
+        conn.execute(
+            "CREATE TABLE pairs (id INTEGER PRIMARY KEY AUTOINCREMENT, user1_id INTEGER NOT NULL, user2_id INTEGER,"
+            " current_round INTEGER NOT NULL DEFAULT 1, started_2 INTEGER NOT NULL DEFAULT 0, round2_total INTEGER)"
+        )
+        conn.execute("INSERT INTO pairs(user1_id, user2_id, current_round, started_2, round2_total) VALUES (1, 2, 2, 1, 3)")
+        conn.execute("INSERT INTO pairs(user1_id, user2_id) VALUES (3, 4)")
+        conn.commit()
+        init_db(conn)
+        init_db(conn)
+        self.assertEqual([tuple(row) for row in conn.execute("SELECT * FROM pair_state")], [(1, 3)])
+        self.assertEqual(core.get_round_progress(conn, 1, 2, 1), (0, 3))
+        conn.close()
+
+
+class TestShardedDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = ShardedDatabase(str(Path(self.tmp.name) / "test.db"), shards=3)
+        conn = self.db.open()
+        add_names(conn, ["Ada", "Bo", "Cy"])
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_pairs_are_routed_to_their_shard(self):
+        async def scenario():
+            pair_ids = []
+            for user_id in range(1, 9, 2):
+                await async_core.create_or_join_pair(self.db, user_id, None, user_id)
+                pair, _ = await async_core.create_or_join_pair(self.db, user_id + 1, None, user_id + 1)
+                pair_ids.append(pair["id"])
+                for uid in (user_id, user_id + 1):
+                    step = await async_core.get_round_step(self.db, pair["id"], 1, uid)
+                    await async_core.answer_and_advance(self.db, pair["id"], 1, uid, step.name_id, "like")
+            results = [await async_core.get_results_for_round(self.db, pair_id, 1) for pair_id in pair_ids]
+            await async_core.start_second_round(self.db, pair_ids[0])
+            progress = await async_core.get_round_progress(self.db, pair_ids[0], 2, 1)
+            return pair_ids, results, progress
+
+        pair_ids, results, progress = asyncio.run(scenario())
+        self.assertEqual(results, [["Ada"]] * 4)
+        self.assertEqual(progress, (0, 1))
+        # The common file holds no ratings; each shard only its own pairs'
+        common_tables = {r[0] for r in self.db.conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        self.assertNotIn("ratings", common_tables)
+        for index, shard in enumerate(self.db.shards):
+            stored = {r[0] for r in shard.conn.execute("SELECT DISTINCT pair_id FROM main.ratings")}
+            self.assertEqual(stored, {p for p in pair_ids if shard_index(p, 3) == index})
+            self.assertTrue(Path(shard.db_path).name.startswith(f"test.shard{index}"))
+        # start_second_round switched the pair in the common file; the snapshot
+        # and its size stay in the pair's shard
+        row = self.db.conn.execute("SELECT current_round FROM pairs WHERE id=?", (pair_ids[0],)).fetchone()
+        self.assertEqual(row["current_round"], 2)
+        shard = self.db.shards[shard_index(pair_ids[0], 3)]
+        row = shard.conn.execute("SELECT round2_total FROM main.pair_state WHERE pair_id=?", (pair_ids[0],)).fetchone()
+        self.assertEqual(row["round2_total"], 1)
+        self.assertNotIn("pair_state", common_tables)
+
+    def test_removed_names_leave_progress_in_the_shards(self):
+        async def scenario():
+            await async_core.create_or_join_pair(self.db, 1, None, 1)
+            pair, _ = await async_core.create_or_join_pair(self.db, 2, None, 2)
+            for _ in range(2):
+                step = await async_core.get_round_step(self.db, pair["id"], 1, 1)
+                await async_core.answer_and_advance(self.db, pair["id"], 1, 1, step.name_id, "neutral")
+            with self.assertRaises(ValueError):
+                # The common file alone can't reach the shard's progress rows
+                sync_names(self.db.conn, ["Bo", "Cy"])
+            self.assertEqual(sync_names(self.db.conn, ["Bo", "Cy"], shards=shard_connections(self.db)), (0, 1))
+            return await async_core.get_round_step(self.db, pair["id"], 1, 1)
+
+        step = asyncio.run(scenario())
+        self.assertEqual((step.name, step.answered, step.total), ("Cy", 1, 2))
+
+    def test_names_added_to_a_rated_catalog_reach_the_shards(self):
+        add_names(self.db.conn, ["Bo", "Cy"], catalog="x")
+        catalog_id = self.db.conn.execute("SELECT id FROM catalogs WHERE name='x'").fetchone()[0]
+
+        async def rate_all(pair_id):
+            step = await async_core.get_round_step(self.db, pair_id, 1, 1)
+            while step.name_id is not None:
+                step = await async_core.answer_and_advance(self.db, pair_id, 1, 1, step.name_id, "neutral")
+            return step
+
+        async def scenario():
+            await async_core.create_or_join_pair(self.db, 1, None, 1, catalog_id=catalog_id)
+            pair, _ = await async_core.create_or_join_pair(self.db, 2, None, 2, catalog_id=catalog_id)
+            step = await async_core.get_round_step(self.db, pair["id"], 1, 1)
+            # Answering "Bo" leaves "Cy" queued in the shard's prefetch
+            await async_core.answer_and_advance(self.db, pair["id"], 1, 1, step.name_id, "neutral")
+            # "Ada" joins with its old id, behind the pair's cursor
+            add_names(self.db.conn, ["Ada", "Zed"], catalog="x", shards=shard_connections(self.db))
+            step = await async_core.get_round_step(self.db, pair["id"], 1, 1)
+            return step, await rate_all(pair["id"])
+
+        step, finished = asyncio.run(scenario())
+        self.assertEqual((step.name, step.answered, step.total), ("Ada", 1, 4))
+        self.assertEqual((finished.answered, finished.total), (4, 4))
+
+    def test_group_commit_is_rejected(self):
+        with self.assertRaises(ValueError):
+            create_database(str(Path(self.tmp.name) / "other.db"), shards=2, commit_rows=10)
+
+
+class TestRatingsMigration(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = str(Path(self.tmp.name) / "old.db")
+        # Ratings written before schema version 2
+        self.old_answers = [(1, 1, 1, name_id, "like" if name_id % 2 else "dislike") for name_id in range(1, 8)]
+        self.old_answers += [(1, 1, 2, name_id, "like") for name_id in range(1, 4)]
+        conn = get_connection(self.path)
+        create_legacy_ratings(conn)
+        conn.executemany("INSERT INTO ratings(pair_id, round, user_id, name_id, answer) VALUES (?, ?, ?, ?, ?)", self.old_answers)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def seed(self, conn):
+        add_names(conn, [f"Name{i}" for i in range(1, 11)])
+        core.create_or_join_pair(conn, 1, "a", 1)
+        core.create_or_join_pair(conn, 2, "b", 2)
+
+    def assert_migrated(self, conn):
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], SCHEMA_VERSION)
+        sql = conn.execute("SELECT sql FROM sqlite_master WHERE name='ratings'").fetchone()[0]
+        self.assertIn("WITHOUT ROWID", sql)
+        # The clustered primary key is the table itself: no separate indexes
+        self.assertIsNone(conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND tbl_name='ratings'").fetchone())
+        self.assertIsNone(conn.execute("SELECT 1 FROM sqlite_master WHERE name='ratings_v2'").fetchone())
+
+    def test_init_db_migrates_right_away(self):
+        conn = get_connection(self.path)
+        init_db(conn)
+        self.assert_migrated(conn)
+        self.seed(conn)
+        rows = conn.execute("SELECT pair_id, round, user_id, name_id, answer FROM ratings ORDER BY user_id, name_id").fetchall()
+        self.assertEqual([tuple(r) for r in rows], [a[:4] + ({"like": 1, "dislike": 2}[a[4]],) for a in self.old_answers])
+        self.assertEqual(core.get_results_for_round(conn, 1, 1), ["Name1", "Name3"])
+        conn.close()
+
+    def test_database_migrates_online(self):
+        db = Database(self.path)
+        conn = db.open()
+        self.assertTrue(conn.legacy_ratings)
+        self.seed(conn)
+
+        async def scenario():
+            migration = asyncio.ensure_future(db.migrate(batch_rows=3))
+            # Answers keep arriving while batches are copied
+            for name_id in range(4, 8):
+                await db.run(core.record_answer, 1, 1, 2, name_id, "like")
+            self.assertTrue(await migration)
+            await db.run(core.record_answer, 1, 1, 2, 8, "neutral")
+            self.assertFalse(await db.migrate())
+            return await db.run(core.get_results_for_round, 1, 1)
+
+        try:
+            self.assertEqual(asyncio.run(scenario()), ["Name1", "Name3", "Name5", "Name7"])
+            self.assertFalse(conn.legacy_ratings)
+            self.assert_migrated(conn)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM ratings").fetchone()[0], len(self.old_answers) + 5)
+        finally:
+            db.close()
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,92 @@
+import gzip
+import random
+import re
+import tempfile
+import unittest
+from pathlib import Path
+
+import filter_names
+from bot_app.config import BASE_DIR
+from filter_names import (
+    BAD_PATTERNS,
+    CYRILLIC_FULL,
+    ENGINE,
+    ScoreEngine,
+    iter_names,
+    read_unique_names,
+    score_name,
+    score_names,
+    top_names,
+)
+
+
+def fuzz_names(count, seed=0):
+    rnd = random.Random(seed)
+    letters = "АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯІЎабвгдеёжзийклмнопрстуфхцчшщъыьэюяіўAbz-' \n"
+    endings = ["ман", "бек", "бай", "хан", "ио", "ь", "слав", "иль", "вей", "ган", "дж", "ман\n", "ий\n"]
+    names = []
+    for _ in range(count):
+        name = "".join(rnd.choice(letters) for _ in range(rnd.randint(0, 14)))
+        if rnd.random() < 0.5:
+            name = name.capitalize() + rnd.choice(endings)
+        names.append(name)
+    return names
+
+
+class TestScoreEngine(unittest.TestCase):
+    def setUp(self):
+        self.names = read_unique_names(BASE_DIR / "names.txt") + sorted(filter_names.CORE) + fuzz_names(5000)
+
+    def test_scores_match_reference(self):
+        for name in self.names:
+            self.assertEqual(ENGINE.score(name), score_name(name), repr(name))
+
+    def test_relaxed_scores_skip_bad_patterns(self):
+        for name in self.names:
+            expected = None
+            if CYRILLIC_FULL.match(name):
+                expected = score_name(name) + 40 * sum(1 for pat in BAD_PATTERNS if re.search(pat, name))
+            self.assertEqual(ENGINE.score(name, relaxed=True), expected, repr(name))
+
+    def test_process_pool_keeps_order(self):
+        self.assertEqual(score_names(self.names, workers=2, chunk_size=1000), [score_name(name) for name in self.names])
+
+    def test_rules_are_compiled_by_shape(self):
+        engine = ScoreEngine(bad_patterns=[r"ман$", r"\-", r"дж", r"[0-9]"])
+        self.assertEqual(engine.bad_substrings, ["-", "дж"])
+        self.assertEqual([regex.pattern for regex in engine.bad_regexes], [r"[0-9]"])
+        self.assertEqual(engine.score("Локман") - ENGINE.score("Локман", relaxed=True), -40)
+
+
+class TestStreamingSelection(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(3)
+        unique = read_unique_names(BASE_DIR / "names.txt")[:3000] + fuzz_names(1000, seed=4)
+        # Every name several times, shuffled, so repeats arrive after evictions
+        self.stream = [name.strip() for name in unique * 3 if name.strip()]
+        rnd.shuffle(self.stream)
+
+    def full_sort(self, relaxed=False):
+        names = list(dict.fromkeys(self.stream))
+        scored = [(name, ENGINE.score(name, relaxed)) for name in names]
+        return sorted([item for item in scored if item[1] is not None], key=lambda x: (x[1], x[0]), reverse=True)
+
+    def test_top_k_matches_full_sort(self):
+        expected = self.full_sort()
+        for count in (1, 10, 1000, len(expected) + 5):
+            self.assertEqual(top_names(self.stream, count, chunk_size=700), expected[:count])
+        self.assertEqual(top_names(self.stream, 50, relaxed=True, workers=2, chunk_size=500), self.full_sort(relaxed=True)[:50])
+
+    def test_reads_plain_and_gzipped_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            plain = Path(tmp) / "names.txt"
+            plain.write_text("Иван\n\n  Пётр \nИван\n", encoding="utf-8")
+            packed = Path(tmp) / "names.txt.gz"
+            packed.write_bytes(gzip.compress(plain.read_bytes()))
+            for path in (plain, packed):
+                self.assertEqual(list(iter_names(path)), ["Иван", "Пётр", "Иван"])
+                self.assertEqual(read_unique_names(path), ["Иван", "Пётр"])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
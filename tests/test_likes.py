@@ -0,0 +1,101 @@
+import random
+import sqlite3
+import unittest
+
+from bot_app.core import create_or_join_pair, get_results_for_round, record_answer, start_second_round
+from bot_app.db import GroupCommitConnection, ResultCache, add_names, get_connection, init_db
+from bot_app.likes import CHUNK_BITS, common_likes
+
+# The results query the bitmaps replace (answer 1: like)
+LEGACY_RESULTS_SQL = """
+    SELECT DISTINCT n.name
+    FROM names n
+    JOIN ratings r1 ON r1.name_id = n.id AND r1.pair_id = ? AND r1.round = ? AND r1.answer = 1 AND r1.user_id = (SELECT user1_id FROM pairs WHERE id = ?)
+    JOIN ratings r2 ON r2.name_id = n.id AND r2.pair_id = ? AND r2.round = ? AND r2.answer = 1 AND r2.user_id = (SELECT user2_id FROM pairs WHERE id = ?)
+    ORDER BY n.name COLLATE NOCASE ASC
+"""
+
+
+class TestLikeBitmaps(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.row_factory = sqlite3.Row
+        init_db(self.conn)
+        # Ids past CHUNK_BITS so bitmaps span two chunks; mixed case for the NOCASE order
+        names = [f"{'ab'[i % 2]}{'XYxy'[i % 4]}name{i}" for i in range(CHUNK_BITS + 300)]
+        add_names(self.conn, names)
+        create_or_join_pair(self.conn, 1, "a", 10)
+        create_or_join_pair(self.conn, 2, "b", 20)
+        self.pair_id = 1
+        rnd = random.Random(7)
+        for name_id in rnd.sample(range(1, CHUNK_BITS + 300), 900):
+            for user_id in (1, 2):
+                record_answer(self.conn, self.pair_id, 1, user_id, name_id, rnd.choice(["like", "like", "dislike", "neutral"]))
+
+    def legacy_results(self, round_num):
+        args = (self.pair_id, round_num, self.pair_id) * 2
+        return [row["name"] for row in self.conn.execute(LEGACY_RESULTS_SQL, args)]
+
+    def test_results_match_ratings_join(self):
+        expected = self.legacy_results(1)
+        self.assertGreater(len(expected), 100)
+        self.assertEqual(get_results_for_round(self.conn, self.pair_id, 1), expected)
+
+        start_second_round(self.conn, self.pair_id)
+        candidates = [row[0] for row in self.conn.execute("SELECT name_id FROM round2_candidates ORDER BY name_id")]
+        self.assertEqual(candidates, common_likes(self.conn.cursor(), self.pair_id, 1, 1, 2))
+        for name_id in candidates[:50]:
+            record_answer(self.conn, self.pair_id, 2, 1, name_id, "like")
+            record_answer(self.conn, self.pair_id, 2, 2, name_id, "like" if name_id % 3 else "dislike")
+        self.assertEqual(get_results_for_round(self.conn, self.pair_id, 2), self.legacy_results(2))
+
+    def test_bitmaps_are_rebuilt_for_older_databases(self):
+        expected = self.legacy_results(1)
+        # A DB from before the bitmaps: ratings only
+        self.conn.execute("DROP TABLE like_bitmaps")
+        self.conn.commit()
+        init_db(self.conn)
+        self.assertEqual(get_results_for_round(self.conn, self.pair_id, 1), expected)
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.conn = get_connection(":memory:", factory=GroupCommitConnection)
+        self.conn.result_cache = ResultCache(max_size=2)
+        init_db(self.conn)
+        add_names(self.conn, ["bea", "Ada", "Cy", "dan"])
+        create_or_join_pair(self.conn, 1, "a", 10)
+        create_or_join_pair(self.conn, 2, "b", 20)
+        for user_id in (1, 2):
+            record_answer(self.conn, 1, 1, user_id, 1, "like")
+
+    def test_repeated_results_skip_sqlite_and_follow_new_likes(self):
+        self.assertEqual(get_results_for_round(self.conn, 1, 1), ["bea"])
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        self.assertEqual(get_results_for_round(self.conn, 1, 1), ["bea"])
+        self.assertEqual(statements, [])
+        self.conn.set_trace_callback(None)
+
+        # A one-sided like keeps the cached list; a mutual one is added in order
+        record_answer(self.conn, 1, 1, 1, 2, "like")
+        self.assertEqual(get_results_for_round(self.conn, 1, 1), ["bea"])
+        record_answer(self.conn, 1, 1, 2, 2, "like")
+        record_answer(self.conn, 1, 1, 2, 4, "like")
+        record_answer(self.conn, 1, 1, 1, 4, "like")
+        self.assertEqual(get_results_for_round(self.conn, 1, 1), ["Ada", "bea", "dan"])
+        self.assertEqual(self.conn.result_cache.misses, 1)
+
+    def test_lru_eviction(self):
+        cache = ResultCache(max_size=2)
+        cache.put(1, 1, ["a"])
+        cache.put(1, 2, ["b"])
+        cache.get(1, 1)
+        cache.put(2, 1, ["c"])
+        self.assertIn((1, 1), cache)
+        self.assertNotIn((1, 2), cache)
+        self.assertEqual(len(cache), 2)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,95 @@
+import asyncio
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from bot_app import core
+from bot_app.db import Database, add_names
+from bot_app.metrics import Metrics, instrument_handler, metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self._enabled = metrics.enabled
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.enabled = self._enabled
+        metrics.reset()
+
+    def test_render_prometheus_text(self):
+        registry = Metrics(enabled=True)
+        registry.inc("db_commits_total")
+        registry.inc("db_commits_total", 2)
+        for ms in (1, 2, 3, 4):
+            registry.observe("handler_seconds", ms / 1000, handler="rate")
+        text = registry.render()
+        self.assertIn("# TYPE db_commits_total counter\ndb_commits_total 3\n", text)
+        self.assertIn("# TYPE handler_seconds summary", text)
+        self.assertIn('handler_seconds{handler="rate",quantile="0.5"} 0.003000', text)
+        self.assertIn('handler_seconds_count{handler="rate"} 4', text)
+        self.assertIn('handler_seconds_sum{handler="rate"} 0.010000', text)
+
+    def test_updates_from_several_threads_are_not_lost(self):
+        registry = Metrics(enabled=True)
+
+        def work():
+            for _ in range(20000):
+                registry.inc("db_rows_written_total")
+                registry.count_statement("SELECT 1")
+                registry.observe("db_call_seconds", 0.001, function="answer_and_advance")
+
+        # Switch threads as often as possible so unguarded updates would collide
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=work) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(registry.counter("db_rows_written_total"), 80000)
+        self.assertEqual(registry.counter("db_statements_total", function="other"), 80000)
+        self.assertEqual(registry.summary("db_call_seconds", function="answer_and_advance").count, 80000)
+
+    def test_disabled_handlers_are_not_wrapped(self):
+        async def handler(update, context):
+            return "ok"
+
+        metrics.enabled = False
+        self.assertIs(instrument_handler("start", handler), handler)
+
+        metrics.enabled = True
+        timed = instrument_handler("start", handler)
+        self.assertEqual(asyncio.run(timed(None, None)), "ok")
+        self.assertEqual(metrics.summary("handler_seconds", handler="start").count, 1)
+
+    def test_db_calls_statements_and_commits(self):
+        metrics.enabled = True
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(str(Path(tmp) / "t.db"))
+            conn = db.open()
+            add_names(conn, ["Ada", "Bo"])
+            metrics.reset()
+
+            async def scenario():
+                await db.run(core.create_or_join_pair, 1, "a", 10)
+                await db.run(core.get_user_pair, 1)
+
+            asyncio.run(scenario())
+            db.close()
+
+        self.assertEqual(metrics.summary("db_call_seconds", function="create_or_join_pair").count, 1)
+        self.assertEqual(metrics.summary("db_call_seconds", function="get_user_pair").count, 1)
+        self.assertEqual(metrics.counter("db_statements_total", function="get_user_pair"), 1)
+        # New user + new pending pair: one commit each
+        self.assertEqual(metrics.counter("db_commits_total"), 2)
+        self.assertEqual(metrics.counter("db_rows_written_total"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
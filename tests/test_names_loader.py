@@ -0,0 +1,78 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from bot_app import config
+from bot_app.core import (
+    answer_and_advance,
+    create_or_join_pair,
+    get_results_for_round,
+    get_round_step,
+    get_user_pair,
+    start_second_round,
+)
+from bot_app.db import Database, add_names, sync_names
+from bot_app.names_loader import NameCatalog, load_catalogs, load_names
+
+
+class TestNameCatalog(unittest.TestCase):
+    def test_lookup_and_iteration(self):
+        catalog = NameCatalog.from_rows([(2, "Ян"), (5, "Аляксандр"), (9, "Leo")])
+        self.assertEqual(len(catalog), 3)
+        self.assertEqual(catalog.name(5), "Аляксандр")
+        self.assertIsNone(catalog.name(3))
+        self.assertIn(9, catalog)
+        self.assertNotIn(10, catalog)
+        self.assertEqual(list(catalog.ids_from(3)), [5, 9])
+        self.assertEqual(list(catalog.ids_from(0)), [2, 5, 9])
+        # 3 ids * 8 + 4 offsets * 4 + UTF-8 bytes
+        self.assertEqual(catalog.nbytes(), 24 + 16 + len("ЯнАляксандрLeo".encode("utf-8")))
+
+    def test_core_uses_catalog_for_names(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(str(Path(tmp) / "t.db"))
+            conn = db.open()
+            add_names(conn, load_names(config.NAMES_FILE)[:10])
+            conn.name_catalogs = load_catalogs(conn)
+            create_or_join_pair(conn, 1, "a", 10)
+            create_or_join_pair(conn, 2, "b", 20)
+            pair = get_user_pair(conn, 1)
+
+            expected = [(r["id"], r["name"]) for r in conn.execute("SELECT id, name FROM names ORDER BY id LIMIT 3")]
+            step = get_round_step(conn, pair["id"], 1, 1)
+            self.assertEqual((step.name_id, step.name), expected[0])
+            step = answer_and_advance(conn, pair["id"], 1, 1, step.name_id, "like")
+            self.assertEqual((step.name_id, step.name, step.answered), expected[1] + (1,))
+            answer_and_advance(conn, pair["id"], 1, 2, expected[0][0], "like")
+
+            start_second_round(conn, pair["id"])
+            step = get_round_step(conn, pair["id"], 2, 2)
+            self.assertEqual((step.name_id, step.name, step.total), expected[0] + (1,))
+            db.close()
+
+    def test_core_skips_names_removed_from_catalog(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(str(Path(tmp) / "t.db"))
+            conn = db.open()
+            names = load_names(config.NAMES_FILE)[:10]
+            add_names(conn, names)
+            create_or_join_pair(conn, 1, "a", 10)
+            create_or_join_pair(conn, 2, "b", 20)
+            pair = get_user_pair(conn, 1)
+            ids = [r["id"] for r in conn.execute("SELECT id FROM names ORDER BY id LIMIT 2")]
+            for user_id in (1, 2):
+                for name_id in ids:
+                    answer_and_advance(conn, pair["id"], 1, user_id, name_id, "like")
+            start_second_round(conn, pair["id"])
+
+            # The first common like is curated away after round 2 started
+            sync_names(conn, names[1:])
+            conn.name_catalogs = load_catalogs(conn)
+            self.assertEqual(get_results_for_round(conn, pair["id"], 1), [names[1]])
+            step = get_round_step(conn, pair["id"], 2, 1)
+            self.assertEqual((step.name_id, step.name), (ids[1], names[1]))
+            db.close()
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,137 @@
+import asyncio
+import time
+import unittest
+
+from telegram.error import BadRequest, RetryAfter
+
+from bot_app.outbound import OutboundQueue
+
+
+class RecordingBot:
+    def __init__(self, fail_first_with_retry: bool = False):
+        self.sent = []
+        self._fail = fail_first_with_retry
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self._fail:
+            self._fail = False
+            raise RetryAfter(0)
+        await asyncio.sleep(0.001)
+        self.sent.append((chat_id, text, time.monotonic()))
+        return text
+
+
+class EditingBot(RecordingBot):
+    def __init__(self, editable: bool = True):
+        super().__init__()
+        self.edits = []
+        self.answers = []
+        self._editable = editable
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        if not self._editable:
+            raise BadRequest("Message can't be edited")
+        await asyncio.sleep(0.001)
+        self.edits.append((chat_id, message_id, text))
+        return text
+
+    async def answer_callback_query(self, callback_query_id, **kwargs):
+        self.answers.append((callback_query_id, time.monotonic()))
+        return True
+
+
+class TestOutboundQueue(unittest.TestCase):
+    def run_queue(self, bot, scenario, **kwargs):
+        async def main():
+            queue = OutboundQueue(bot, stats_interval=0, **kwargs)
+            queue.start()
+            try:
+                return await scenario(queue)
+            finally:
+                await queue.stop()
+
+        return asyncio.run(main())
+
+    def test_per_chat_order_and_coalescing(self):
+        bot = RecordingBot()
+
+        async def scenario(queue):
+            futures = [queue.send_message(1, f"m{i}") for i in range(3)]
+            futures.append(queue.send_message(2, "pair", coalesce_key="pair_found"))
+            futures.append(queue.send_message(2, "pair", coalesce_key="pair_found"))
+            results = await asyncio.gather(*futures)
+            return queue, results
+
+        queue, results = self.run_queue(bot, scenario, chat_rate=1000, chat_burst=1000)
+        self.assertEqual([t for c, t, _ in bot.sent if c == 1], ["m0", "m1", "m2"])
+        self.assertEqual([t for c, t, _ in bot.sent if c == 2], ["pair"])
+        self.assertEqual(results[-1], "pair")
+        self.assertEqual(queue.stats()["coalesced"], 1)
+        self.assertEqual(queue.stats()["depth"], 0)
+
+    def test_chat_rate_limit_spaces_messages(self):
+        bot = RecordingBot()
+
+        async def scenario(queue):
+            await asyncio.gather(*(queue.send_message(1, f"m{i}") for i in range(3)))
+
+        self.run_queue(bot, scenario, chat_rate=20, chat_burst=1)
+        times = [t for _, _, t in bot.sent]
+        # One token per 50ms after the initial burst of one
+        self.assertGreaterEqual(times[2] - times[0], 0.08)
+
+    def test_retry_after_is_retried(self):
+        bot = RecordingBot(fail_first_with_retry=True)
+
+        async def scenario(queue):
+            await queue.send_message(1, "hello")
+            return queue
+
+        queue = self.run_queue(bot, scenario, chat_rate=1000, chat_burst=1000)
+        self.assertEqual([t for _, t, _ in bot.sent], ["hello"])
+        self.assertEqual(queue.stats()["retries"], 1)
+
+    def test_pending_edit_is_replaced_by_newer_edit(self):
+        bot = EditingBot()
+
+        async def scenario(queue):
+            await queue.send_message(1, "card")
+            # Out of budget: both edits wait in the queue
+            await asyncio.gather(queue.edit_message_text(1, 7, "name A"), queue.edit_message_text(1, 7, "name B"))
+            return queue
+
+        queue = self.run_queue(bot, scenario, chat_rate=20, chat_burst=1)
+        self.assertEqual(bot.edits, [(1, 7, "name B")])
+        self.assertEqual(queue.stats()["coalesced"], 1)
+
+    def test_failed_edit_falls_back_to_new_message(self):
+        bot = EditingBot(editable=False)
+
+        async def scenario(queue):
+            await queue.edit_message_text(1, 7, "name A")
+            return queue
+
+        queue = self.run_queue(bot, scenario, chat_rate=1000, chat_burst=1000)
+        self.assertEqual([t for _, t, _ in bot.sent], ["name A"])
+        self.assertEqual(queue.stats()["edit_fallbacks"], 1)
+
+    def test_callback_answers_skip_the_chat_queue(self):
+        bot = EditingBot()
+
+        async def scenario(queue):
+            await queue.send_message(1, "card")
+            # The chat is out of budget, so the edit waits; the answer doesn't
+            edit = queue.edit_message_text(1, 7, "name A")
+            await queue.answer_callback_query("q1")
+            answered = time.monotonic()
+            await edit
+            return answered
+
+        answered = self.run_queue(bot, scenario, chat_rate=10, chat_burst=1)
+        self.assertEqual([q for q, _ in bot.answers], ["q1"])
+        self.assertEqual(bot.edits, [(1, 7, "name A")])
+        self.assertLess(answered, bot.sent[0][2] + 0.05)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
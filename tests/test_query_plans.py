@@ -0,0 +1,35 @@
+import unittest
+
+from bench.query_bench import collect_plans, plan_failures, plan_problems, query_plan, seed
+from bot_app.db import get_connection, init_db
+
+
+class TestQueryPlans(unittest.TestCase):
+    def setUp(self):
+        self.conn = get_connection(":memory:")
+        init_db(self.conn)
+        seed(self.conn, [f"Name{i:04d}" for i in range(300)], pairs=4, ratings=800)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_core_queries_use_indexes(self):
+        # Pair 2 is in round 1, pair 1 in round 2 (see seed)
+        for pair_id, user_id in ((2, 3), (1, 1)):
+            plans = collect_plans(self.conn, pair_id, user_id, 120)
+            self.assertIn("answer_and_advance r1", plans)
+            self.assertEqual(plan_failures(plans), {})
+
+    def test_dropped_index_is_caught(self):
+        self.conn.execute("DROP INDEX idx_pairs_user1")
+        self.assertIn("get_user_pair", plan_failures(collect_plans(self.conn, 2, 3, 120)))
+
+    def test_full_scan_and_sort_are_flagged(self):
+        plan = query_plan(self.conn, "SELECT name_id FROM ratings WHERE answer=1 ORDER BY name_id")
+        self.assertEqual(len(plan_problems(plan)), 2)
+        plan = query_plan(self.conn, "SELECT answer FROM ratings WHERE pair_id=1 AND round=1 AND user_id=1 AND name_id=5")
+        self.assertEqual(plan_problems(plan), [])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)